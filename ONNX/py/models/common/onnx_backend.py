@@ -0,0 +1,172 @@
+'''
+Inference backends for the ONNX models
+
+create_backend() returns an object with a single run(data) method that feeds
+one input batch (numpy array or mx.nd.NDArray) through the model and returns
+the list of its outputs as numpy arrays, whichever engine runs it:
+
+    mxnet        the model imported into an mx.mod.Module (through onnx_cache)
+    onnxruntime  an onnxruntime InferenceSession with tuned session options
+
+Pick onnxruntime for CPU serving, and mxnet for GPUs or when the MXNet module
+is needed, e.g. for its internal layers.
+
+The session options are feature-detected: the onnxruntime pinned in
+requirements.txt (0.4) predates the thread, execution mode and optimization
+level settings of 1.0, the options it does not have keep its defaults.
+
+Shared by the models: their scripts add models/common to sys.path.
+'''
+import warnings
+
+import numpy as np
+
+
+GRAPH_OPTIMIZATION = {'disable': 'ORT_DISABLE_ALL',
+                      'basic': 'ORT_ENABLE_BASIC',
+                      'extended': 'ORT_ENABLE_EXTENDED',
+                      'all': 'ORT_ENABLE_ALL'}
+
+# integer levels of the onnxruntime releases before the GraphOptimizationLevel enum
+LEGACY_GRAPH_OPTIMIZATION = {'disable': 0, 'basic': 1, 'extended': 2, 'all': 2}
+
+
+def as_numpy(data):
+    return data.asnumpy() if hasattr(data, 'asnumpy') else data
+
+
+class MxnetBackend(object):
+    """
+        ONNX model imported into MXNet, bound for inference
+    """
+    def __init__(self, model_path, data_shape, ctx=None, data_name='data', output=None):
+        """
+            Parameters:
+            ----------
+                model_path : string
+                    onnx model
+                data_shape : tuple
+                    input shape the module is bound at, other shapes rebind it
+                ctx : mx.context
+                    device to run on, cpu by default
+                data_name : string
+                    name of the model input
+                output : string
+                    run the model up to this internal output instead, e.g. 'fc1_output'
+        """
+        import mxnet as mx
+        from onnx_cache import import_model
+        self.mx = mx
+        sym, arg_params, aux_params = import_model(model_path)
+        if output is not None:
+            sym = sym.get_internals()[output]
+        self.mod = mx.mod.Module(symbol=sym, data_names=[data_name], context=ctx or mx.cpu(), label_names=None)
+        self.mod.bind(for_training=False, data_shapes=[(data_name, tuple(data_shape))])
+        # every weight has to be in the model, the layers past an internal output leave extra ones
+        self.mod.set_params(arg_params, aux_params, allow_missing=False, allow_extra=output is not None)
+
+    def run(self, data):
+        if not isinstance(data, self.mx.nd.NDArray):
+            data = self.mx.nd.array(data)
+        # Module.forward rebinds itself when the shape changes
+        self.mod.forward(self.mx.io.DataBatch(data=(data,)), is_train=False)
+        return [output.asnumpy() for output in self.mod.get_outputs()]
+
+
+class OrtBackend(object):
+    """
+        ONNX model run by onnxruntime on the CPU
+    """
+    def __init__(self, model_path, intra_op_threads=0, inter_op_threads=0, graph_optimization='all',
+                 io_binding=False):
+        """
+            Parameters:
+            ----------
+                model_path : string
+                    onnx model
+                intra_op_threads : int number
+                    threads running one operator, 0 lets onnxruntime pick
+                inter_op_threads : int number
+                    threads running independent operators in parallel, 0 or 1 runs the graph sequentially
+                graph_optimization : string
+                    'disable', 'basic', 'extended' or 'all'
+                io_binding : bool
+                    bind the outputs to preallocated arrays, one set per input shape, run() then returns
+                    these arrays and overwrites them on the next run with the same shape;
+                    needs an onnxruntime with IO binding (1.2+), plain runs are used otherwise
+            Options the installed onnxruntime does not have are listed in self.unsupported, with a warning
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        self.unsupported = []
+        if intra_op_threads > 0:
+            self.set_option(options, 'intra_op_num_threads', intra_op_threads)
+        if inter_op_threads > 0:
+            self.set_option(options, 'inter_op_num_threads', inter_op_threads)
+        if inter_op_threads > 1:
+            if hasattr(ort, 'ExecutionMode'):
+                self.set_option(options, 'execution_mode', ort.ExecutionMode.ORT_PARALLEL)
+            else:
+                self.set_option(options, 'enable_sequential_execution', False)
+        if hasattr(ort, 'GraphOptimizationLevel'):
+            self.set_option(options, 'graph_optimization_level',
+                            getattr(ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION[graph_optimization]))
+        else:
+            self.set_option(options, 'graph_optimization_level', LEGACY_GRAPH_OPTIMIZATION[graph_optimization])
+        if self.unsupported:
+            warnings.warn('onnxruntime %s has no session option %s, left at the default'
+                          % (getattr(ort, '__version__', '?'), ', '.join(self.unsupported)))
+        self.session = ort.InferenceSession(model_path, options)
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        self.io_binding = io_binding and hasattr(self.session, 'io_binding')
+        self.bindings = {}
+
+    def set_option(self, options, name, value):
+        if hasattr(options, name):
+            setattr(options, name, value)
+        else:
+            self.unsupported.append(name)
+
+    def run(self, data):
+        data = np.ascontiguousarray(as_numpy(data), dtype=np.float32)
+        if not self.io_binding:
+            return self.session.run(self.output_names, {self.input_name: data})
+        if data.shape not in self.bindings:
+            # the first run with a shape gives the output shapes
+            outputs = [np.empty_like(output) for output in
+                       self.session.run(self.output_names, {self.input_name: data})]
+            binding = self.session.io_binding()
+            for name, output in zip(self.output_names, outputs):
+                binding.bind_output(name, 'cpu', 0, output.dtype, output.shape, output.ctypes.data)
+            self.bindings[data.shape] = (binding, outputs)
+        binding, outputs = self.bindings[data.shape]
+        binding.bind_cpu_input(self.input_name, data)
+        self.session.run_with_iobinding(binding)
+        return outputs
+
+
+def create_backend(backend, model_path, data_shape, ctx=None, **options):
+    """
+        model runner of the backend
+    Parameters:
+    ----------
+        backend: string
+            'mxnet' or 'onnxruntime'
+        model_path: string
+            onnx model
+        data_shape: tuple
+            input shape the MXNet module is bound at
+        ctx: mx.context
+            device of the MXNet module
+        options:
+            the other arguments of MxnetBackend or OrtBackend
+    Returns:
+    -------
+        MxnetBackend or OrtBackend
+    """
+    if backend == 'mxnet':
+        return MxnetBackend(model_path, data_shape, ctx, **options)
+    if backend == 'onnxruntime':
+        return OrtBackend(model_path, **options)
+    raise ValueError('unknown backend %s, use mxnet or onnxruntime' % backend)
@@ -0,0 +1,140 @@
+'''
+Persistent cache for ONNX models imported into MXNet
+
+import_model() converts the ONNX file once and saves the symbol JSON and the
+params under a key made of the file name, a hash of its absolute path and its
+content hash. Later starts load them with mx.sym.load / mx.nd.load instead of
+parsing the protobuf again.
+An entry is stale, and converted again, when the hash of the ONNX file or the
+MXNet version it was converted with differs. The hash is only computed again
+when the size or mtime of the ONNX file changed. Models of the same file name
+in different directories get separate entries.
+
+Shared by the models: their scripts add models/common to sys.path.
+
+Pre-warm the cache: python onnx_cache.py resnet100.onnx ResNet101_DUC_HDC.onnx [--cache-dir DIR] [--force]
+'''
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import mxnet as mx
+
+
+DEFAULT_CACHE_DIR = os.environ.get('ONNX_MODEL_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.mxnet', 'onnx_cache'))
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()[:16]
+
+
+def path_key(model_path):
+    return hashlib.sha1(os.path.abspath(model_path).encode('utf-8')).hexdigest()[:8]
+
+
+def cache_entry(model_path, cache_dir):
+    '''
+    Cache prefix of the ONNX file and whether its converted symbol and params are up to date
+    The last size, mtime and hash of every model are kept in <name>-<path key>.json, the hash is reused while they match
+    '''
+    name = '%s-%s' % (os.path.splitext(os.path.basename(model_path))[0], path_key(model_path))
+    index_path = os.path.join(cache_dir, name + '.json')
+    st = os.stat(model_path)
+    old = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            old = json.load(f)
+    if old.get('source') == os.path.abspath(model_path) and old.get('size') == st.st_size \
+            and old.get('mtime') == st.st_mtime:
+        digest = old['digest']
+    else:
+        digest = file_digest(model_path)
+    prefix = os.path.join(cache_dir, '%s-%s' % (name, digest))
+    index = {'source': os.path.abspath(model_path), 'size': st.st_size, 'mtime': st.st_mtime,
+             'digest': digest, 'mxnet': mx.__version__}
+    fresh = old.get('digest') == digest and old.get('mxnet') == mx.__version__ \
+        and os.path.exists(prefix + '-symbol.json') and os.path.exists(prefix + '.params')
+    return prefix, fresh, old, index, index_path
+
+
+def write_index(index, index_path):
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def save_entry(prefix, old, index, index_path, sym, arg_params, aux_params):
+    '''
+    Write the symbol and params under temporary names first, concurrent loaders never see a partial entry,
+    then drop the entry of the previous version of the model
+    '''
+    tmp = '%s.%d.tmp' % (prefix, os.getpid())
+    sym.save(tmp + '-symbol.json')
+    save_dict = {('arg:%s' % k): v for k, v in arg_params.items()}
+    save_dict.update({('aux:%s' % k): v for k, v in aux_params.items()})
+    mx.nd.save(tmp + '.params', save_dict)
+    os.replace(tmp + '-symbol.json', prefix + '-symbol.json')
+    os.replace(tmp + '.params', prefix + '.params')
+    write_index(index, index_path)
+    if old.get('digest') not in (None, index['digest']):
+        old_prefix = os.path.join(os.path.dirname(index_path), '%s-%s' % (
+            os.path.splitext(os.path.basename(index_path))[0], old['digest']))
+        for path in (old_prefix + '-symbol.json', old_prefix + '.params'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def load_entry(prefix):
+    sym = mx.sym.load(prefix + '-symbol.json')
+    arg_params, aux_params = {}, {}
+    for k, v in mx.nd.load(prefix + '.params').items():
+        kind, name = k.split(':', 1)
+        if kind == 'arg':
+            arg_params[name] = v
+        else:
+            aux_params[name] = v
+    return sym, arg_params, aux_params
+
+
+def import_model(model_path, cache_dir=DEFAULT_CACHE_DIR, force=False):
+    '''
+    Drop-in replacement of mxnet.contrib.onnx.import_model going through the cache
+    Returns (sym, arg_params, aux_params)
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    prefix, fresh, old, index, index_path = cache_entry(model_path, cache_dir)
+    if fresh and not force:
+        if old != index:
+            # same content, new mtime: skip hashing it next time
+            write_index(index, index_path)
+        return load_entry(prefix)
+    from mxnet.contrib.onnx import import_model as onnx_import_model
+    sym, arg_params, aux_params = onnx_import_model(model_path)
+    save_entry(prefix, old, index, index_path, sym, arg_params, aux_params)
+    return sym, arg_params, aux_params
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pre-warm the ONNX to MXNet import cache')
+    parser.add_argument('models', nargs='+', help='onnx model files')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='cache directory')
+    parser.add_argument('--force', action='store_true', help='convert again even if the cache is fresh')
+    args = parser.parse_args()
+    for model_path in args.models:
+        tic = time.time()
+        import_model(model_path, args.cache_dir, args.force)
+        print('%s: %.2f s' % (model_path, time.time() - tic))
+
+
+if __name__ == '__main__':
+    main()
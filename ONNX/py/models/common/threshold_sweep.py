@@ -0,0 +1,46 @@
+'''
+Verification accuracy of face pairs over a grid of distance thresholds
+
+calculate_accuracy() thresholds the distances of the pairs once,
+calculate_accuracies() gives the same numbers for all the thresholds at once:
+the distances of the same and of the different pairs are sorted once and the
+number of pairs below every threshold is found by binary search.
+
+Shared by verification.py and arcface_validation.py: they add models/common to sys.path.
+'''
+import numpy as np
+
+
+def calculate_accuracy(threshold, dist, actual_issame):
+    '''
+    Computes the actual accuracy for test samples by thresholding the distance between embedding vectors of a test
+    image pair and comparing the output with the ground truth for the pair
+    '''
+    predict_issame = np.less(dist, threshold)
+    tp = np.sum(np.logical_and(predict_issame, actual_issame))
+    fp = np.sum(np.logical_and(predict_issame, np.logical_not(actual_issame)))
+    tn = np.sum(np.logical_and(np.logical_not(predict_issame), np.logical_not(actual_issame)))
+    fn = np.sum(np.logical_and(np.logical_not(predict_issame), actual_issame))
+
+    tpr = 0 if (tp + fn == 0) else float(tp) / float(tp + fn)
+    fpr = 0 if (fp + tn == 0) else float(fp) / float(fp + tn)
+    acc = float(tp + tn) / dist.size
+    return tpr, fpr, acc
+
+
+def calculate_accuracies(thresholds, dist, actual_issame):
+    '''
+    calculate_accuracy() for all the thresholds at once, a finer threshold grid costs next to nothing
+    '''
+    actual_issame = np.asarray(actual_issame, dtype=bool)
+    dist_same = np.sort(dist[actual_issame])
+    dist_diff = np.sort(dist[np.logical_not(actual_issame)])
+    # pairs predicted the same, np.less(dist, threshold), for every threshold
+    tp = np.searchsorted(dist_same, thresholds, side='left')
+    fp = np.searchsorted(dist_diff, thresholds, side='left')
+    tn = dist_diff.size - fp
+
+    tpr = np.zeros(len(thresholds)) if dist_same.size == 0 else tp / float(dist_same.size)
+    fpr = np.zeros(len(thresholds)) if dist_diff.size == 0 else fp / float(dist_diff.size)
+    acc = (tp + tn) / float(dist.size)
+    return tpr, fpr, acc
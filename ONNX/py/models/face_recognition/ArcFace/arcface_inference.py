@@ -19,11 +19,10 @@
 # * OpenCV - `pip install opencv-python`
 # * Scikit-learn - `pip install scikit-learn`
 # * EasyDict - `pip install easydict`
-# * Scikit-image - `pip install scikit-image`
 # 
 # Also the following scripts and folders (included in the repo) must be present in the same folder as this notebook:
 # * `mtcnn_detector.py` (Performs face detection as a part of preprocessing)
-# * `helper.py` (helper script for face detection)
+# * `helper.py` (helper script for face detection and alignment)
 # 
 # In order to do inference with a python script:
 # * Generate the script : In Jupyter Notebook browser, go to File -> Download as -> Python (.py)
@@ -51,26 +50,23 @@ from sklearn.decomposition import PCA
 from time import sleep
 from easydict import EasyDict as edict
 from mtcnn_detector import MtcnnDetector
-from skimage import transform as trans
+from helper import umeyama_batch, warp_faces
 import matplotlib.pyplot as plt
-from mxnet.contrib.onnx.onnx2mx.import_model import import_model
+# onnx_cache and onnx_backend are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from onnx_backend import create_backend
 
 
 # ### Load pretrained model
-# `get_model()` : Loads ONNX model into MXNet symbols and params, defines model using symbol file and binds parameters to the model using params file.
+# `get_model()` : Loads ONNX model into MXNet symbols and params, defines model using symbol file and binds parameters to the model using params file. With `backend='onnxruntime'` the model runs in an onnxruntime session instead.
 
 # In[2]:
 
 
-def get_model(ctx, model):
+def get_model(ctx, model, backend='mxnet', **options):
     image_size = (112,112)
-    # Import ONNX model
-    sym, arg_params, aux_params = import_model(model)
-    # Define and binds parameters to the network
-    model = mx.mod.Module(symbol=sym, context=ctx, label_names = None)
-    model.bind(data_shapes=[('data', (1, 3, image_size[0], image_size[1]))])
-    model.set_params(arg_params, aux_params)
-    return model
+    # Import ONNX model and bind it (mxnet), or open an onnxruntime session; options go to create_backend
+    return create_backend(backend, model, (1, 3, image_size[0], image_size[1]), ctx, **options)
 
 
 # ### Face detector & alignment
@@ -139,13 +135,10 @@ def preprocess(img, bbox=None, landmark=None, **kwargs):
           [62.7299, 92.2041] ], dtype=np.float32 )
         if image_size[1]==112:
             src[:,0] += 8.0
-        dst = landmark.astype(np.float32)
-        tform = trans.SimilarityTransform()
-        tform.estimate(dst, src)
-        M = tform.params[0:2,:]
-        assert len(image_size)==2
-        warped = cv2.warpAffine(img,M,(image_size[1],image_size[0]), borderValue = 0.0)
-        return warped
+        # closed-form similarity transform and warp, the same as face_preprocess.preprocess_batch
+        M = umeyama_batch(landmark[None], src)
+        warped = warp_faces(img, M, np.empty((1, 3, image_size[0], image_size[1]), dtype=img.dtype))
+        return np.ascontiguousarray(warped[0].transpose((1, 2, 0)))
     
     # If no landmark points available, do alignment using bounding box. If no bounding box available use center crop
     if M is None:
@@ -192,11 +185,8 @@ def get_input(detector,face_img):
 
 
 def get_feature(model,aligned):
-    input_blob = np.expand_dims(aligned, axis=0)
-    data = mx.nd.array(input_blob)
-    db = mx.io.DataBatch(data=(data,))
-    model.forward(db, is_train=False)
-    embedding = model.get_outputs()[0].asnumpy()
+    input_blob = np.expand_dims(aligned, axis=0).astype(np.float32)
+    embedding = model.run(input_blob)[0]
     embedding = sklearn.preprocessing.normalize(embedding).flatten()
     return embedding
 
@@ -48,7 +48,10 @@ import pickle
 import mxnet as mx
 from mxnet import ndarray as nd
 from easydict import EasyDict as edict
-from mxnet.contrib.onnx.onnx2mx.import_model import import_model
+# onnx_cache, onnx_backend and threshold_sweep are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from onnx_cache import import_model
+from threshold_sweep import calculate_accuracies
 
 
 # ### Data loading helper code
@@ -94,8 +97,8 @@ def load_property(data_dir):
 
 # ### Evaluation helper code
 # * `class LFold` is used to split the data for K-fold crossvalidation
-# * `calculate_roc()` computes accuracy on each fold of cross validation using `calculate_accuracy()`
-# * `calculate_accuracy()` computes the actual accuracy for test samples by thresholding the distance between embedding vectors of a test image pair and comparing the output with the ground truth for the pair
+# * `calculate_roc()` computes accuracy on each fold of cross validation using `calculate_accuracies()`
+# * `calculate_accuracies()` (threshold_sweep.py, shared with verification.py) computes the actual accuracy for test samples at every threshold by thresholding the distance between embedding vectors of a test image pair and comparing the output with the ground truth for the pair
 # * `evaluate()` splits embeddings into test pairs and computes accuracies using `calculate_roc()`
 
 # In[3]:
@@ -131,33 +134,18 @@ def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_fold
     
     for fold_idx, (train_set, test_set) in enumerate(k_fold.split(indices)):        
         # Find the best threshold for the fold
-        acc_train = np.zeros((nrof_thresholds))
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, _, acc_train[threshold_idx] = calculate_accuracy(threshold, dist[train_set], actual_issame[train_set])
+        _, _, acc_train = calculate_accuracies(thresholds, dist[train_set], actual_issame[train_set])
         best_threshold_index = np.argmax(acc_train)
-        for threshold_idx, threshold in enumerate(thresholds):
-            tprs[fold_idx,threshold_idx], fprs[fold_idx,threshold_idx], _ = calculate_accuracy(threshold, dist[test_set], actual_issame[test_set])
-        _, _, accuracy[fold_idx] = calculate_accuracy(thresholds[best_threshold_index], dist[test_set], actual_issame[test_set])
+        tprs[fold_idx,:], fprs[fold_idx,:], acc_test = calculate_accuracies(thresholds, dist[test_set], actual_issame[test_set])
+        accuracy[fold_idx] = acc_test[best_threshold_index]
           
     tpr = np.mean(tprs,0)
     fpr = np.mean(fprs,0)
     return tpr, fpr, accuracy
 
-def calculate_accuracy(threshold, dist, actual_issame):
-    predict_issame = np.less(dist, threshold)
-    tp = np.sum(np.logical_and(predict_issame, actual_issame))
-    fp = np.sum(np.logical_and(predict_issame, np.logical_not(actual_issame)))
-    tn = np.sum(np.logical_and(np.logical_not(predict_issame), np.logical_not(actual_issame)))
-    fn = np.sum(np.logical_and(np.logical_not(predict_issame), actual_issame))
-  
-    tpr = 0 if (tp+fn==0) else float(tp) / float(tp+fn)
-    fpr = 0 if (fp+tn==0) else float(fp) / float(fp+tn)
-    acc = float(tp+tn)/dist.size
-    return tpr, fpr, acc
-
-def evaluate(embeddings, actual_issame, nrof_folds=10):
+def evaluate(embeddings, actual_issame, nrof_folds=10, threshold_step=0.01):
     # Calculate evaluation metrics
-    thresholds = np.arange(0, 4, 0.01)
+    thresholds = np.arange(0, 4, threshold_step)
     embeddings1 = embeddings[0::2]
     embeddings2 = embeddings[1::2]
     tpr, fpr, accuracy = calculate_roc(thresholds, embeddings1, embeddings2,
@@ -0,0 +1,106 @@
+'''
+Benchmark for the batched face alignment in face_preprocess.py against the
+per-face SimilarityTransform + warpAffine path it replaced.
+
+Run: python benchmark_align.py --faces 100,1000,5000 --threads 1,2,4,8
+'''
+from __future__ import print_function
+
+import argparse
+import time
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+from face_preprocess import ARCFACE_SRC, alignment_transforms, preprocess_batch
+
+
+def legacy_umeyama(src, dst):
+    '''
+    Per-face Umeyama estimate, as skimage.transform.SimilarityTransform.estimate does it
+    '''
+    num = src.shape[0]
+    src_mean = src.mean(axis=0)
+    dst_mean = dst.mean(axis=0)
+    src_demean = src - src_mean
+    dst_demean = dst - dst_mean
+    A = np.dot(dst_demean.T, src_demean) / num
+    d = np.ones((2,))
+    if np.linalg.det(A) < 0:
+        d[1] = -1
+    U, S, V = np.linalg.svd(A)
+    T = np.eye(3)
+    T[:2, :2] = np.dot(U, np.dot(np.diag(d), V))
+    scale = 1.0 / src_demean.var(axis=0).sum() * np.dot(S, d)
+    T[:2, 2] = dst_mean - scale * np.dot(T[:2, :2], src_mean)
+    T[:2, :2] *= scale
+    return T[:2]
+
+
+def legacy_align(img, landmarks, src):
+    out = np.empty((len(landmarks), 3, 112, 112), dtype=np.uint8)
+    for i, landmark in enumerate(landmarks):
+        M = legacy_umeyama(landmark, src)
+        warped = cv2.warpAffine(img, M, (112, 112), borderValue=0.0)
+        out[i] = np.transpose(cv2.cvtColor(warped, cv2.COLOR_BGR2RGB), (2, 0, 1))
+    return out
+
+
+def random_landmarks(num_face, width, height, seed=0):
+    '''
+    The reference landmarks scaled, rotated, jittered and moved around the image
+    '''
+    rng = np.random.RandomState(seed)
+    scale = rng.uniform(0.5, 3.0, size=(num_face, 1, 1))
+    angle = rng.uniform(-0.5, 0.5, size=num_face)
+    rot = np.stack([np.stack([np.cos(angle), -np.sin(angle)], 1), np.stack([np.sin(angle), np.cos(angle)], 1)], 1)
+    points = np.einsum('nij,kj->nki', rot, ARCFACE_SRC) * scale + rng.normal(0, 2, size=(num_face, 5, 2))
+    points += rng.uniform(0, 1, size=(num_face, 1, 2)) * [width - 400, height - 400]
+    return points
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        tic = time.time()
+        func()
+        best = min(best, time.time() - tic)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark face alignment')
+    parser.add_argument('--faces', default='100,1000,5000', help='comma separated face counts')
+    parser.add_argument('--threads', default='1,2,4', help='comma separated warp thread counts')
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs')
+    args = parser.parse_args()
+
+    img = np.random.RandomState(0).randint(0, 255, (1080, 1920, 3)).astype(np.uint8)
+    src = ARCFACE_SRC.copy()
+    src[:, 0] += 8.0
+    threads = [int(x) for x in args.threads.split(',')]
+    pools = dict((t, ThreadPool(t)) for t in threads if t > 1)
+
+    for num_face in [int(x) for x in args.faces.split(',')]:
+        landmarks = random_landmarks(num_face, img.shape[1], img.shape[0])
+        ref = np.stack([legacy_umeyama(l, src) for l in landmarks])
+        assert np.allclose(ref, alignment_transforms(landmarks), atol=1e-4), 'transforms differ from the reference'
+        out = np.empty((num_face, 3, 112, 112), dtype=np.uint8)
+
+        t_legacy_solve = timeit(lambda: [legacy_umeyama(l, src) for l in landmarks], args.repeat)
+        t_solve = timeit(lambda: alignment_transforms(landmarks), args.repeat)
+        t_legacy = timeit(lambda: legacy_align(img, landmarks, src), args.repeat)
+        print('faces %6d  solve legacy %8.2f ms  batched %8.2f ms  |  align legacy %8.2f ms' %
+              (num_face, t_legacy_solve * 1e3, t_solve * 1e3, t_legacy * 1e3))
+        for t in threads:
+            pool = pools.get(t)
+            t_batch = timeit(lambda: preprocess_batch(img, landmarks, out=out, pool=pool, rgb=True), args.repeat)
+            print('      %2d threads  align batched %8.2f ms  speedup %.2fx' % (t, t_batch * 1e3, t_legacy / t_batch))
+
+    for pool in pools.values():
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Side-by-side latency and throughput of the inference backends in onnx_backend.py.
+
+Runs the model with MXNet and with onnxruntime for every thread count,
+graph optimization level and IO binding setting, checks the outputs agree
+with the first backend, and reports the p50 / p99 latency of batch 1 and
+the throughput at --batch-size. Any ONNX model works with its input shape:
+
+Run: python benchmark_backends.py --model resnet100.onnx --shape 3,112,112 --threads 1,4
+     python benchmark_backends.py --model ResNet101_DUC_HDC.onnx --shape 3,800,800 --batch-size 1
+     python benchmark_backends.py --model resnet50v2.onnx --shape 3,224,224 --optimizations basic,all
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+# onnx_cache and onnx_backend are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from onnx_backend import create_backend
+
+
+def timeit(backend, data, runs):
+    latencies = []
+    for _ in range(runs):
+        tic = time.time()
+        backend.run(data)
+        latencies.append(time.time() - tic)
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the mxnet and onnxruntime backends')
+    parser.add_argument('--model', default='resnet100.onnx', help='onnx model')
+    parser.add_argument('--shape', default='3,112,112', help='input shape without the batch axis')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size of the throughput run')
+    parser.add_argument('--backends', default='mxnet,onnxruntime', help='comma separated backends')
+    parser.add_argument('--threads', default='0,1,4', help='comma separated onnxruntime intra-op threads, 0 for all')
+    parser.add_argument('--inter-op-threads', type=int, default=0, help='onnxruntime inter-op threads')
+    parser.add_argument('--optimizations', default='all', help='comma separated onnxruntime graph optimization levels')
+    parser.add_argument('--runs', type=int, default=50, help='timed runs per setting')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed runs per setting')
+    args = parser.parse_args()
+
+    shape = tuple(int(x) for x in args.shape.split(','))
+    rng = np.random.RandomState(0)
+    single = rng.uniform(0, 255, (1,) + shape).astype(np.float32)
+    batch = rng.uniform(0, 255, (args.batch_size,) + shape).astype(np.float32)
+
+    settings = []
+    for name in args.backends.split(','):
+        if name == 'mxnet':
+            settings.append(('mxnet', {}))
+            continue
+        for opt in args.optimizations.split(','):
+            for threads in [int(x) for x in args.threads.split(',')]:
+                for io_binding in (False, True):
+                    settings.append((name, {'intra_op_threads': threads, 'inter_op_threads': args.inter_op_threads,
+                                            'graph_optimization': opt, 'io_binding': io_binding}))
+
+    reference = None
+    print('%-48s %10s %10s %12s' % ('backend', 'p50(ms)', 'p99(ms)', 'items/s'))
+    for name, options in settings:
+        backend = create_backend(name, args.model, single.shape, **options)
+        output = backend.run(single)[0]
+        if reference is None:
+            reference = output.copy()
+        elif not np.allclose(output, reference, rtol=1e-3, atol=1e-3):
+            print('  outputs differ from the first backend, max abs diff %g' % np.abs(output - reference).max())
+        for _ in range(args.warmup):
+            backend.run(single)
+            backend.run(batch)
+        p50, p99 = np.percentile(timeit(backend, single, args.runs), [50, 99])
+        throughput = args.batch_size / np.median(timeit(backend, batch, max(1, args.runs // 5)))
+        label = name
+        if options:
+            label += ' %s intra=%d inter=%d%s' % (options['graph_optimization'], options['intra_op_threads'],
+                                                 options['inter_op_threads'], ' io-binding' if options['io_binding'] else '')
+        print('%-48s %10.2f %10.2f %12.1f' % (label, p50 * 1e3, p99 * 1e3, throughput))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+Throughput benchmark for EmbeddingService.
+
+Compares one forward per face on a module bound at batch size 1 (as
+get_feature in arcface_inference.py does) with the micro-batching service
+fed by several client threads, and prints the service statistics.
+
+Run: python benchmark_embedding.py --model resnet100.onnx --batch-sizes 8,32 --clients 32
+'''
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+
+import mxnet as mx
+import numpy as np
+
+from embedding_service import EmbeddingService, get_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the micro-batching embedding service')
+    parser.add_argument('--model', default='resnet100.onnx', help='arcface onnx model')
+    parser.add_argument('--faces', type=int, default=512, help='number of faces embedded')
+    parser.add_argument('--batch-sizes', default='8,16,32', help='comma separated service batch sizes')
+    parser.add_argument('--max-wait', type=float, default=5, help='max batch wait in ms')
+    parser.add_argument('--clients', type=int, default=32, help='client threads')
+    parser.add_argument('--gpu', type=int, default=-1, help='gpu id, -1 for cpu')
+    parser.add_argument('--backend', default='mxnet', choices=['mxnet', 'onnxruntime'], help='inference backend')
+    args = parser.parse_args()
+
+    ctx = mx.cpu() if args.gpu < 0 else mx.gpu(args.gpu)
+    faces = np.random.RandomState(0).randint(0, 255, (args.faces, 3, 112, 112)).astype(np.uint8)
+
+    model = get_model(ctx, args.model, 1, backend=args.backend)
+    tic = time.time()
+    for aligned in faces:
+        model.run(aligned[None].astype(np.float32))
+    base = args.faces / (time.time() - tic)
+    print('batch size  1, sequential        %8.1f faces/s' % base)
+
+    for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+        with EmbeddingService(get_model(ctx, args.model, batch_size, backend=args.backend), batch_size=batch_size,
+                              max_wait=args.max_wait * 1e-3) as service:
+            def client(k):
+                for i in range(k, args.faces, args.clients):
+                    service.embed(faces[i])
+            threads = [threading.Thread(target=client, args=(k,)) for k in range(args.clients)]
+            tic = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            throughput = args.faces / (time.time() - tic)
+            stats = service.stats()
+        print('batch size %2d, %3d clients       %8.1f faces/s  %.2fx  p50 %.1f ms  p99 %.1f ms' %
+              (batch_size, args.clients, throughput, throughput / base, stats['p50'] * 1e3, stats['p99'] * 1e3))
+        print('    batch sizes %s' % sorted(stats['batch_size_histogram'].items()))
+
+
+if __name__ == '__main__':
+    main()
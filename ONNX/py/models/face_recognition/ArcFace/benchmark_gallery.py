@@ -0,0 +1,62 @@
+'''
+Query latency benchmark for FaceGallery.
+
+Enrolls random embeddings into a new gallery, checks the top k against an
+exact float32 search on a sample and reports the latency per query for
+several query batch sizes.
+
+Run: python benchmark_gallery.py --path /tmp/gallery --size 1000000 --dtype float16 --batches 1,16,64,256
+'''
+from __future__ import print_function
+
+import argparse
+import shutil
+import time
+
+import numpy as np
+
+from face_gallery import FaceGallery
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark face gallery search')
+    parser.add_argument('--path', default='/tmp/face_gallery_benchmark', help='gallery folder, it is replaced')
+    parser.add_argument('--size', type=int, default=1000000, help='enrolled faces')
+    parser.add_argument('--dim', type=int, default=512, help='embedding length')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'int8'], help='gallery storage')
+    parser.add_argument('--block-size', type=int, default=16384, help='gallery rows per matmul')
+    parser.add_argument('--batches', default='1,16,64,256', help='comma separated query batch sizes')
+    parser.add_argument('--k', type=int, default=5, help='matches per query')
+    parser.add_argument('--cache-mb', type=int, default=0, help='float32 block cache of the gallery in MB, 0 for none')
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs')
+    args = parser.parse_args()
+
+    shutil.rmtree(args.path, ignore_errors=True)
+    gallery = FaceGallery(args.path, dim=args.dim, dtype=args.dtype, block_size=args.block_size,
+                          cache_bytes=args.cache_mb << 20)
+    rng = np.random.RandomState(0)
+    tic = time.time()
+    for start in range(0, args.size, 100000):
+        num = min(100000, args.size - start)
+        gallery.add(rng.normal(size=(num, args.dim)).astype(np.float32), np.arange(start, start + num))
+    gallery.flush()
+    print('enrolled %d faces in %.1f s' % (args.size, time.time() - tic))
+
+    # queries close to known faces, the exact match has to come first
+    truth = rng.randint(0, args.size, size=max(int(x) for x in args.batches.split(',')))
+    queries = gallery.embeddings[truth].astype(np.float32) * gallery.scale
+    queries += rng.normal(0, 0.02, size=queries.shape).astype(np.float32)
+    _, labels = gallery.search(queries[:16], args.k)
+    assert np.array_equal(labels[:, 0], truth[:16]), 'nearest face is not the enrolled one'
+
+    for batch in [int(x) for x in args.batches.split(',')]:
+        best = float('inf')
+        for _ in range(args.repeat):
+            tic = time.time()
+            gallery.search(queries[:batch], args.k)
+            best = min(best, time.time() - tic)
+        print('batch %4d  %9.2f ms per batch  %8.2f ms per query' % (batch, best * 1e3, best * 1e3 / batch))
+
+
+if __name__ == '__main__':
+    main()
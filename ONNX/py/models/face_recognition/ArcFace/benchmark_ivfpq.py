@@ -0,0 +1,97 @@
+'''
+Recall and latency benchmark for FaceIvfPq against exact search.
+
+The embeddings come from a .npy file (n x 512, e.g. saved by an earlier
+run with --save-embeddings) or are computed with the ArcFace model over
+the images of a verification .bin. The last --queries embeddings are held
+out as queries, the rest is enrolled, and recall@k against the exact top k
+is reported for every nprobe, with and without exact re-ranking.
+
+Run: python benchmark_ivfpq.py --bin lfw.bin --model resnet100.onnx --save-embeddings lfw_emb.npy --nprobes 1,4,16,64
+     python benchmark_ivfpq.py --embeddings lfw_emb.npy --nprobes 1,4,16,64 --rerank 100
+'''
+from __future__ import print_function
+
+import argparse
+import shutil
+import time
+
+import numpy as np
+
+from face_ivfpq import FaceIvfPq
+
+
+def compute_embeddings(args):
+    '''
+    ArcFace embeddings of the images of a verification .bin
+    '''
+    import mxnet as mx
+    from embedding_service import get_model
+    from verification import load_bin
+    data_list, _ = load_bin(args.bin, (112, 112), flip=False)
+    data = data_list[0]
+    model = get_model(mx.gpu(args.gpu) if args.gpu >= 0 else mx.cpu(), args.model, args.batch_size)
+    batch = np.zeros((args.batch_size, 3, 112, 112), dtype=np.float32)
+    embeddings = []
+    for start in range(0, data.shape[0], args.batch_size):
+        num = min(args.batch_size, data.shape[0] - start)
+        batch[:num] = data[start:start+num]
+        embeddings.append(model.run(batch)[0][:num].copy())
+    return np.vstack(embeddings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark IVF-PQ recall against exact search')
+    parser.add_argument('--embeddings', default='', help='n x d .npy embeddings')
+    parser.add_argument('--bin', default='', help='verification .bin to embed when there is no --embeddings')
+    parser.add_argument('--model', default='resnet100.onnx', help='ArcFace onnx model for --bin')
+    parser.add_argument('--gpu', type=int, default=-1, help='gpu id for --bin, -1 for cpu')
+    parser.add_argument('--batch-size', type=int, default=64, help='batch size for --bin')
+    parser.add_argument('--save-embeddings', default='', help='save the embeddings computed for --bin')
+    parser.add_argument('--path', default='/tmp/face_ivfpq_benchmark', help='index folder, it is replaced')
+    parser.add_argument('--queries', type=int, default=1000, help='held out query embeddings')
+    parser.add_argument('--nlist', type=int, default=0, help='inverted lists, 0 for 4 sqrt(n)')
+    parser.add_argument('--m', type=int, default=64, help='bytes per PQ code')
+    parser.add_argument('--train-size', type=int, default=100000, help='training sample size')
+    parser.add_argument('--nprobes', default='1,4,16,64', help='comma separated nprobe values')
+    parser.add_argument('--rerank', type=int, default=100, help='candidates re-ranked exactly, 0 to skip')
+    parser.add_argument('--k', type=int, default=10, help='matches per query')
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = np.load(args.embeddings).astype(np.float32)
+    else:
+        embeddings = compute_embeddings(args)
+        if args.save_embeddings:
+            np.save(args.save_embeddings, embeddings)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    gallery, queries = embeddings[:-args.queries], embeddings[-args.queries:]
+    labels = np.arange(gallery.shape[0])
+    nlist = args.nlist or int(4 * np.sqrt(gallery.shape[0]))
+    print('gallery %d  queries %d  dim %d  nlist %d  m %d' % (gallery.shape[0], queries.shape[0],
+                                                              gallery.shape[1], nlist, args.m))
+
+    exact = np.argsort(-np.dot(queries, gallery.T), axis=1, kind='stable')[:, :args.k]
+
+    shutil.rmtree(args.path, ignore_errors=True)
+    index = FaceIvfPq(args.path, dim=gallery.shape[1], nlist=nlist, m=args.m, keep_vectors=args.rerank > 0)
+    sample = gallery[np.random.RandomState(0).permutation(gallery.shape[0])[:args.train_size]]
+    tic = time.time()
+    index.train(sample)
+    print('trained on %d in %.1f s' % (sample.shape[0], time.time() - tic))
+    tic = time.time()
+    index.add(gallery, labels)
+    print('enrolled in %.1f s' % (time.time() - tic))
+
+    print('%7s %7s %12s %12s' % ('nprobe', 'rerank', 'recall@%d' % args.k, 'ms/query'))
+    for nprobe in [int(x) for x in args.nprobes.split(',')]:
+        for rerank in sorted(set([0, args.rerank])):
+            tic = time.time()
+            _, found = index.search(queries, args.k, nprobe, rerank)
+            latency = (time.time() - tic) / queries.shape[0]
+            recall = np.mean([np.intersect1d(a, b).size for a, b in zip(found, exact)]) / args.k
+            print('%7d %7d %12.4f %12.3f' % (nprobe, rerank, recall, latency * 1e3))
+
+
+if __name__ == '__main__':
+    main()
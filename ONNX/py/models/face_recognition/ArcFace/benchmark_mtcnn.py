@@ -0,0 +1,92 @@
+'''
+Latency benchmark for MtcnnDetector.
+
+Compares the per-scale first stage with the packed pyramid first stage,
+and reports the full detect_face latency for both. With --num-workers it
+also measures how the per-scale first stage scales over a thread or
+process pool of PNet replicas. The executor cache counters of every
+network are printed after the runs, to size --executor-cache-size.
+
+Run: python benchmark_mtcnn.py --model-folder mtcnn-model --image player1.jpg --height 1080
+     python benchmark_mtcnn.py --num-workers 1,2,4,8 --worker-type process --intra-op-threads 1
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+import cv2
+import mxnet as mx
+import numpy as np
+
+from mtcnn_detector import MtcnnDetector
+
+
+def load_image(path, height):
+    '''
+    Read the test image (or make a random one) and resize it to the given height
+    '''
+    if path:
+        img = cv2.imread(path)
+    else:
+        img = np.random.RandomState(0).randint(0, 255, (height, height * 16 // 9, 3)).astype(np.uint8)
+    scale = float(height) / img.shape[0]
+    return cv2.resize(img, (int(round(img.shape[1] * scale)), height))
+
+
+def timeit(func, repeat, warmup=2):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        tic = time.time()
+        func()
+        times.append(time.time() - tic)
+    return np.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark mtcnn detection latency')
+    parser.add_argument('--model-folder', default='mtcnn-model', help='folder with det1-det4 models')
+    parser.add_argument('--image', default='', help='test image, random noise if empty')
+    parser.add_argument('--height', type=int, default=1080, help='resize the test image to this height')
+    parser.add_argument('--minsize', type=int, default=20, help='minimal face size')
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs, the median is reported')
+    parser.add_argument('--num-workers', default='', help='comma separated worker counts for the scaling run')
+    parser.add_argument('--worker-type', default='process', choices=['thread', 'process'],
+                        help='first stage pool, thread is experimental')
+    parser.add_argument('--intra-op-threads', type=int, default=None, help='OpenMP threads per operator')
+    parser.add_argument('--executor-cache-size', type=int, default=32, help='bound executors per network, 0 disables')
+    args = parser.parse_args()
+
+    img = load_image(args.image, args.height)
+    print('image', img.shape)
+
+    for packed in [False, True]:
+        detector = MtcnnDetector(model_folder=args.model_folder, minsize=args.minsize,
+                                 packed_pyramid=packed, executor_cache_size=args.executor_cache_size,
+                                 ctx=mx.cpu())
+        first = timeit(lambda: detector.first_stage(img), args.repeat)
+        full = timeit(lambda: detector.detect_face(img), args.repeat)
+        ret = detector.detect_face(img)
+        num_face = 0 if ret is None else ret[0].shape[0]
+        print('packed_pyramid=%-5s first stage %8.2f ms  detect_face %8.2f ms  faces %d' %
+              (packed, first * 1e3, full * 1e3, num_face))
+        for name, stats in sorted(detector.cache_stats().items()):
+            print('    %-5s executor cache hits %6d misses %4d size %4d' %
+                  (name, stats['hits'], stats['misses'], stats['size']))
+
+    if args.num_workers:
+        base = None
+        for num_worker in [int(x) for x in args.num_workers.split(',')]:
+            with MtcnnDetector(model_folder=args.model_folder, minsize=args.minsize, num_worker=num_worker,
+                               worker_type=args.worker_type, intra_op_threads=args.intra_op_threads,
+                               executor_cache_size=args.executor_cache_size, ctx=mx.cpu()) as detector:
+                first = timeit(lambda: detector.first_stage(img), args.repeat)
+            base = base or first
+            print('%s workers=%-3d first stage %8.2f ms  speedup %.2fx' %
+                  (args.worker_type, num_worker, first * 1e3, base / first))
+
+
+if __name__ == '__main__':
+    main()
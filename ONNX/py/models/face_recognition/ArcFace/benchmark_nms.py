@@ -0,0 +1,111 @@
+'''
+Benchmark for the sort-once nms engine in helper.py against the original
+per-pick np.delete implementation it replaced.
+
+Run: python benchmark_nms.py --sizes 100,1000,5000,20000
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from helper import nms, batched_nms
+
+
+def legacy_nms(boxes, overlap_threshold, mode='Union'):
+    '''
+    The original helper.nms, kept here as the reference implementation
+    (with a stable sort so that ties are broken the same way)
+    '''
+    if len(boxes) == 0:
+        return []
+    if boxes.dtype.kind == "i":
+        boxes = boxes.astype("float")
+    pick = []
+    x1, y1, x2, y2, score = [boxes[:, i] for i in range(5)]
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    idxs = np.argsort(score, kind='stable')
+    while len(idxs) > 0:
+        last = len(idxs) - 1
+        i = idxs[last]
+        pick.append(i)
+        xx1 = np.maximum(x1[i], x1[idxs[:last]])
+        yy1 = np.maximum(y1[i], y1[idxs[:last]])
+        xx2 = np.minimum(x2[i], x2[idxs[:last]])
+        yy2 = np.minimum(y2[i], y2[idxs[:last]])
+        w = np.maximum(0, xx2 - xx1 + 1)
+        h = np.maximum(0, yy2 - yy1 + 1)
+        inter = w * h
+        if mode == 'Min':
+            overlap = inter / np.minimum(area[i], area[idxs[:last]])
+        else:
+            overlap = inter / (area[i] + area[idxs[:last]] - inter)
+        idxs = np.delete(idxs, np.concatenate(([last],
+                                               np.where(overlap > overlap_threshold)[0])))
+    return pick
+
+
+def random_boxes(num_box, image_size=1920, num_faces=None, seed=0):
+    '''
+    PNet-like candidates: jittered boxes clustered around a few faces of varying size
+    '''
+    rng = np.random.RandomState(seed)
+    if num_faces is None:
+        num_faces = max(1, num_box // 50)
+    side = rng.uniform(12, 240, size=num_faces)
+    cx = rng.uniform(0, image_size, size=num_faces)
+    cy = rng.uniform(0, image_size, size=num_faces)
+    face = rng.randint(0, num_faces, size=num_box)
+    s = side[face] * rng.uniform(0.7, 1.3, size=num_box)
+    x1 = np.round(cx[face] + rng.normal(0, 0.2, size=num_box) * s - s / 2)
+    y1 = np.round(cy[face] + rng.normal(0, 0.2, size=num_box) * s - s / 2)
+    boxes = np.vstack([x1, y1, x1 + np.round(s), y1 + np.round(s), rng.uniform(0.6, 1.0, size=num_box)]).T
+    return boxes.astype(np.float32)
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        tic = time.time()
+        func()
+        best = min(best, time.time() - tic)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark nms implementations')
+    parser.add_argument('--sizes', default='100,500,1000,2000,5000,10000,20000', help='comma separated box counts')
+    parser.add_argument('--threshold', type=float, default=0.5, help='overlap threshold')
+    parser.add_argument('--mode', default='Union', choices=['Union', 'Min'], help='overlap mode')
+    parser.add_argument('--groups', type=int, default=10, help='number of groups for batched_nms')
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat runs')
+    args = parser.parse_args()
+
+    print('%8s %12s %12s %12s %12s %8s' % ('boxes', 'legacy(ms)', 'nms(ms)', 'batched(ms)', 'loop(ms)', 'speedup'))
+    for num_box in [int(x) for x in args.sizes.split(',')]:
+        boxes = random_boxes(num_box)
+        groups = np.random.RandomState(1).randint(0, args.groups, size=num_box)
+
+        ref = legacy_nms(boxes, args.threshold, args.mode)
+        out = nms(boxes, args.threshold, args.mode)
+        assert np.array_equal(np.asarray(ref), out), 'nms differs from the reference'
+
+        group_ids = np.unique(groups)
+        loop = np.concatenate([np.flatnonzero(groups == g)[legacy_nms(boxes[groups == g], args.threshold, args.mode)]
+                               for g in group_ids])
+        assert np.array_equal(loop, batched_nms(boxes, groups, args.threshold, args.mode)), \
+            'batched_nms differs from the reference'
+
+        t_legacy = timeit(lambda: legacy_nms(boxes, args.threshold, args.mode), args.repeat)
+        t_nms = timeit(lambda: nms(boxes, args.threshold, args.mode), args.repeat)
+        t_batched = timeit(lambda: batched_nms(boxes, groups, args.threshold, args.mode), args.repeat)
+        t_loop = timeit(lambda: [legacy_nms(boxes[groups == g], args.threshold, args.mode) for g in group_ids],
+                        args.repeat)
+        print('%8d %12.2f %12.2f %12.2f %12.2f %7.1fx' % (num_box, t_legacy * 1e3, t_nms * 1e3,
+                                                           t_batched * 1e3, t_loop * 1e3, t_legacy / t_nms))
+
+
+if __name__ == '__main__':
+    main()
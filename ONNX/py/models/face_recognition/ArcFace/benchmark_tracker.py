@@ -0,0 +1,79 @@
+'''
+Latency benchmark for MtcnnTracker.
+
+Runs the tracker over a video (or a slowly panning crop of a still image)
+for every keyframe interval and reports the keyframe and tracked frame
+latency and the latency saved against detect_face on every frame.
+
+Run: python benchmark_tracker.py --model-folder mtcnn-model --video camera.mp4 --intervals 1,5,10,30
+'''
+from __future__ import print_function
+
+import argparse
+
+import cv2
+import mxnet as mx
+import numpy as np
+
+from mtcnn_detector import MtcnnDetector
+from mtcnn_tracker import MtcnnTracker
+
+
+def load_frames(args):
+    '''
+    Decode the first frames of the video, or pan a crop over the image
+    '''
+    frames = []
+    if args.video:
+        cap = cv2.VideoCapture(args.video)
+        while len(frames) < args.frames:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            frames.append(frame)
+        cap.release()
+        return frames
+    if args.image:
+        img = cv2.imread(args.image)
+    else:
+        img = np.random.RandomState(0).randint(0, 255, (720, 1280, 3)).astype(np.uint8)
+    h, w = img.shape[:2]
+    ch, cw = h * 3 // 4, w * 3 // 4
+    for i in range(args.frames):
+        t = 0.5 + 0.5 * np.sin(2 * np.pi * i / args.frames)
+        x, y = int(t * (w - cw)), int(t * (h - ch))
+        frames.append(np.ascontiguousarray(img[y:y+ch, x:x+cw]))
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark mtcnn video tracking latency')
+    parser.add_argument('--model-folder', default='mtcnn-model', help='folder with det1-det4 models')
+    parser.add_argument('--video', default='', help='test video')
+    parser.add_argument('--image', default='', help='still image to pan over when there is no video')
+    parser.add_argument('--frames', type=int, default=200, help='number of frames')
+    parser.add_argument('--intervals', default='1,5,10,30', help='comma separated keyframe intervals')
+    parser.add_argument('--min-confidence', type=float, default=0.9, help='fallback below this ONet score')
+    parser.add_argument('--expand', type=float, default=0.25, help='growth of the tracked boxes')
+    args = parser.parse_args()
+
+    frames = load_frames(args)
+    print('frames', len(frames), frames[0].shape)
+    detector = MtcnnDetector(model_folder=args.model_folder, ctx=mx.cpu())
+
+    print('%9s %10s %10s %14s %14s %12s' % ('interval', 'keyframes', 'fallbacks', 'keyframe(ms)',
+                                              'tracked(ms)', 'saved/frame'))
+    for interval in [int(x) for x in args.intervals.split(',')]:
+        tracker = MtcnnTracker(detector, keyframe_interval=interval, min_confidence=args.min_confidence,
+                               expand=args.expand)
+        for frame in frames:
+            tracker.track(frame)
+        stats = tracker.stats()
+        print('%9d %10d %10d %14.2f %14.2f %10.2fms' % (interval, stats['keyframes'], stats['fallbacks'],
+                                                       stats['keyframe_latency'] * 1e3,
+                                                       stats['tracked_latency'] * 1e3,
+                                                       stats['saved'] * 1e3 / stats['frames']))
+
+
+if __name__ == '__main__':
+    main()
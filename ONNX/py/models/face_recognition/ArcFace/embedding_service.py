@@ -0,0 +1,233 @@
+# coding: utf-8
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# onnx_cache and onnx_backend are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from onnx_backend import create_backend
+
+
+def get_model(ctx, model, batch_size, image_size=(112, 112), backend='mxnet', **options):
+    """
+        load the ArcFace ONNX model for batches of batch_size faces
+    Parameters:
+    ----------
+        ctx: mx.context
+            device to run on, with the mxnet backend
+        model: string
+            path of the onnx model
+        batch_size: int number
+            batch size the module is bound at
+        backend: string
+            'mxnet' or 'onnxruntime', options go to onnx_backend.create_backend
+    Returns:
+    -------
+        onnx_backend.MxnetBackend or OrtBackend
+    """
+    return create_backend(backend, model, (batch_size, 3, image_size[0], image_size[1]), ctx, **options)
+
+
+class EmbeddingService(object):
+    """
+        In-process micro-batching around an embedding model
+
+        Callers submit aligned faces from any number of threads (or asyncio
+        tasks). A single worker thread takes them off a queue and forms batches
+        of up to batch_size faces, waiting at most max_wait for a batch to fill
+        up after its first face arrived. Every batch runs through the model bound
+        at batch_size, partial batches are padded with zeros, and every caller gets the
+        L2 normalized embedding of its face through a future.
+    """
+    def __init__(self,
+                 model,
+                 batch_size = 32,
+                 max_wait = 0.005,
+                 image_size = (112, 112),
+                 latency_window = 10000):
+        """
+            Initialize the service and start its worker thread
+
+            Parameters:
+            ----------
+                model : onnx_backend.MxnetBackend or OrtBackend
+                    embedding model for batches of batch_size, see get_model
+                batch_size : int number
+                    largest batch, the batch size the model is bound at
+                max_wait : float number
+                    seconds a batch waits for more faces after its first one
+                image_size : tuple
+                    height and width of the aligned faces
+                latency_window : int number
+                    number of latest requests the latency percentiles are computed over
+
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.input_buf = np.zeros((batch_size, 3, image_size[0], image_size[1]), dtype=np.float32)
+
+        self.queue = queue.Queue()
+        # submit and close: no face is queued after the stop sentinel
+        self.submit_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.batch_histogram = Counter()
+        self.latencies = deque(maxlen=latency_window)
+        self.num_request = 0
+
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def close(self):
+        """
+            stop the worker thread once the queued faces are done
+        """
+        with self.submit_lock:
+            worker, self.worker = self.worker, None
+            if worker is None:
+                return
+            self.queue.put(None)
+        worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, aligned):
+        """
+            queue one face
+        Parameters:
+        ----------
+            aligned: numpy array, 3 x h x w
+                aligned rgb face, e.g. from get_input or face_preprocess.preprocess_batch
+        Returns:
+        -------
+            concurrent.futures.Future of the embedding
+        """
+        future = Future()
+        with self.submit_lock:
+            if self.worker is None:
+                raise RuntimeError('the embedding service is closed')
+            self.queue.put((aligned, future, time.time()))
+        return future
+
+    def embed(self, aligned):
+        """
+            embedding of one face, blocks until its batch has run
+        """
+        return self.submit(aligned).result()
+
+    def embed_batch(self, faces):
+        """
+            embeddings of several faces, n x d
+        """
+        futures = [self.submit(aligned) for aligned in faces]
+        return np.vstack([future.result() for future in futures])
+
+    async def embed_async(self, aligned):
+        """
+            asyncio front end of embed
+        """
+        import asyncio
+        return await asyncio.wrap_future(self.submit(aligned))
+
+    def forward(self, num):
+        """
+            run the model over the first num faces of the input buffer
+        Returns:
+        -------
+            numpy array, num x d
+                L2 normalized embeddings
+        """
+        embedding = self.model.run(self.input_buf)[0][:num]
+        # an all zero embedding stays zero instead of turning into NaN
+        return embedding / np.maximum(np.linalg.norm(embedding, axis=1, keepdims=True), 1e-12)
+
+    def next_batch(self):
+        """
+            block for the first face, then collect more until the batch is full or max_wait is over
+        Returns:
+        -------
+            list of (aligned, future, submit time), None to stop
+            faces whose future was cancelled while queued (e.g. by an asyncio timeout) are dropped
+        """
+        item = self.queue.get()
+        while item is not None and not item[1].set_running_or_notify_cancel():
+            item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch
+                self.queue.put(None)
+                break
+            if item[1].set_running_or_notify_cancel():
+                batch.append(item)
+        return batch
+
+    def run(self):
+        """
+            worker thread loop
+        """
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            num = len(batch)
+            try:
+                for i, (aligned, _, _) in enumerate(batch):
+                    self.input_buf[i] = aligned
+                # the rows of the previous batch would otherwise run again
+                self.input_buf[num:] = 0
+                embedding = self.forward(num)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            done = time.time()
+            with self.lock:
+                self.batch_histogram[num] += 1
+                self.num_request += num
+                self.latencies.extend(done - submitted for _, _, submitted in batch)
+            for i, (_, future, _) in enumerate(batch):
+                future.set_result(embedding[i])
+
+    def stats(self):
+        """
+            queue depth, batch size histogram and latency percentiles
+        Returns:
+        -------
+            dict with the current queue depth, the number of requests and batches,
+            the {batch size: count} histogram and the p50 and p99 latency in seconds
+            over the latest requests
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            histogram = dict(self.batch_histogram)
+            num_request = self.num_request
+        p50, p99 = np.percentile(latencies, [50, 99]) if latencies.size > 0 else (0.0, 0.0)
+        return {'queue_depth': self.queue.qsize(),
+                'requests': num_request,
+                'batches': sum(histogram.values()),
+                'batch_size_histogram': histogram,
+                'p50': float(p50),
+                'p99': float(p99)}
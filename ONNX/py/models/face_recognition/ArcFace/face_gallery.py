@@ -0,0 +1,274 @@
+# coding: utf-8
+import json
+import os
+
+import numpy as np
+
+
+class FaceGallery(object):
+    """
+        1:N identification over a gallery of enrolled face embeddings
+
+        The L2 normalized embeddings are kept in an append-only memory mapped
+        matrix, as float16 or as int8 (scaled by 127), next to their labels and
+        tombstones. A search runs blocked matrix multiplies over the gallery and
+        keeps the top k scores (cosine similarity) with argpartition. Up to
+        cache_bytes of the blocks converted to float32 are kept between
+        searches, rows only change on compact().
+
+        add() and remove() change the memory maps only, flush() (or leaving the
+        with block) makes them persistent.
+
+        Files in the gallery folder:
+            meta.json        dim, dtype, number of rows and generation
+            embeddings.bin   rows x dim, row major
+            labels.bin       int64 label of every row
+            deleted.bin      uint8 tombstone of every row
+        compact() writes the rows into the files of the next generation
+        (embeddings-1.bin, ...) and switches to them with meta.json.
+    """
+    def __init__(self,
+                 path,
+                 dim = 512,
+                 dtype = 'float16',
+                 block_size = 16384,
+                 cache_bytes = 0):
+        """
+            Open the gallery in path, create it if it does not exist
+
+            Parameters:
+            ----------
+                path : string
+                    gallery folder
+                dim : int number
+                    embedding length, only used when creating the gallery
+                dtype : string
+                    'float16' or 'int8', only used when creating the gallery
+                block_size : int number
+                    gallery rows multiplied at once by search
+                cache_bytes : int number
+                    memory for float32 blocks kept between searches, 4 x dim bytes per row, 0 converts
+                    every block on every search. The first blocks that fit stay cached: a search
+                    scans all the blocks in order, an LRU would evict every block before its next use
+
+        """
+        self.path = path
+        self.block_size = block_size
+        self.cache_bytes = cache_bytes
+        self.cache = {}
+        self.cached_bytes = 0
+        self.generation = 0
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.dim, self.dtype, self.size = meta['dim'], np.dtype(meta['dtype']), meta['size']
+            self.generation = meta.get('generation', 0)
+        else:
+            assert dtype in ('float16', 'int8')
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.dim, self.dtype, self.size = dim, np.dtype(dtype), 0
+        # int8 rows hold round(x * 127)
+        self.scale = 1.0 / 127 if self.dtype == np.int8 else 1.0
+        self.open(max(self.size, 1024))
+        self.write_meta()
+
+    def file(self, name, generation=None):
+        """
+            path of a gallery file, of the current generation by default
+        """
+        generation = self.generation if generation is None else generation
+        if generation > 0 and name.endswith('.bin'):
+            name = '%s-%d.bin' % (name[:-4], generation)
+        return os.path.join(self.path, name)
+
+    def open(self, capacity):
+        """
+            memory map the files with room for capacity rows, growing them if needed
+        """
+        self.capacity = capacity
+        self.embeddings = self.map('embeddings.bin', self.dtype, (capacity, self.dim))
+        self.labels = self.map('labels.bin', np.int64, (capacity,))
+        self.deleted = self.map('deleted.bin', np.uint8, (capacity,))
+
+    def map(self, name, dtype, shape):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(self.file(name), 'ab') as f:
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+        return np.memmap(self.file(name), dtype=dtype, mode='r+', shape=shape)
+
+    def write_meta(self):
+        """
+            commit the number of rows, rows past it are ignored when the gallery is opened again
+        """
+        tmp = self.file('meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': self.dtype.name, 'size': self.size,
+                       'generation': self.generation}, f)
+        os.replace(tmp, self.file('meta.json'))
+
+    def flush(self):
+        """
+            write the memory maps to disk and commit the number of rows
+        """
+        self.embeddings.flush()
+        self.labels.flush()
+        self.deleted.flush()
+        self.write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def __len__(self):
+        """
+            number of enrolled faces, without the deleted ones
+        """
+        return self.size - int(np.count_nonzero(self.deleted[:self.size]))
+
+    def quantize(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        # an all zero embedding stays zero instead of turning into NaN
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        if self.dtype == np.int8:
+            return np.round(embeddings * 127).astype(np.int8)
+        return embeddings.astype(self.dtype)
+
+    def add(self, embeddings, labels):
+        """
+            enroll faces
+        Parameters:
+        ----------
+            embeddings: numpy array, n x dim
+                embeddings, normalized here
+            labels: numpy array, n
+                int label (identity) of every face
+        Returns:
+        -------
+            rows of the new faces
+        """
+        rows = self.quantize(embeddings)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        assert rows.shape[0] == labels.shape[0]
+        start, end = self.size, self.size + rows.shape[0]
+        if end > self.capacity:
+            capacity = self.capacity
+            while capacity < end:
+                capacity *= 2
+            self.open(capacity)
+        self.embeddings[start:end] = rows
+        self.labels[start:end] = labels
+        self.deleted[start:end] = 0
+        self.size = end
+        return np.arange(start, end)
+
+    def remove(self, labels):
+        """
+            delete all the faces of the labels, their rows stay until compact()
+        Returns:
+        -------
+            number of faces deleted
+        """
+        rows = np.flatnonzero(np.isin(self.labels[:self.size], labels) & (self.deleted[:self.size] == 0))
+        self.deleted[rows] = 1
+        return rows.size
+
+    def compact(self):
+        """
+            rewrite the gallery without the deleted rows
+
+            The rows are written to the files of the next generation, which replace the current
+            ones when meta.json is written: a crash before that leaves the gallery as it was.
+        """
+        keep = np.flatnonzero(self.deleted[:self.size] == 0)
+        size = keep.size
+        capacity = max(1024, size)
+        generation = self.generation + 1
+        for name, rows in [('embeddings.bin', self.embeddings), ('labels.bin', self.labels),
+                           ('deleted.bin', self.deleted)]:
+            out = np.memmap(self.file(name, generation), dtype=rows.dtype, mode='w+',
+                            shape=(capacity,) + rows.shape[1:])
+            for start in range(0, size, self.block_size):
+                end = min(start + self.block_size, size)
+                out[start:end] = rows[keep[start:end]]
+            out.flush()
+            del out
+        self.embeddings = self.labels = self.deleted = None
+        previous, self.generation, self.size = self.generation, generation, size
+        self.write_meta()
+        for name in ['embeddings.bin', 'labels.bin', 'deleted.bin']:
+            os.remove(self.file(name, previous))
+        self.cache.clear()
+        self.cached_bytes = 0
+        self.open(capacity)
+
+    def block(self, start, end, block_buf):
+        """
+            gallery rows start to end as float32, from the cache if it has them
+        """
+        block = self.cache.get(start)
+        if block is not None:
+            if block.shape[0] == end - start:
+                return block
+            # the last block grows as faces are added
+            del self.cache[start]
+            self.cached_bytes -= block.nbytes
+        if self.cached_bytes + (end - start) * self.dim * 4 > self.cache_bytes:
+            block = block_buf[:end - start]
+            block[...] = self.embeddings[start:end]
+            return block
+        block = self.cache[start] = np.asarray(self.embeddings[start:end], dtype=np.float32)
+        self.cached_bytes += block.nbytes
+        return block
+
+    def search(self, queries, k=5):
+        """
+            top k gallery faces of every query
+        Parameters:
+        ----------
+            queries: numpy array, q x dim
+                query embeddings, normalized here
+            k: int number
+                number of matches
+        Returns:
+        -------
+            scores: numpy array, q x k
+                cosine similarity of the matches, in decreasing order, -inf past the gallery size
+            labels: numpy array, q x k
+                labels of the matches, -1 past the gallery size
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12) * self.scale
+        num_query = queries.shape[0]
+        best_scores = np.full((num_query, k), -np.inf, dtype=np.float32)
+        best_rows = np.full((num_query, k), -1, dtype=np.int64)
+        query_index = np.arange(num_query)[:, None]
+        # float16 / int8 rows are converted block by block, numpy has no gemm for them
+        block_buf = np.empty((min(self.block_size, self.size), self.dim), dtype=np.float32)
+
+        for start in range(0, self.size, self.block_size):
+            end = min(start + self.block_size, self.size)
+            scores = np.dot(queries, self.block(start, end, block_buf).T)
+            deleted = np.flatnonzero(self.deleted[start:end])
+            if deleted.size > 0:
+                scores[:, deleted] = -np.inf
+
+            # top k of the block, merged with the top k so far
+            if end - start > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(end - start), (num_query, end - start))
+            scores = np.hstack([best_scores, scores[query_index, top]])
+            rows = np.hstack([best_rows, top + start])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores, best_rows = scores[query_index, top], rows[query_index, top]
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores, best_rows = best_scores[query_index, order], best_rows[query_index, order]
+        valid = np.isfinite(best_scores) & (best_rows >= 0)
+        labels = np.where(valid, self.labels[np.maximum(best_rows, 0)], -1)
+        return best_scores, labels
@@ -0,0 +1,313 @@
+# coding: utf-8
+import json
+import os
+
+import numpy as np
+
+
+def nearest_centroids(x, centroids, chunk = 65536):
+    """
+        index of the nearest centroid (L2) of every row of x
+    """
+    norms = (centroids ** 2).sum(axis=1)
+    assign = np.empty(x.shape[0], dtype=np.int64)
+    for start in range(0, x.shape[0], chunk):
+        # ||x||^2 is the same for every centroid
+        dist = norms - 2 * np.dot(x[start:start+chunk], centroids.T)
+        assign[start:start+chunk] = np.argmin(dist, axis=1)
+    return assign
+
+
+def kmeans(x, k, niter = 20, seed = 0):
+    """
+        Lloyd's k-means
+    Parameters:
+    ----------
+        x: numpy array, n x d
+            float32 training vectors, n >= k
+        k: int number
+            number of centroids
+        niter: int number
+            number of iterations
+        seed: int number
+            seed of the initial centroids, picked among x
+    Returns:
+    -------
+        centroids: numpy array, k x d
+    """
+    assert x.shape[0] >= k, 'need at least %d training vectors, got %d' % (k, x.shape[0])
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(x.shape[0], k, replace=False)].astype(np.float32)
+    for _ in range(niter):
+        assign = nearest_centroids(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        used = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[used]
+        centroids[used] = np.add.reduceat(x[order], starts, axis=0) / counts[used, None]
+        # empty clusters restart from random training vectors
+        empty = np.flatnonzero(counts == 0)
+        if empty.size > 0:
+            centroids[empty] = x[rng.choice(x.shape[0], empty.size, replace=False)]
+    return centroids
+
+
+class FaceIvfPq(object):
+    """
+        Approximate 1:N identification with an inverted file and product quantization
+
+        The coarse quantizer (k-means, nlist centroids) splits the gallery into
+        inverted lists. Every face is stored as the PQ code of its residual to
+        its coarse centroid: m uint8 indices into 256 centroid codebooks of
+        dim / m dimensions, 64 bytes per face with the default m. A search
+        probes the nprobe lists nearest to the query and scores their codes
+        with a per query lookup table. With keep_vectors the float16 embeddings
+        are stored too and the best candidates can be re-ranked exactly.
+
+        Files in the index folder:
+            meta.json       dim, nlist, m, keep_vectors and number of rows
+            centroids.npy   nlist x dim coarse centroids
+            codebooks.npy   m x 256 x dim / m PQ codebooks
+            codes.bin       rows x m uint8 PQ codes
+            lists.bin       int32 inverted list of every row
+            labels.bin      int64 label of every row
+            vectors.bin     rows x dim float16 embeddings, with keep_vectors only
+    """
+    def __init__(self,
+                 path,
+                 dim = 512,
+                 nlist = 1024,
+                 m = 64,
+                 keep_vectors = False):
+        """
+            Open the index in path, create it if it does not exist
+
+            Parameters:
+            ----------
+                path : string
+                    index folder
+                dim : int number
+                    embedding length, only used when creating the index
+                nlist : int number
+                    number of inverted lists, only used when creating the index
+                m : int number
+                    bytes per PQ code, a divisor of dim, only used when creating the index
+                keep_vectors : bool
+                    also store the float16 embeddings for re-ranking, only used when creating the index
+
+        """
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.dim, self.nlist, self.m = meta['dim'], meta['nlist'], meta['m']
+            self.keep_vectors, self.size = meta['keep_vectors'], meta['size']
+        else:
+            assert dim % m == 0, 'm has to divide dim'
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.dim, self.nlist, self.m, self.keep_vectors, self.size = dim, nlist, m, keep_vectors, 0
+        self.dsub = self.dim // self.m
+
+        self.centroids = self.codebooks = None
+        if os.path.exists(self.file('codebooks.npy')):
+            self.set_quantizers(np.load(self.file('centroids.npy')), np.load(self.file('codebooks.npy')))
+        self.open(max(self.size, 1024))
+        self.invlists = None
+        self.write_meta()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def open(self, capacity):
+        """
+            memory map the files with room for capacity rows, growing them if needed
+        """
+        self.capacity = capacity
+        self.codes = self.map('codes.bin', np.uint8, (capacity, self.m))
+        self.lists = self.map('lists.bin', np.int32, (capacity,))
+        self.labels = self.map('labels.bin', np.int64, (capacity,))
+        self.vectors = self.map('vectors.bin', np.float16, (capacity, self.dim)) if self.keep_vectors else None
+
+    def map(self, name, dtype, shape):
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(self.file(name), 'ab') as f:
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+        return np.memmap(self.file(name), dtype=dtype, mode='r+', shape=shape)
+
+    def write_meta(self):
+        """
+            commit the number of rows, rows past it are ignored when the index is opened again
+        """
+        tmp = self.file('meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'dim': self.dim, 'nlist': self.nlist, 'm': self.m,
+                       'keep_vectors': self.keep_vectors, 'size': self.size}, f)
+        os.replace(tmp, self.file('meta.json'))
+
+    def flush(self):
+        for rows in (self.codes, self.lists, self.labels, self.vectors):
+            if rows is not None:
+                rows.flush()
+        self.write_meta()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def trained(self):
+        return self.codebooks is not None
+
+    def set_quantizers(self, centroids, codebooks):
+        self.centroids = centroids.astype(np.float32)
+        self.codebooks = codebooks.astype(np.float32)
+        self.centroid_norms = (self.centroids ** 2).sum(axis=1)
+        self.codebook_norms = (self.codebooks ** 2).sum(axis=2)
+
+    def normalize(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def train(self, sample, niter = 20, seed = 0):
+        """
+            learn the coarse centroids and the PQ codebooks
+        Parameters:
+        ----------
+            sample: numpy array, n x dim
+                training embeddings, at least max(nlist, 256), normalized here
+        """
+        sample = self.normalize(sample)
+        centroids = kmeans(sample, self.nlist, niter, seed)
+        residuals = sample - centroids[nearest_centroids(sample, centroids)]
+        codebooks = np.stack([kmeans(np.ascontiguousarray(residuals[:, j*self.dsub:(j+1)*self.dsub]), 256, niter, seed)
+                              for j in range(self.m)])
+        np.save(self.file('centroids.npy'), centroids)
+        np.save(self.file('codebooks.npy'), codebooks)
+        self.set_quantizers(centroids, codebooks)
+
+    def encode(self, embeddings):
+        """
+            inverted lists and PQ codes of normalized embeddings
+        """
+        lists = nearest_centroids(embeddings, self.centroids)
+        residuals = embeddings - self.centroids[lists]
+        codes = np.empty((embeddings.shape[0], self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = nearest_centroids(residuals[:, j*self.dsub:(j+1)*self.dsub], self.codebooks[j])
+        return lists, codes
+
+    def add(self, embeddings, labels):
+        """
+            enroll faces, the index has to be trained
+        Parameters:
+        ----------
+            embeddings: numpy array, n x dim
+                embeddings, normalized here
+            labels: numpy array, n
+                int label (identity) of every face
+        Returns:
+        -------
+            rows of the new faces
+        """
+        assert self.trained, 'train the index before adding faces'
+        embeddings = self.normalize(embeddings)
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        assert embeddings.shape[0] == labels.shape[0]
+        lists, codes = self.encode(embeddings)
+        # the faces of a list are written next to each other, probing it reads a few contiguous runs
+        order = np.argsort(lists, kind='stable')
+        start, end = self.size, self.size + embeddings.shape[0]
+        if end > self.capacity:
+            self.flush()
+            capacity = self.capacity
+            while capacity < end:
+                capacity *= 2
+            self.open(capacity)
+        self.codes[start:end] = codes[order]
+        self.lists[start:end] = lists[order]
+        self.labels[start:end] = labels[order]
+        if self.keep_vectors:
+            self.vectors[start:end] = embeddings[order]
+        self.size = end
+        self.invlists = None
+        self.flush()
+        rows = np.empty(order.size, dtype=np.int64)
+        rows[order] = np.arange(start, end)
+        return rows
+
+    def build_invlists(self):
+        """
+            rows of every inverted list, sorted by list: rows[offsets[c]:offsets[c+1]] are in list c
+        """
+        lists = np.asarray(self.lists[:self.size])
+        rows = np.argsort(lists, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.nlist))])
+        self.invlists = (rows, offsets)
+
+    def search(self, queries, k = 5, nprobe = 16, rerank = 0):
+        """
+            approximate top k gallery faces of every query
+        Parameters:
+        ----------
+            queries: numpy array, q x dim
+                query embeddings, normalized here
+            k: int number
+                number of matches
+            nprobe: int number
+                number of inverted lists scanned per query
+            rerank: int number
+                re-rank this many best PQ candidates with the exact embeddings, 0 to skip,
+                the index has to keep its vectors
+        Returns:
+        -------
+            scores: numpy array, q x k
+                cosine similarity of the matches, estimated from the codes without rerank,
+                in decreasing order, -inf past the candidates
+            labels: numpy array, q x k
+                labels of the matches, -1 past the candidates
+        """
+        assert self.trained, 'train the index before searching it'
+        assert rerank == 0 or self.keep_vectors, 're-ranking needs an index created with keep_vectors'
+        if self.invlists is None:
+            self.build_invlists()
+        inv_rows, offsets = self.invlists
+        queries = self.normalize(queries)
+        nprobe = min(nprobe, self.nlist)
+        num_candidate = max(k, rerank)
+
+        # ||q - c||^2 for every coarse centroid
+        coarse = (queries ** 2).sum(axis=1, keepdims=True) + self.centroid_norms - 2 * np.dot(queries, self.centroids.T)
+        probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+        subspace = np.arange(self.m) * 256
+
+        scores = np.full((queries.shape[0], k), -np.inf, dtype=np.float32)
+        labels = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        for i, query in enumerate(queries):
+            lists = probes[i]
+            runs = [inv_rows[offsets[c]:offsets[c+1]] for c in lists]
+            rows = np.concatenate(runs)
+            if rows.size == 0:
+                continue
+            probe = np.repeat(np.arange(nprobe), [run.size for run in runs])
+
+            # ||r - y||^2 = ||q - c||^2 + sum over subspaces of (||y_j||^2 - 2 r_j . y_j), r = q - c
+            residuals = (query - self.centroids[lists]).reshape(nprobe, self.m, self.dsub)
+            tables = self.codebook_norms - 2 * np.einsum('pmd,mkd->pmk', residuals, self.codebooks)
+            codes = self.codes[rows].astype(np.int64) + subspace
+            dist = tables.reshape(nprobe, -1)[probe[:, None], codes].sum(axis=1) + coarse[i, lists][probe]
+
+            if rows.size > num_candidate:
+                top = np.argpartition(dist, num_candidate - 1)[:num_candidate]
+                rows, dist = rows[top], dist[top]
+            if rerank > 0:
+                # unit vectors: cosine similarity is the dot product
+                sim = np.dot(np.asarray(self.vectors[rows], dtype=np.float32), query)
+            else:
+                # unit vectors: ||a - b||^2 = 2 - 2 cos
+                sim = 1 - dist / 2
+            top = np.argsort(-sim, kind='stable')[:k]
+            scores[i, :top.size] = sim[top]
+            labels[i, :top.size] = self.labels[rows[top]]
+        return scores, labels
@@ -1,7 +1,15 @@
 
 import cv2
 import numpy as np
-from skimage import transform as trans
+from helper import umeyama_batch, warp_faces
+
+# landmarks of the aligned 112x96 face, x shifted by 8 for 112x112
+ARCFACE_SRC = np.array([
+  [30.2946, 51.6963],
+  [65.5318, 51.5014],
+  [48.0252, 71.7366],
+  [33.5493, 92.3655],
+  [62.7299, 92.2041] ], dtype=np.float32 )
 
 def parse_lst_line(line):
   '''
@@ -44,6 +52,26 @@ def read_image(img_path, **kwargs):
       img = np.transpose(img, (2,0,1))
   return img
 
+def alignment_transforms(landmarks, image_size=(112,112)):
+  '''
+  Similarity transforms from the 5 landmarks of n faces to the aligned face
+  '''
+  src = ARCFACE_SRC.copy()
+  if image_size[1]==112:
+    src[:,0] += 8.0
+  return umeyama_batch(landmarks, src)
+
+def preprocess_batch(img, landmarks, image_size=(112,112), out=None, pool=None, rgb=False):
+  '''
+  Align n faces at once - returns an n x 3 x h x w uint8 batch ready for the network
+  img is the image of all the faces or a list with the image of every face,
+  landmarks is n x 5 x 2, pool an optional ThreadPool for the warps
+  '''
+  M = alignment_transforms(landmarks, image_size)
+  if out is None:
+    out = np.empty((len(landmarks), 3, image_size[0], image_size[1]), dtype=np.uint8)
+  return warp_faces(img, M, out, pool=pool, rgb=rgb)
+
 def preprocess(img, bbox=None, landmark=None, **kwargs):
   '''
   Preprocess input image - returns aligned face images
@@ -64,19 +92,7 @@ def preprocess(img, bbox=None, landmark=None, **kwargs):
   # Do alignment using landmnark points
   if landmark is not None:
     assert len(image_size)==2
-    src = np.array([
-      [30.2946, 51.6963],
-      [65.5318, 51.5014],
-      [48.0252, 71.7366],
-      [33.5493, 92.3655],
-      [62.7299, 92.2041] ], dtype=np.float32 )
-    if image_size[1]==112:
-      src[:,0] += 8.0
-    dst = landmark.astype(np.float32)
-
-    tform = trans.SimilarityTransform()
-    tform.estimate(dst, src)
-    M = tform.params[0:2,:]
+    M = alignment_transforms(landmark[None], image_size)[0]
 
   # If no landmark points available, do alignment using bounding box. If no bounding box available use center crop
   if M is None:
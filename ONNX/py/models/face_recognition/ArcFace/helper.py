@@ -5,6 +5,80 @@ import cv2
 import numpy as np
 
 
+def _greedy_nms(boxes, overlap_threshold, mode, groups=None):
+    """
+        greedy nms that sorts the boxes once
+
+        Candidates are visited by descending score. Each picked box only
+        compares itself against the boxes whose x1 lies in the range where an
+        overlap is possible, found with a binary search on a second ordering of
+        the boxes by x1. Suppression is recorded in a boolean mask, so the index
+        list is never re-sliced or reallocated per picked box.
+
+    Parameters:
+    ----------
+        boxes: numpy array n x 5
+            input bbox array
+        overlap_threshold: float number
+            threshold of overlap
+        mode: string
+            how to compute overlap ratio, 'Union' or 'Min'
+        groups: numpy array n or None
+            group id of each box, boxes only suppress boxes of their own group
+    Returns:
+    -------
+        index array of the selected bbox, by descending score
+    """
+    # sort once by descending score, ties keep the later box first
+    order = np.argsort(boxes[:, 4], kind='stable')[::-1]
+    x1, y1, x2, y2 = [boxes[order, i] for i in range(4)]
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    num_box = order.shape[0]
+
+    # sweep key: x1, with every group shifted to its own disjoint range
+    max_w = (x2 - x1).max()
+    key = x1
+    if groups is not None:
+        groups = groups[order]
+        span = x1.max() - x1.min() + max_w + 4
+        key = x1 + (groups - groups.min()) * span
+
+    # boxes ordered by key and the key range each box can overlap with
+    by_x = np.argsort(key, kind='stable')
+    sorted_key = key[by_x]
+    lower = np.searchsorted(sorted_key, key - max_w - 2, side='left')
+    upper = np.searchsorted(sorted_key, key + (x2 - x1) + 2, side='right')
+    rank = np.empty(num_box, dtype=np.intp)
+    rank[by_x] = np.arange(num_box)
+
+    top_left = np.vstack([x1[by_x], y1[by_x]])
+    bottom_right = np.vstack([x2[by_x], y2[by_x]])
+    sorted_area = area[by_x]
+    box_top_left = np.vstack([x1, y1]).T[:, :, None]
+    box_bottom_right = np.vstack([x2, y2]).T[:, :, None]
+
+    suppressed = np.zeros(num_box, dtype=bool)
+    pick = []
+    for i in range(num_box):
+        if suppressed[rank[i]]:
+            continue
+        pick.append(i)
+
+        lo, hi = lower[i], upper[i]
+        # compute the width and height of the intersections
+        wh = np.minimum(box_bottom_right[i], bottom_right[:, lo:hi]) - np.maximum(box_top_left[i], top_left[:, lo:hi]) + 1
+        np.maximum(wh, 0, out=wh)
+
+        inter = wh[0] * wh[1]
+        if mode == 'Min':
+            overlap = inter / np.minimum(area[i], sorted_area[lo:hi])
+        else:
+            overlap = inter / (area[i] + sorted_area[lo:hi] - inter)
+        suppressed[lo:hi] |= overlap > overlap_threshold
+
+    return order[pick]
+
+
 def nms(boxes, overlap_threshold, mode='Union'):
     """
         non max suppression
@@ -29,42 +103,38 @@ def nms(boxes, overlap_threshold, mode='Union'):
     if boxes.dtype.kind == "i":
         boxes = boxes.astype("float")
 
-    # initialize the list of picked indexes
-    pick = []
-
-    # grab the coordinates of the bounding boxes
-    x1, y1, x2, y2, score = [boxes[:, i] for i in range(5)]
-
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = np.argsort(score)
-
-    # keep looping while some indexes still remain in the indexes list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
-        pick.append(i)
+    return _greedy_nms(boxes, overlap_threshold, mode)
 
-        xx1 = np.maximum(x1[i], x1[idxs[:last]])
-        yy1 = np.maximum(y1[i], y1[idxs[:last]])
-        xx2 = np.minimum(x2[i], x2[idxs[:last]])
-        yy2 = np.minimum(y2[i], y2[idxs[:last]])
 
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
+def batched_nms(boxes, groups, overlap_threshold, mode='Union'):
+    """
+        non max suppression run independently for every group in one call,
+        e.g. per pyramid scale or per image
 
-        inter = w * h
-        if mode == 'Min':
-            overlap = inter / np.minimum(area[i], area[idxs[:last]])
-        else:
-            overlap = inter / (area[i] + area[idxs[:last]] - inter)
+    Parameters:
+    ----------
+        boxes: numpy array n x 5
+            input bbox array
+        groups: numpy array n
+            integer group id of each box
+        overlap_threshold: float number
+            threshold of overlap
+        mode: float number
+            how to compute overlap ratio, 'Union' or 'Min'
+    Returns:
+    -------
+        index array of the selected bbox, ordered by group id and then by
+        descending score, i.e. the concatenation of nms() run on every group
+    """
+    if len(boxes) == 0:
+        return []
 
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs, np.concatenate(([last],
-                                               np.where(overlap > overlap_threshold)[0])))
+    if boxes.dtype.kind == "i":
+        boxes = boxes.astype("float")
+    groups = np.asarray(groups)
 
-    return pick
+    pick = _greedy_nms(boxes, overlap_threshold, mode, groups=groups)
+    return pick[np.argsort(groups[pick], kind='stable')]
 
 def adjust_input(in_data):
     """
@@ -89,6 +159,73 @@ def adjust_input(in_data):
     out_data = (out_data - 127.5)*0.0078125
     return out_data
 
+def crop_resize_batch(img, boxes, size, out, channel=0, dtype=np.uint8):
+    """
+        crop boxes out of img, resize them and write the normalized crops
+        into a preallocated network input buffer
+
+        Parts of a box outside the image read as 0, like the zero filled
+        temporary crops of the per box loop. Crops inside the image are resized
+        straight from views of it, the others (and the float conversion) go
+        through one scratch buffer shared by all the boxes. The float
+        conversion, transpose and normalization of adjust_input are done once
+        over all the boxes.
+
+    Parameters:
+    ----------
+        img: numpy array, bgr order of shape (h, w, 3)
+            input image
+        boxes: numpy array, n x 4 or more
+            integer valued x1, y1, x2, y2 (inclusive) of the crops
+        size: int number
+            side of the resized crops
+        out: numpy array, float32 of shape n x c x size x size
+            buffer to write, channels [channel, channel+3) are filled
+        channel: int number
+            first channel of out to write
+        dtype: numpy dtype
+            dtype the crops are resized in, np.uint8 or np.float32
+    Returns:
+    -------
+        out
+    """
+    num_box = boxes.shape[0]
+    if num_box == 0:
+        return out
+    height, width, _ = img.shape
+    x1 = boxes[:, 0].astype(np.int32)
+    y1 = boxes[:, 1].astype(np.int32)
+    w = (boxes[:, 2] - boxes[:, 0] + 1).astype(np.int32)
+    h = (boxes[:, 3] - boxes[:, 1] + 1).astype(np.int32)
+
+    # part of every box inside the image
+    ix1, iy1 = np.maximum(x1, 0), np.maximum(y1, 0)
+    ix2, iy2 = np.minimum(x1 + w, width), np.minimum(y1 + h, height)
+    inside = (ix1 == x1) & (iy1 == y1) & (ix2 == x1 + w) & (iy2 == y1 + h)
+    direct = inside if np.dtype(dtype) == img.dtype else np.zeros(num_box, dtype=bool)
+
+    staging = np.empty((num_box, size, size, 3), dtype=dtype)
+    scratch = None
+    if not direct.all():
+        scratch = np.empty((h.max(), w.max(), 3), dtype=dtype)
+    for i in range(num_box):
+        if direct[i]:
+            cv2.resize(img[y1[i]:y1[i]+h[i], x1[i]:x1[i]+w[i]], (size, size), dst=staging[i])
+            continue
+        crop = scratch[:h[i], :w[i]]
+        if not inside[i]:
+            crop.fill(0)
+        if ix2[i] > ix1[i] and iy2[i] > iy1[i]:
+            np.copyto(crop[iy1[i]-y1[i]:iy2[i]-y1[i], ix1[i]-x1[i]:ix2[i]-x1[i]],
+                      img[iy1[i]:iy2[i], ix1[i]:ix2[i]], casting='unsafe')
+        cv2.resize(crop, (size, size), dst=staging[i])
+
+    # same as adjust_input, for all the boxes at once
+    target = out[:, channel:channel+3]
+    np.subtract(staging.transpose((0, 3, 1, 2)), 127.5, out=target, casting='unsafe')
+    target *= 0.0078125
+    return out
+
 def generate_bbox(map, reg, scale, threshold):
      """
          generate bbox from feature map
@@ -129,7 +266,7 @@ def generate_bbox(map, reg, scale, threshold):
      return boundingbox.T
 
 
-def detect_first_stage(img, net, scale, threshold):
+def detect_first_stage(img, net, scale, threshold, nms_threshold=0.5):
     """
         run PNet for first stage
     
@@ -141,6 +278,8 @@ def detect_first_stage(img, net, scale, threshold):
             how much should the input image scale
         net: PNet
             worker
+        nms_threshold: float number or None
+            overlap threshold of the per scale nms, None leaves it to the caller
     Returns:
     -------
         total_boxes : bboxes
@@ -159,10 +298,228 @@ def detect_first_stage(img, net, scale, threshold):
     if boxes.size == 0:
         return None
 
+    if nms_threshold is None:
+        return boxes
+
     # nms
-    pick = nms(boxes[:,0:5], 0.5, mode='Union')
+    pick = nms(boxes[:,0:5], nms_threshold, mode='Union')
     boxes = boxes[pick]
     return boxes
 
 def detect_first_stage_warpper( args ):
     return detect_first_stage(*args)
+
+def detect_first_stage_scales(img, net, scales, threshold, nms_threshold=0.5):
+    """
+        run PNet for first stage over several scales with the same worker
+
+    Parameters:
+    ----------
+        img: numpy array, bgr order
+            input image
+        net: PNet
+            worker
+        scales: list of float number
+            how much should the input image scale
+        threshold: float number
+            detect threshold
+        nms_threshold: float number or None
+            overlap threshold of the per scale nms, None leaves it to the caller
+    Returns:
+    -------
+        total_boxes : list of bboxes (or None) for every scale
+    """
+    return [detect_first_stage(img, net, scale, threshold, nms_threshold) for scale in scales]
+
+def detect_first_stage_scales_warpper( args ):
+    return detect_first_stage_scales(*args)
+
+def build_pyramid(img, scales):
+    """
+        build the image pyramid by progressive downscaling, every level is
+        resized from the previous level instead of from the original image
+
+    Parameters:
+    ----------
+        img: numpy array, bgr order
+            input image
+        scales: list of float number
+            decreasing scales of the pyramid levels
+    Returns:
+    -------
+        levels: list of numpy array
+            resized images, level i has size ceil(height*scales[i]) x ceil(width*scales[i])
+    """
+    height, width, _ = img.shape
+    levels = []
+    prev = img
+    for scale in scales:
+        hs = int(math.ceil(height * scale))
+        ws = int(math.ceil(width * scale))
+        prev = cv2.resize(prev, (ws, hs))
+        levels.append(prev)
+    return levels
+
+
+def pnet_output_size(size):
+    """
+        size of the PNet output map for an input side of `size` pixels
+        (3x3 conv, 2x2/2 pool with ceil rounding, 3x3 conv, 3x3 conv)
+    """
+    return max(0, int(math.ceil((size - 4) / 2.0)) - 3)
+
+
+def pack_pyramid(levels, gap=2):
+    """
+        pack pyramid levels into one canvas with shelf packing
+
+        Every level starts at an even offset and is separated from its neighbours
+        by at least `gap` pixels, so PNet (12x12 receptive field, stride 2) sees
+        each level on its own cells of the canvas output map.
+
+    Parameters:
+    ----------
+        levels: list of numpy array
+            pyramid levels sorted by decreasing size
+        gap: int number
+            minimal empty border between two levels
+    Returns:
+    -------
+        canvas: numpy array
+            packed image, the free space is filled with mid gray (about 0 after adjust_input)
+        offsets: list of (x, y)
+            top left corner of every level in the canvas
+    """
+    def even(v):
+        return v + (v % 2)
+
+    canvas_w = even(levels[0].shape[1])
+    offsets = []
+    shelf_y, shelf_h, x = 0, 0, 0
+    for level in levels:
+        h, w = level.shape[:2]
+        if x > 0 and x + w > canvas_w:
+            # start a new shelf below the current one
+            shelf_y = even(shelf_y + shelf_h + gap)
+            shelf_h, x = 0, 0
+        offsets.append((x, shelf_y))
+        x = even(x + w + gap)
+        shelf_h = max(shelf_h, h)
+    canvas_h = even(shelf_y + shelf_h)
+
+    canvas = np.full((canvas_h, canvas_w, levels[0].shape[2]), 128, dtype=levels[0].dtype)
+    for level, (ox, oy) in zip(levels, offsets):
+        h, w = level.shape[:2]
+        canvas[oy:oy+h, ox:ox+w, :] = level
+    return canvas, offsets
+
+
+def detect_first_stage_packed(img, net, scales, threshold):
+    """
+        run PNet for first stage once over all the pyramid levels packed in one canvas
+
+    Parameters:
+    ----------
+        img: numpy array, bgr order
+            input image
+        net: PNet
+            worker
+        scales: list of float number
+            how much should the input image scale for every level
+        threshold: float number
+            detect threshold
+    Returns:
+    -------
+        total_boxes : list of bboxes (or None) for every scale, before nms
+    """
+    levels = build_pyramid(img, scales)
+    canvas, offsets = pack_pyramid(levels)
+
+    output = net.predict(adjust_input(canvas))
+    score_map = output[1][0, 1, :, :]
+    reg_map = output[0]
+
+    total_boxes = []
+    for level, (ox, oy), scale in zip(levels, offsets, scales):
+        # the cells of this level in the canvas output map
+        h, w = level.shape[:2]
+        cy, cx = oy // 2, ox // 2
+        ch, cw = pnet_output_size(h), pnet_output_size(w)
+        boxes = generate_bbox(score_map[cy:cy+ch, cx:cx+cw], reg_map[:, :, cy:cy+ch, cx:cx+cw], scale, threshold)
+        total_boxes.append(boxes if boxes.size > 0 else None)
+    return total_boxes
+
+
+def umeyama_batch(src, dst):
+    """
+        least squares similarity transforms (Umeyama) from every point set to the target,
+        in closed form: in 2d the rotation and scale are the complex number
+        a = sum(conj(s) * d) / sum(|s|^2) of the centered points
+
+    Parameters:
+    ----------
+        src: numpy array, n x k x 2
+            point sets, e.g. the 5 landmarks of n faces
+        dst: numpy array, k x 2 or n x k x 2
+            target points, e.g. the landmarks of the aligned face
+    Returns:
+    -------
+        M: numpy array, n x 2 x 3
+            affine matrices mapping every src onto dst, for cv2.warpAffine
+    """
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.broadcast_to(np.asarray(dst, dtype=np.float64), src.shape)
+    src_mean = src.mean(axis=1)
+    dst_mean = dst.mean(axis=1)
+    src_demean = src - src_mean[:, None, :]
+    dst_demean = dst - dst_mean[:, None, :]
+
+    var = (src_demean ** 2).sum(axis=(1, 2))
+    a = (src_demean * dst_demean).sum(axis=(1, 2)) / var
+    b = (src_demean[:, :, 0] * dst_demean[:, :, 1] - src_demean[:, :, 1] * dst_demean[:, :, 0]).sum(axis=1) / var
+
+    M = np.empty((src.shape[0], 2, 3))
+    M[:, 0, 0] = a
+    M[:, 0, 1] = -b
+    M[:, 1, 0] = b
+    M[:, 1, 1] = a
+    M[:, :, 2] = dst_mean - np.einsum('nij,nj->ni', M[:, :, 0:2], src_mean)
+    return M
+
+
+def warp_faces(img, M, out, pool=None, rgb=False):
+    """
+        warp faces into a preallocated n x 3 x h x w batch
+
+    Parameters:
+    ----------
+        img: numpy array of shape (h, w, 3) or list of n of them
+            the image every face is warped from
+        M: numpy array, n x 2 x 3
+            affine matrices, e.g. from umeyama_batch
+        out: numpy array, n x 3 x h x w
+            output batch, of the dtype of the images
+        pool: ThreadPool or None
+            warp the faces over the pool, cv2.warpAffine releases the GIL
+        rgb: bool
+            swap the channels from bgr to rgb
+    Returns:
+    -------
+        out
+    """
+    num, _, h, w = out.shape
+    staging = np.empty((num, h, w, 3), dtype=out.dtype)
+
+    def warp(i):
+        face = cv2.warpAffine(img if isinstance(img, np.ndarray) else img[i], M[i], (w, h),
+                              dst=staging[i], borderValue=0.0)
+        if rgb:
+            face = face[:, :, ::-1]
+        out[i] = face.transpose((2, 0, 1))
+
+    if pool is None:
+        for i in range(num):
+            warp(i)
+    else:
+        pool.map(warp, range(num))
+    return out
@@ -1,17 +1,142 @@
 # coding: utf-8
 import os
+import ctypes
 import mxnet as mx
 import numpy as np
 import math
 import cv2
+import multiprocessing
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 from itertools import repeat
-from helper import nms, adjust_input, generate_bbox, detect_first_stage_warpper
+from helper import nms, batched_nms, generate_bbox, detect_first_stage_warpper, detect_first_stage_packed, \
+    detect_first_stage_scales, detect_first_stage_scales_warpper, crop_resize_batch, umeyama_batch
 try:
     from itertools import izip as zip
 except ImportError:
     pass
 
+
+def set_num_threads(num_threads):
+    """
+        set the number of OpenMP threads MXNet uses inside one operator
+    Parameters:
+    ----------
+        num_threads: int number or None
+            threads per operator, None or 0 keeps the library default
+    """
+    if not num_threads or num_threads <= 0:
+        return
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    if hasattr(mx.base._LIB, 'MXSetNumOMPThreads'):
+        mx.base._LIB.MXSetNumOMPThreads(ctypes.c_int(num_threads))
+
+
+class CachedPredictor(object):
+    """
+        drop-in replacement for FeedForward.predict that keeps a bounded LRU cache
+        of bound executors keyed by the input shape, so that a shape seen before
+        never rebinds. All the executors share the same parameter arrays.
+    """
+    def __init__(self, net, capacity=32, bucket=False):
+        """
+        Parameters:
+        ----------
+            net: FeedForward
+                loaded network
+            capacity: int number
+                largest number of bound executors kept
+            bucket: bool
+                round the batch size up to a power of two and pad the input,
+                so that varying box counts map to a few shapes
+        """
+        self.symbol = net.symbol
+        self.ctx = net.ctx[0]
+        self.arg_params = dict((k, v.as_in_context(self.ctx)) for k, v in net.arg_params.items())
+        self.aux_params = dict((k, v.as_in_context(self.ctx)) for k, v in net.aux_params.items())
+        self.capacity = capacity
+        self.bucket = bucket
+        self.executors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def bucket_size(self, num):
+        """
+            batch size actually bound for num inputs
+        """
+        if not self.bucket or num <= 1:
+            return num
+        return 1 << (num - 1).bit_length()
+
+    def executor(self, shape):
+        """
+            bound executor for the input shape, least recently used one is dropped when full
+        """
+        exe = self.executors.pop(shape, None)
+        if exe is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            arg_shapes, _, aux_shapes = self.symbol.infer_shape(data=shape)
+            args = {}
+            for name, arg_shape in zip(self.symbol.list_arguments(), arg_shapes):
+                args[name] = self.arg_params[name] if name in self.arg_params else mx.nd.zeros(arg_shape, self.ctx)
+            aux_states = [self.aux_params[name] for name in self.symbol.list_auxiliary_states()]
+            exe = self.symbol.bind(self.ctx, args, grad_req='null', aux_states=aux_states)
+            if len(self.executors) >= self.capacity:
+                self.executors.popitem(last=False)
+        self.executors[shape] = exe
+        return exe
+
+    def predict(self, data):
+        """
+            run the network over a numpy batch
+        Parameters:
+        ----------
+            data: numpy array, n x c x h x w
+                network input
+        Retures:
+        -------
+            numpy output, or a list of them for multi-output networks, same as FeedForward.predict
+        """
+        num = data.shape[0]
+        exe = self.executor((self.bucket_size(num),) + data.shape[1:])
+        # rows past num are left over from an earlier batch, their outputs are dropped
+        exe.arg_dict['data'][:num] = data
+        exe.forward(is_train=False)
+        outputs = [out[:num].asnumpy() for out in exe.outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def stats(self):
+        """
+            hit and miss counters of the executor cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.executors)}
+
+
+def load_net(prefix, ctx, cache_size=0, bucket=False):
+    """
+        load a MTCNN network, wrapped in a CachedPredictor unless cache_size is 0
+    """
+    net = mx.model.FeedForward.load(prefix, 1, ctx=ctx)
+    if cache_size > 0:
+        net = CachedPredictor(net, cache_size, bucket)
+    return net
+
+
+# PNet of a first stage worker process
+_worker_pnet = None
+
+def _pnet_worker_init(model_prefix, intra_op_threads, cache_size=0):
+    global _worker_pnet
+    set_num_threads(intra_op_threads)
+    _worker_pnet = load_net(model_prefix, mx.cpu(), cache_size)
+
+def _pnet_worker_run(args):
+    img, scales, threshold = args
+    return detect_first_stage_scales(img, _worker_pnet, scales, threshold, None)
+
 class MtcnnDetector(object):
     """
         Joint Face Detection and Alignment using Multi-task Cascaded Convolutional Neural Networks
@@ -25,6 +150,11 @@ class MtcnnDetector(object):
                  factor = 0.709,
                  num_worker = 1,
                  accurate_landmark = False,
+                 packed_pyramid = False,
+                 worker_type = None,
+                 intra_op_threads = None,
+                 max_batch_size = 256,
+                 executor_cache_size = 32,
                  ctx=mx.cpu()):
         """
             Initialize the detector
@@ -43,29 +173,100 @@ class MtcnnDetector(object):
                     number of processes we use for first stage
                 accurate_landmark: bool
                     use accurate landmark localization or not
+                packed_pyramid: bool
+                    pack all the pyramid levels into one canvas and run PNet once
+                    per image instead of once per scale
+                worker_type: string or None
+                    how the num_worker PNet replicas run the first stage:
+                    'process' for a process pool (cpu only), the default on cpu with num_worker > 1,
+                    'thread' for a thread pool (experimental: the replicas run predict concurrently
+                    and MXNet does not guarantee that executors are thread safe),
+                    None to run them one after another
+                intra_op_threads: int number or None
+                    OpenMP threads used inside every operator, None for the library default.
+                    The process workers set it for themselves only, the other modes change it
+                    for the whole process. With num_worker workers, num_worker * intra_op_threads
+                    should not exceed the number of cores
+                max_batch_size: int number
+                    largest RNet, ONet and LNet batch, detect_faces pools the candidates of several images
+                executor_cache_size: int number
+                    bound executors kept per network, keyed by input shape. RNet, ONet
+                    and LNet batches are padded to power of two sizes. 0 binds a new
+                    executor for every new shape (FeedForward.predict)
 
         """
+        assert worker_type in (None, 'thread', 'process')
         self.num_worker = num_worker
         self.accurate_landmark = accurate_landmark
+        self.packed_pyramid = packed_pyramid
+        self.max_batch_size = max_batch_size
+        if worker_type is None and ctx.device_type == 'cpu':
+            worker_type = 'process'
+        self.worker_type = worker_type if num_worker > 1 else None
+        self.pool = None
+
+        # opt-in, and the process workers keep it to themselves
+        if self.worker_type != 'process':
+            set_num_threads(intra_op_threads)
 
         # load 4 models from folder
         models = ['det1', 'det2', 'det3','det4']
         models = [ os.path.join(model_folder, f) for f in models]
         
+        # the process pool loads its own replicas, one is kept for the packed pyramid
+        num_replica = 1 if self.worker_type == 'process' else num_worker
         self.PNets = []
-        for i in range(num_worker):
-            workner_net = mx.model.FeedForward.load(models[0], 1, ctx=ctx)
+        for i in range(num_replica):
+            workner_net = load_net(models[0], ctx, executor_cache_size)
             self.PNets.append(workner_net)
 
-        self.RNet = mx.model.FeedForward.load(models[1], 1, ctx=ctx)
-        self.ONet = mx.model.FeedForward.load(models[2], 1, ctx=ctx)
-        self.LNet = mx.model.FeedForward.load(models[3], 1, ctx=ctx)
+        # persistent first stage workers, released by close()
+        if self.worker_type == 'thread':
+            self.pool = ThreadPool(num_worker)
+        elif self.worker_type == 'process':
+            self.pool = multiprocessing.get_context('spawn').Pool(num_worker,
+                                                                  initializer=_pnet_worker_init,
+                                                                  initargs=(models[0], intra_op_threads,
+                                                                            executor_cache_size))
+
+        self.RNet = load_net(models[1], ctx, executor_cache_size, bucket=True)
+        self.ONet = load_net(models[2], ctx, executor_cache_size, bucket=True)
+        self.LNet = load_net(models[3], ctx, executor_cache_size, bucket=True)
 
         self.minsize   = float(minsize)
         self.factor    = float(factor)
         self.threshold = threshold
 
 
+    def close(self):
+        """
+            stop the first stage worker pool
+        """
+        if getattr(self, 'pool', None) is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def cache_stats(self):
+        """
+            executor cache counters of every network, to size executor_cache_size
+        Retures:
+        -------
+            dict of network name to {'hits', 'misses', 'size'}, empty without the cache
+        """
+        nets = [('PNet%d' % i, net) for i, net in enumerate(self.PNets)]
+        nets += [('RNet', self.RNet), ('ONet', self.ONet), ('LNet', self.LNet)]
+        return dict((name, net.stats()) for name, net in nets if isinstance(net, CachedPredictor))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
     def convert_to_square(self, bbox):
         """
             convert bbox to square
@@ -185,120 +386,145 @@ class MtcnnDetector(object):
                 yield l[i:i + n]
         num_list = range(number)
         return list(chunks(num_list, self.num_worker))
+
+    def balance_scales(self, scales):
+        """
+            split the scales over the workers so that every worker gets
+            about the same number of pixels
+        Parameters:
+        ----------
+            scales: list of float number
+                decreasing scales of the image pyramid
+        Retures:
+        -------
+            list of num_worker lists of scale indexes
+        """
+        loads = [0.0] * self.num_worker
+        tasks = [[] for _ in range(self.num_worker)]
+        for i in sorted(range(len(scales)), key=lambda i: -scales[i]):
+            k = int(np.argmin(loads))
+            tasks[k].append(i)
+            loads[k] += scales[i] * scales[i]
+        return tasks
         
     def detect_face_limited(self, img, det_type=2):
         height, width, _ = img.shape
+        total_boxes = np.array( [ [0.0, 0.0, img.shape[1], img.shape[0], 0.9] ] ,dtype=np.float32)
+        image_index = np.zeros(1, dtype=np.int64)
         if det_type>=2:
-          total_boxes = np.array( [ [0.0, 0.0, img.shape[1], img.shape[0], 0.9] ] ,dtype=np.float32)
-          num_box = total_boxes.shape[0]
+          stage = self.second_stage([img], total_boxes, image_index)
+          if stage is None:
+              return None
+          total_boxes, image_index = stage
 
-          # pad the bbox
-          [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
-          # (3, 24, 24) is the input shape for RNet
-          input_buf = np.zeros((num_box, 3, 24, 24), dtype=np.float32)
+        stage = self.third_stage([img], total_boxes, image_index)
+        if stage is None:
+            return None
+        total_boxes, points, image_index = stage
 
-          for i in range(num_box):
-              tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
-              tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-              input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (24, 24)))
+        if not self.accurate_landmark:
+            return total_boxes, points
 
-          output = self.RNet.predict(input_buf)
+        return total_boxes, self.extended_stage([img], total_boxes, points, image_index)
 
-          # filter the total_boxes with threshold
-          passed = np.where(output[1][:, 1] > self.threshold[1])
-          total_boxes = total_boxes[passed]
+    def first_stage(self, img):
+        """
+            run PNet over the image pyramid and merge the candidates of all the scales
+        Parameters:
+        ----------
+            img: numpy array, bgr order of shape (h, w, 3)
+                input image
+        Retures:
+        -------
+            bboxes: numpy array, n x 5 (x1,y2,x2,y2,score)
+                refined square candidates for the second stage, None if nothing is found
+        """
+        height, width, _ = img.shape
+        MIN_DET_SIZE = 12
 
-          if total_boxes.size == 0:
-              return None
+        if img is None:
+            return None
 
-          total_boxes[:, 4] = output[1][passed, 1].reshape((-1,))
-          reg = output[0][passed]
+        # only works for color image
+        if len(img.shape) != 3:
+            return None
 
-          # nms
-          pick = nms(total_boxes, 0.7, 'Union')
-          total_boxes = total_boxes[pick]
-          total_boxes = self.calibrate_box(total_boxes, reg[pick])
-          total_boxes = self.convert_to_square(total_boxes)
-          total_boxes[:, 0:4] = np.round(total_boxes[:, 0:4])
+        # detected boxes
+        total_boxes = []
+
+        minl = min( height, width)
+
+        # get all the valid scales
+        scales = []
+        m = MIN_DET_SIZE/self.minsize
+        minl *= m
+        factor_count = 0
+        while minl > MIN_DET_SIZE:
+            scales.append(m*self.factor**factor_count)
+            minl *= self.factor
+            factor_count += 1
+
+        if self.packed_pyramid:
+            # all the scales in a single PNet forward
+            total_boxes = detect_first_stage_packed(img, self.PNets[0], scales, self.threshold[0])
+        elif self.pool is not None:
+            # every worker runs its share of the scales concurrently
+            tasks = [t for t in self.balance_scales(scales) if len(t) > 0]
+            if self.worker_type == 'thread':
+                results = self.pool.map(detect_first_stage_scales_warpper,
+                                        [(img, self.PNets[k], [scales[i] for i in t], self.threshold[0], None)
+                                         for k, t in enumerate(tasks)])
+            else:
+                results = self.pool.map(_pnet_worker_run,
+                                        [(img, [scales[i] for i in t], self.threshold[0]) for t in tasks])
+            total_boxes = [None] * len(scales)
+            for t, boxes in zip(tasks, results):
+                for i, b in zip(t, boxes):
+                    total_boxes[i] = b
         else:
-          total_boxes = np.array( [ [0.0, 0.0, img.shape[1], img.shape[0], 0.9] ] ,dtype=np.float32)
-        num_box = total_boxes.shape[0]
-        [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
-        # (3, 48, 48) is the input shape for ONet
-        input_buf = np.zeros((num_box, 3, 48, 48), dtype=np.float32)
-
-        for i in range(num_box):
-            tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.float32)
-            tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-            input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (48, 48)))
-
-        output = self.ONet.predict(input_buf)
+            sliced_index = self.slice_index(len(scales))
+            total_boxes = []
+            for batch in sliced_index:
+                # per scale nms is done below for all the scales at once
+                local_boxes = map( detect_first_stage_warpper, \
+                        zip(repeat(img), self.PNets[:len(batch)], [scales[i] for i in batch], repeat(self.threshold[0]), repeat(None)) )
+                total_boxes.extend(local_boxes)
+        
+        # remove the Nones, remember the scale of every box
+        scale_index = [ np.full(len(boxes), i) for i, boxes in enumerate(total_boxes) if boxes is not None]
+        total_boxes = [ i for i in total_boxes if i is not None]
 
-        # filter the total_boxes with threshold
-        passed = np.where(output[2][:, 1] > self.threshold[2])
-        total_boxes = total_boxes[passed]
+        if len(total_boxes) == 0:
+            return None
+        
+        total_boxes = np.vstack(total_boxes)
 
         if total_boxes.size == 0:
             return None
 
-        total_boxes[:, 4] = output[2][passed, 1].reshape((-1,))
-        reg = output[1][passed]
-        points = output[0][passed]
-
-        # compute landmark points
-        bbw = total_boxes[:, 2] - total_boxes[:, 0] + 1
-        bbh = total_boxes[:, 3] - total_boxes[:, 1] + 1
-        points[:, 0:5] = np.expand_dims(total_boxes[:, 0], 1) + np.expand_dims(bbw, 1) * points[:, 0:5]
-        points[:, 5:10] = np.expand_dims(total_boxes[:, 1], 1) + np.expand_dims(bbh, 1) * points[:, 5:10]
-
-        # nms
-        total_boxes = self.calibrate_box(total_boxes, reg)
-        pick = nms(total_boxes, 0.7, 'Min')
+        # nms within every scale
+        pick = batched_nms(total_boxes[:, 0:5], np.concatenate(scale_index), 0.5, 'Union')
         total_boxes = total_boxes[pick]
-        points = points[pick]
-        
-        if not self.accurate_landmark:
-            return total_boxes, points
-
-        #############################################
-        # extended stage
-        #############################################
-        num_box = total_boxes.shape[0]
-        patchw = np.maximum(total_boxes[:, 2]-total_boxes[:, 0]+1, total_boxes[:, 3]-total_boxes[:, 1]+1)
-        patchw = np.round(patchw*0.25)
-
-        # make it even
-        patchw[np.where(np.mod(patchw,2) == 1)] += 1
 
-        input_buf = np.zeros((num_box, 15, 24, 24), dtype=np.float32)
-        for i in range(5):
-            x, y = points[:, i], points[:, i+5]
-            x, y = np.round(x-0.5*patchw), np.round(y-0.5*patchw)
-            [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(np.vstack([x, y, x+patchw-1, y+patchw-1]).T,
-                                                                    width,
-                                                                    height)
-            for j in range(num_box):
-                tmpim = np.zeros((tmpw[j], tmpw[j], 3), dtype=np.float32)
-                tmpim[dy[j]:edy[j]+1, dx[j]:edx[j]+1, :] = img[y[j]:ey[j]+1, x[j]:ex[j]+1, :]
-                input_buf[j, i*3:i*3+3, :, :] = adjust_input(cv2.resize(tmpim, (24, 24)))
-
-        output = self.LNet.predict(input_buf)
-
-        pointx = np.zeros((num_box, 5))
-        pointy = np.zeros((num_box, 5))
-
-        for k in range(5):
-            # do not make a large movement
-            tmp_index = np.where(np.abs(output[k]-0.5) > 0.35)
-            output[k][tmp_index[0]] = 0.5
+        # merge the detection from first stage
+        pick = nms(total_boxes[:, 0:5], 0.7, 'Union')
+        total_boxes = total_boxes[pick]
 
-            pointx[:, k] = np.round(points[:, k] - 0.5*patchw) + output[k][:, 0]*patchw
-            pointy[:, k] = np.round(points[:, k+5] - 0.5*patchw) + output[k][:, 1]*patchw
+        bbw = total_boxes[:, 2] - total_boxes[:, 0] + 1
+        bbh = total_boxes[:, 3] - total_boxes[:, 1] + 1
 
-        points = np.hstack([pointx, pointy])
-        points = points.astype(np.int32)
+        # refine the bboxes
+        total_boxes = np.vstack([total_boxes[:, 0]+total_boxes[:, 5] * bbw,
+                                 total_boxes[:, 1]+total_boxes[:, 6] * bbh,
+                                 total_boxes[:, 2]+total_boxes[:, 7] * bbw,
+                                 total_boxes[:, 3]+total_boxes[:, 8] * bbh,
+                                 total_boxes[:, 4]
+                                 ])
 
-        return total_boxes, points
+        total_boxes = total_boxes.T
+        total_boxes = self.convert_to_square(total_boxes)
+        total_boxes[:, 0:4] = np.round(total_boxes[:, 0:4])
+        return total_boxes
 
     def detect_face(self, img, det_type=0):
         """
@@ -318,93 +544,62 @@ class MtcnnDetector(object):
         # check input
         height, width, _ = img.shape
         if det_type==0:
-            MIN_DET_SIZE = 12
-
-            if img is None:
-                return None
-
-            # only works for color image
-            if len(img.shape) != 3:
-                return None
-
-            # detected boxes
-            total_boxes = []
-
-            minl = min( height, width)
-
-            # get all the valid scales
-            scales = []
-            m = MIN_DET_SIZE/self.minsize
-            minl *= m
-            factor_count = 0
-            while minl > MIN_DET_SIZE:
-                scales.append(m*self.factor**factor_count)
-                minl *= self.factor
-                factor_count += 1
-
-            #############################################
-            # first stage
-            #############################################
-            
-            sliced_index = self.slice_index(len(scales))
-            total_boxes = []
-            for batch in sliced_index:
-                local_boxes = map( detect_first_stage_warpper, \
-                        zip(repeat(img), self.PNets[:len(batch)], [scales[i] for i in batch], repeat(self.threshold[0])) )
-                total_boxes.extend(local_boxes)
-            
-            # remove the Nones 
-            total_boxes = [ i for i in total_boxes if i is not None]
-
-            if len(total_boxes) == 0:
-                return None
-            
-            total_boxes = np.vstack(total_boxes)
-
-            if total_boxes.size == 0:
+            total_boxes = self.first_stage(img)
+            if total_boxes is None:
                 return None
-
-            # merge the detection from first stage
-            pick = nms(total_boxes[:, 0:5], 0.7, 'Union')
-            total_boxes = total_boxes[pick]
-
-            bbw = total_boxes[:, 2] - total_boxes[:, 0] + 1
-            bbh = total_boxes[:, 3] - total_boxes[:, 1] + 1
-
-            # refine the bboxes
-            total_boxes = np.vstack([total_boxes[:, 0]+total_boxes[:, 5] * bbw,
-                                     total_boxes[:, 1]+total_boxes[:, 6] * bbh,
-                                     total_boxes[:, 2]+total_boxes[:, 7] * bbw,
-                                     total_boxes[:, 3]+total_boxes[:, 8] * bbh,
-                                     total_boxes[:, 4]
-                                     ])
-
-            total_boxes = total_boxes.T
-            total_boxes = self.convert_to_square(total_boxes)
-            total_boxes[:, 0:4] = np.round(total_boxes[:, 0:4])
         else:
             total_boxes = np.array( [ [0.0, 0.0, img.shape[1], img.shape[0], 0.9] ] ,dtype=np.float32)
 
-        #############################################
-        # second stage
-        #############################################
-        num_box = total_boxes.shape[0]
+        return self.refine_boxes(img, total_boxes)
 
-        # pad the bbox
-        [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
-        # (3, 24, 24) is the input shape for RNet
-        input_buf = np.zeros((num_box, 3, 24, 24), dtype=np.float32)
+    def refine_boxes(self, img, total_boxes):
+        """
+            run RNet, ONet (and LNet) on candidate boxes, skipping the PNet pyramid
+        Parameters:
+        ----------
+            img: numpy array, bgr order of shape (h, w, 3)
+                input image
+            total_boxes: numpy array, n x 5 (x1,y2,x2,y2,score)
+                square candidates, clipped to the image in place
+        Retures:
+        -------
+            None or the (bboxes, points) tuple of detect_face
+        """
+        results = self.refine_pooled([img], total_boxes, np.zeros(total_boxes.shape[0], dtype=np.int64))
+        return results[0]
 
-        for i in range(num_box):
-            tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.uint8)
-            tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-            input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (24, 24)))
+    def image_segments(self, image_index, num_image):
+        """
+            [start, end) rows of every image in boxes ordered by image
+        """
+        bounds = np.searchsorted(image_index, np.arange(num_image + 1))
+        return [(i, bounds[i], bounds[i+1]) for i in range(num_image) if bounds[i+1] > bounds[i]]
 
-        output = self.RNet.predict(input_buf)
+    def second_stage(self, images, total_boxes, image_index):
+        """
+            RNet on the candidates of the images, threshold, nms within every image and calibration
+        Parameters:
+        ----------
+            images: list of numpy array, bgr order of shape (h, w, 3)
+                input images
+            total_boxes: numpy array, n x 5 (x1,y2,x2,y2,score)
+                square candidates ordered by image, clipped to the images in place
+            image_index: numpy array, n
+                image of every candidate
+        Retures:
+        -------
+            None or the (bboxes, image_index) tuple of the square boxes that passed
+        """
+        # (3, 24, 24) is the input shape for RNet
+        input_buf = np.empty((total_boxes.shape[0], 3, 24, 24), dtype=np.float32)
+        for i, start, end in self.image_segments(image_index, len(images)):
+            self.stage_input(images[i], total_boxes[start:end], 24, np.uint8, out=input_buf[start:end])
+        output = self.predict_batched(self.RNet, input_buf)
 
         # filter the total_boxes with threshold
         passed = np.where(output[1][:, 1] > self.threshold[1])
         total_boxes = total_boxes[passed]
+        image_index = image_index[passed]
 
         if total_boxes.size == 0:
             return None
@@ -412,33 +607,40 @@ class MtcnnDetector(object):
         total_boxes[:, 4] = output[1][passed, 1].reshape((-1,))
         reg = output[0][passed]
 
-        # nms
-        pick = nms(total_boxes, 0.7, 'Union')
+        # nms within every image
+        pick = batched_nms(total_boxes, image_index, 0.7, 'Union')
         total_boxes = total_boxes[pick]
+        image_index = image_index[pick]
         total_boxes = self.calibrate_box(total_boxes, reg[pick])
         total_boxes = self.convert_to_square(total_boxes)
         total_boxes[:, 0:4] = np.round(total_boxes[:, 0:4])
+        return total_boxes, image_index
 
-        #############################################
-        # third stage
-        #############################################
-        num_box = total_boxes.shape[0]
-
-        # pad the bbox
-        [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(total_boxes, width, height)
+    def third_stage(self, images, total_boxes, image_index):
+        """
+            ONet on the boxes of the images, threshold, landmarks, calibration and nms within every image
+        Parameters:
+        ----------
+            images: list of numpy array, bgr order of shape (h, w, 3)
+                input images
+            total_boxes: numpy array, n x 5 (x1,y2,x2,y2,score)
+                boxes ordered by image, clipped to the images in place
+            image_index: numpy array, n
+                image of every box
+        Retures:
+        -------
+            None or the (bboxes, points, image_index) tuple of the detections
+        """
         # (3, 48, 48) is the input shape for ONet
-        input_buf = np.zeros((num_box, 3, 48, 48), dtype=np.float32)
-
-        for i in range(num_box):
-            tmp = np.zeros((tmph[i], tmpw[i], 3), dtype=np.float32)
-            tmp[dy[i]:edy[i]+1, dx[i]:edx[i]+1, :] = img[y[i]:ey[i]+1, x[i]:ex[i]+1, :]
-            input_buf[i, :, :, :] = adjust_input(cv2.resize(tmp, (48, 48)))
-
-        output = self.ONet.predict(input_buf)
+        input_buf = np.empty((total_boxes.shape[0], 3, 48, 48), dtype=np.float32)
+        for i, start, end in self.image_segments(image_index, len(images)):
+            self.stage_input(images[i], total_boxes[start:end], 48, np.float32, out=input_buf[start:end])
+        output = self.predict_batched(self.ONet, input_buf)
 
         # filter the total_boxes with threshold
         passed = np.where(output[2][:, 1] > self.threshold[2])
         total_boxes = total_boxes[passed]
+        image_index = image_index[passed]
 
         if total_boxes.size == 0:
             return None
@@ -453,18 +655,24 @@ class MtcnnDetector(object):
         points[:, 0:5] = np.expand_dims(total_boxes[:, 0], 1) + np.expand_dims(bbw, 1) * points[:, 0:5]
         points[:, 5:10] = np.expand_dims(total_boxes[:, 1], 1) + np.expand_dims(bbh, 1) * points[:, 5:10]
 
-        # nms
+        # nms within every image
         total_boxes = self.calibrate_box(total_boxes, reg)
-        pick = nms(total_boxes, 0.7, 'Min')
-        total_boxes = total_boxes[pick]
-        points = points[pick]
-        
-        if not self.accurate_landmark:
-            return total_boxes, points
+        pick = batched_nms(total_boxes, image_index, 0.7, 'Min')
+        return total_boxes[pick], points[pick], image_index[pick]
 
-        #############################################
-        # extended stage
-        #############################################
+    def extended_stage(self, images, total_boxes, points, image_index):
+        """
+            LNet refinement of the landmarks
+        Parameters:
+        ----------
+            images: list of numpy array, bgr order of shape (h, w, 3)
+                input images
+            total_boxes: numpy array, n x 5, points: numpy array, n x 10, image_index: numpy array, n
+                detections of third_stage
+        Retures:
+        -------
+            points: numpy array, n x 10 int32 landmarks
+        """
         num_box = total_boxes.shape[0]
         patchw = np.maximum(total_boxes[:, 2]-total_boxes[:, 0]+1, total_boxes[:, 3]-total_boxes[:, 1]+1)
         patchw = np.round(patchw*0.25)
@@ -472,19 +680,10 @@ class MtcnnDetector(object):
         # make it even
         patchw[np.where(np.mod(patchw,2) == 1)] += 1
 
-        input_buf = np.zeros((num_box, 15, 24, 24), dtype=np.float32)
-        for i in range(5):
-            x, y = points[:, i], points[:, i+5]
-            x, y = np.round(x-0.5*patchw), np.round(y-0.5*patchw)
-            [dy, edy, dx, edx, y, ey, x, ex, tmpw, tmph] = self.pad(np.vstack([x, y, x+patchw-1, y+patchw-1]).T,
-                                                                    width,
-                                                                    height)
-            for j in range(num_box):
-                tmpim = np.zeros((tmpw[j], tmpw[j], 3), dtype=np.float32)
-                tmpim[dy[j]:edy[j]+1, dx[j]:edx[j]+1, :] = img[y[j]:ey[j]+1, x[j]:ex[j]+1, :]
-                input_buf[j, i*3:i*3+3, :, :] = adjust_input(cv2.resize(tmpim, (24, 24)))
-
-        output = self.LNet.predict(input_buf)
+        input_buf = np.empty((num_box, 15, 24, 24), dtype=np.float32)
+        for i, start, end in self.image_segments(image_index, len(images)):
+            self.landmark_input(images[i], points[start:end], patchw[start:end], out=input_buf[start:end])
+        output = self.predict_batched(self.LNet, input_buf)
 
         pointx = np.zeros((num_box, 5))
         pointy = np.zeros((num_box, 5))
@@ -498,10 +697,150 @@ class MtcnnDetector(object):
             pointy[:, k] = np.round(points[:, k+5] - 0.5*patchw) + output[k][:, 1]*patchw
 
         points = np.hstack([pointx, pointy])
-        points = points.astype(np.int32)
+        return points.astype(np.int32)
 
-        return total_boxes, points
+    def refine_pooled(self, images, total_boxes, image_index):
+        """
+            second, third and extended stage on the candidates of several images at once
+        Parameters:
+        ----------
+            images: list of numpy array, bgr order of shape (h, w, 3)
+                input images
+            total_boxes: numpy array, n x 5 (x1,y2,x2,y2,score)
+                square candidates ordered by image, clipped to the images in place
+            image_index: numpy array, n
+                image of every candidate
+        Retures:
+        -------
+            list with, for every image, None or the (bboxes, points) tuple
+        """
+        results = [None] * len(images)
+        stage = self.second_stage(images, total_boxes, image_index)
+        if stage is None:
+            return results
+        total_boxes, image_index = stage
+
+        stage = self.third_stage(images, total_boxes, image_index)
+        if stage is None:
+            return results
+        total_boxes, points, image_index = stage
+
+        if self.accurate_landmark:
+            points = self.extended_stage(images, total_boxes, points, image_index)
+
+        for i, start, end in self.image_segments(image_index, len(images)):
+            results[i] = (total_boxes[start:end], points[start:end])
+        return results
+
+
+    def stage_input(self, img, bboxes, size, dtype, out=None):
+        """
+            crop the bboxes out of img and resize them to the network input
+        Parameters:
+        ----------
+            img: numpy array, bgr order of shape (h, w, 3)
+                input image
+            bboxes: numpy array, n x 5
+                input bboxes, clipped to the image in place by pad()
+            size: int number
+                side of the network input, 24 for RNet and 48 for ONet
+            dtype: numpy dtype
+                dtype of the crops before they are resized
+            out: numpy array or None
+                preallocated float32 buffer of shape n x 3 x size x size
+        Retures:
+        -------
+            input_buf: numpy array, n x 3 x size x size
+        """
+        height, width, _ = img.shape
+        if out is None:
+            out = np.empty((bboxes.shape[0], 3, size, size), dtype=np.float32)
+
+        crop_resize_batch(img, bboxes, size, out, dtype=dtype)
+
+        # pad() clips the bboxes to the image in place, the next steps rely on it
+        self.pad(bboxes, width, height)
+        return out
+
+    def landmark_input(self, img, points, patchw, out=None):
+        """
+            crop the patches around the 5 landmarks for LNet
+        Parameters:
+        ----------
+            img: numpy array, bgr order of shape (h, w, 3)
+                input image
+            points: numpy array, n x 10 (x1, x2 ... x5, y1, y2 ..y5)
+                landmarks
+            patchw: numpy array, n
+                side of the patches
+            out: numpy array or None
+                preallocated float32 buffer of shape n x 15 x 24 x 24
+        Retures:
+        -------
+            input_buf: numpy array, n x 15 x 24 x 24
+        """
+        if out is None:
+            out = np.empty((points.shape[0], 15, 24, 24), dtype=np.float32)
 
+        for i in range(5):
+            x, y = points[:, i], points[:, i+5]
+            x, y = np.round(x-0.5*patchw), np.round(y-0.5*patchw)
+            crop_resize_batch(img, np.vstack([x, y, x+patchw-1, y+patchw-1]).T, 24, out,
+                              channel=i*3, dtype=np.float32)
+        return out
+
+    def predict_batched(self, net, input_buf):
+        """
+            run net over input_buf in batches of at most max_batch_size
+        Parameters:
+        ----------
+            net: FeedForward
+                RNet, ONet or LNet
+            input_buf: numpy array, n x c x h x w
+                network input
+        Retures:
+        -------
+            list of network outputs, concatenated over the batches
+        """
+        outputs = []
+        for start in range(0, input_buf.shape[0], self.max_batch_size):
+            outputs.append(net.predict(input_buf[start:start+self.max_batch_size]))
+        if len(outputs) == 1:
+            return outputs[0]
+        return [np.concatenate(out) for out in zip(*outputs)]
+
+    def detect_faces(self, images, det_type=0):
+        """
+            detect faces over a list of images
+
+            PNet runs on every image, then the candidates of all the images are
+            pooled into shared RNet, ONet and LNet batches. The result is the
+            same as calling detect_face on every image.
+        Parameters:
+        ----------
+            images: list of numpy array, bgr order of shape (h, w, 3)
+                input images, they may have different sizes
+        Retures:
+        -------
+            list with, for every image, None or the (bboxes, points) tuple
+            returned by detect_face
+        """
+        # candidates of every image, kept contiguous and ordered by image so that
+        # pad() can clip every image's boxes in place through a slice
+        total_boxes = []
+        image_index = []
+        for i, img in enumerate(images):
+            if det_type==0:
+                boxes = self.first_stage(img)
+            else:
+                boxes = np.array( [ [0.0, 0.0, img.shape[1], img.shape[0], 0.9] ] ,dtype=np.float32)
+            if boxes is not None:
+                total_boxes.append(boxes)
+                image_index.append(np.full(boxes.shape[0], i))
+
+        if len(total_boxes) == 0:
+            return [None] * len(images)
+        return self.refine_pooled(images, np.vstack(total_boxes), np.concatenate(image_index))
 
 
     def list2colmatrix(self, pts_list):
@@ -538,44 +877,12 @@ class MtcnnDetector(object):
         """
         assert from_shape.shape[0] == to_shape.shape[0] and from_shape.shape[0] % 2 == 0
 
-        sigma_from = 0.0
-        sigma_to = 0.0
-        cov = np.matrix([[0.0, 0.0], [0.0, 0.0]])
-
-        # compute the mean and cov
-        from_shape_points = from_shape.reshape(from_shape.shape[0]/2, 2)
-        to_shape_points = to_shape.reshape(to_shape.shape[0]/2, 2)
-        mean_from = from_shape_points.mean(axis=0)
-        mean_to = to_shape_points.mean(axis=0)
-
-        for i in range(from_shape_points.shape[0]):
-            temp_dis = np.linalg.norm(from_shape_points[i] - mean_from)
-            sigma_from += temp_dis * temp_dis
-            temp_dis = np.linalg.norm(to_shape_points[i] - mean_to)
-            sigma_to += temp_dis * temp_dis
-            cov += (to_shape_points[i].transpose() - mean_to.transpose()) * (from_shape_points[i] - mean_from)
-
-        sigma_from = sigma_from / to_shape_points.shape[0]
-        sigma_to = sigma_to / to_shape_points.shape[0]
-        cov = cov / to_shape_points.shape[0]
-
-        # compute the affine matrix
-        s = np.matrix([[1.0, 0.0], [0.0, 1.0]])
-        u, d, vt = np.linalg.svd(cov)
-
-        if np.linalg.det(cov) < 0:
-            if d[1] < d[0]:
-                s[1, 1] = -1
-            else:
-                s[0, 0] = -1
-        r = u * s * vt
-        c = 1.0
-        if sigma_from != 0:
-            c = 1.0 / sigma_from * np.trace(np.diag(d) * s)
-
-        tran_b = mean_to.transpose() - c * r * mean_from.transpose()
-        tran_m = c * r
+        from_shape_points = np.asarray(from_shape).reshape(1, -1, 2)
+        to_shape_points = np.asarray(to_shape).reshape(-1, 2)
+        tran = umeyama_batch(from_shape_points, to_shape_points)[0]
 
+        tran_m = np.matrix(tran[:, 0:2])
+        tran_b = np.matrix(tran[:, 2:3])
         return tran_m, tran_b
 
     def extract_image_chips(self, img, points, desired_size=256, padding=0):
@@ -593,44 +900,21 @@ class MtcnnDetector(object):
             crop_imgs: list, n
                 cropped and aligned faces 
         """
-        crop_imgs = []
-        for p in points:
-            shape  =[]
-            for k in range(len(p)/2):
-                shape.append(p[k])
-                shape.append(p[k+5])
-
-            if padding > 0:
-                padding = padding
-            else:
-                padding = 0
-            # average positions of face points
-            mean_face_shape_x = [0.224152, 0.75610125, 0.490127, 0.254149, 0.726104]
-            mean_face_shape_y = [0.2119465, 0.2119465, 0.628106, 0.780233, 0.780233]
+        padding = max(padding, 0)
+        # average positions of face points
+        mean_face_shape_x = [0.224152, 0.75610125, 0.490127, 0.254149, 0.726104]
+        mean_face_shape_y = [0.2119465, 0.2119465, 0.628106, 0.780233, 0.780233]
+        to_points = (padding + np.vstack([mean_face_shape_x, mean_face_shape_y]).T) / (2 * padding + 1) * desired_size
+        from_points = np.stack([points[:, 0:5], points[:, 5:10]], axis=2)
+
+        # similar transfroms of all the faces at once, only the rotation and scale are used
+        tran_m = umeyama_batch(from_points, to_points)[:, :, 0:2]
+        scales = np.linalg.norm(tran_m[:, :, 0], axis=1)
+        angles = 180.0 / math.pi * np.arctan2(tran_m[:, 1, 0], tran_m[:, 0, 0])
 
-            from_points = []
-            to_points = []
-
-            for i in range(len(shape)/2):
-                x = (padding + mean_face_shape_x[i]) / (2 * padding + 1) * desired_size
-                y = (padding + mean_face_shape_y[i]) / (2 * padding + 1) * desired_size
-                to_points.append([x, y])
-                from_points.append([shape[2*i], shape[2*i+1]])
-
-            # convert the points to Mat
-            from_mat = self.list2colmatrix(from_points)
-            to_mat = self.list2colmatrix(to_points)
-
-            # compute the similar transfrom
-            tran_m, tran_b = self.find_tfrom_between_shapes(from_mat, to_mat)
-
-            probe_vec = np.matrix([1.0, 0.0]).transpose()
-            probe_vec = tran_m * probe_vec
-
-            scale = np.linalg.norm(probe_vec)
-            angle = 180.0 / math.pi * math.atan2(probe_vec[1, 0], probe_vec[0, 0])
-
-            from_center = [(shape[0]+shape[2])/2.0, (shape[1]+shape[3])/2.0]
+        crop_imgs = []
+        for p, scale, angle in zip(points, scales, angles):
+            from_center = [(p[0]+p[1])/2.0, (p[5]+p[6])/2.0]
             to_center = [0, 0]
             to_center[1] = desired_size * 0.4
             to_center[0] = desired_size * 0.5
@@ -0,0 +1,147 @@
+# coding: utf-8
+import time
+import numpy as np
+
+
+class MtcnnTracker(object):
+    """
+        Face tracking over a video stream with a MtcnnDetector
+
+        The full cascade runs on keyframes only. On the frames in between, the
+        boxes of the previous frame are expanded and refined by RNet and ONet,
+        skipping the PNet pyramid. A frame falls back to the full cascade when
+        a face is lost or the track confidence drops. New faces are picked up
+        on the next keyframe.
+    """
+    def __init__(self,
+                 detector,
+                 keyframe_interval = 10,
+                 min_confidence = 0.9,
+                 expand = 0.25):
+        """
+            Initialize the tracker
+
+            Parameters:
+            ----------
+                detector : MtcnnDetector
+                    detector used for the keyframes and the refinement
+                keyframe_interval : int number
+                    run the full cascade at least once every keyframe_interval frames,
+                    1 runs it on every frame
+                min_confidence : float number
+                    lowest ONet score of a tracked face, below it the frame falls back
+                    to the full cascade
+                expand : float number
+                    how much the previous boxes grow on every side, relative to their
+                    size, to cover the motion between two frames
+
+        """
+        assert keyframe_interval >= 1
+        self.detector = detector
+        self.keyframe_interval = keyframe_interval
+        self.min_confidence = min_confidence
+        self.expand = expand
+        self.reset()
+
+    def reset(self):
+        """
+            drop the tracks and the latency counters, the next frame is a keyframe
+        """
+        # boxes of the previous frame, None before the first keyframe
+        self.boxes = None
+        self.since_keyframe = 0
+        self.num_frame = 0
+        self.num_keyframe = 0
+        self.num_fallback = 0
+        self.keyframe_time = 0.0
+        self.tracked_time = 0.0
+        self.saved_time = 0.0
+        self.last_keyframe = False
+        self.last_latency = 0.0
+        self.last_saved = 0.0
+
+    def expand_boxes(self, boxes):
+        """
+            square and grow the boxes of the previous frame into the RNet candidates
+        Parameters:
+        ----------
+            boxes: numpy array, n x 5 (x1,y2,x2,y2,score)
+                faces of the previous frame
+        Retures:
+        -------
+            candidates: numpy array, n x 5
+        """
+        square = self.detector.convert_to_square(boxes[:, 0:5].astype(np.float32))
+        grow = np.round((square[:, 2] - square[:, 0] + 1) * self.expand)
+        square[:, 0:2] -= np.expand_dims(grow, 1)
+        square[:, 2:4] += np.expand_dims(grow, 1)
+        square[:, 0:4] = np.round(square[:, 0:4])
+        return square
+
+    def lost(self, ret):
+        """
+            whether the refined tracks can not be trusted
+        """
+        if ret is None:
+            return True
+        boxes = ret[0]
+        return boxes.shape[0] < self.boxes.shape[0] or boxes[:, 4].min() < self.min_confidence
+
+    def track(self, img):
+        """
+            detect the faces of the next video frame
+        Parameters:
+        ----------
+            img: numpy array, bgr order of shape (h, w, 3)
+                video frame
+        Retures:
+        -------
+            None or the (bboxes, points) tuple of MtcnnDetector.detect_face
+        """
+        tic = time.time()
+        keyframe = self.boxes is None or self.since_keyframe >= self.keyframe_interval
+
+        ret = None
+        fallback = False
+        if not keyframe and self.boxes.shape[0] > 0:
+            ret = self.detector.refine_boxes(img, self.expand_boxes(self.boxes))
+            fallback = self.lost(ret)
+
+        if keyframe or fallback:
+            key_tic = time.time()
+            ret = self.detector.detect_face(img)
+            self.keyframe_time += time.time() - key_tic
+            self.num_keyframe += 1
+            self.num_fallback += int(fallback)
+            self.since_keyframe = 0
+
+        self.boxes = np.zeros((0, 5), dtype=np.float32) if ret is None else ret[0].copy()
+        self.since_keyframe += 1
+        self.num_frame += 1
+
+        # latency saved against the mean keyframe, a fallback frame wasted its refinement
+        self.last_keyframe = keyframe or fallback
+        self.last_latency = time.time() - tic
+        self.last_saved = 0.0
+        if not keyframe:
+            self.last_saved = self.keyframe_time / self.num_keyframe - self.last_latency
+            if not fallback:
+                self.tracked_time += self.last_latency
+        self.saved_time += self.last_saved
+        return ret
+
+    def stats(self):
+        """
+            frame counters and latencies of the stream so far
+        Retures:
+        -------
+            dict with the number of frames, keyframes and fallbacks, the mean keyframe
+            and tracked frame latency and the total latency saved, in seconds
+        """
+        num_tracked = self.num_frame - self.num_keyframe
+        return {'frames': self.num_frame,
+                'keyframes': self.num_keyframe,
+                'fallbacks': self.num_fallback,
+                'keyframe_latency': self.keyframe_time / max(self.num_keyframe, 1),
+                'tracked_latency': self.tracked_time / max(num_tracked, 1),
+                'saved': self.saved_time}
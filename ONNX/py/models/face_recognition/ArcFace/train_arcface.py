@@ -101,6 +101,10 @@ margin_m = 0.5
 margin_s = 64.0
 # verification targets
 target = 'lfw,cfp_fp,agedb_30'
+# run the verification in a background process instead of pausing the training
+ver_async = False
+# gpu of the background verification process, -1 for cpu
+ver_gpu = -1
 beta = 1000.0
 beta_min = 5.0
 beta_freeze = 0
@@ -238,7 +242,8 @@ def get_symbol(arg_params, aux_params, image_channel, image_h, image_w, num_laye
 
 
 def train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_steps,wd,fc7_wd_mult,
-              mom,emb_size,per_batch_size,margin_m,margin_s,target,beta,beta_min,beta_freeze,gamma,power,scale):
+              mom,emb_size,per_batch_size,margin_m,margin_s,target,beta,beta_min,beta_freeze,gamma,power,scale,
+              ver_async=False,ver_gpu=-1):
     # define context
     ctx = []
     num_gpus = max(mx.test_utils.list_gpus()) + 1
@@ -325,24 +330,39 @@ def train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_
 
     ver_list = []
     ver_name_list = []
+    ver_path_list = []
     for name in target.split(','):
         path = os.path.join(data_dir,name+".bin")
         if os.path.exists(path):
-            data_set = verification.load_bin(path, image_size)
-            ver_list.append(data_set)
+            if not ver_async:
+                data_set = verification.load_bin(path, image_size, flip=False)
+                ver_list.append(data_set)
             ver_name_list.append(name)
+            ver_path_list.append(path)
             print('ver', name)
 
-
+    # the background worker evaluates snapshots of the embedding part of the network,
+    # the snapshots are kept here until their results decide on the checkpoint
+    ver_worker = None
+    ver_snapshots = {}
+    if ver_async and len(ver_path_list)>0:
+        ver_worker = verification.VerificationWorker(sym.get_internals()['fc1_output'], ver_path_list,
+                                                     image_size, batch_size, ver_gpu)
+
+    def ver_report(nbatch, results):
+        acc_list = []
+        for i, (acc2, std2, xnorm) in enumerate(results):
+            print('[%s][%d]XNorm: %f' % (ver_name_list[i], nbatch, xnorm))
+            print('[%s][%d]Accuracy-Flip: %1.5f+-%1.5f' % (ver_name_list[i], nbatch, acc2, std2))
+            acc_list.append(acc2)
+        return acc_list
 
     def ver_test(nbatch):
         results = []
         for i in xrange(len(ver_list)):
             acc1, std1, acc2, std2, xnorm, embeddings_list = verification.test(ver_list[i], model, batch_size, 10, None, None)
-            print('[%s][%d]XNorm: %f' % (ver_name_list[i], nbatch, xnorm))
-            print('[%s][%d]Accuracy-Flip: %1.5f+-%1.5f' % (ver_name_list[i], nbatch, acc2, std2))
-            results.append(acc2)
-        return results
+            results.append((acc2, std2, xnorm))
+        return ver_report(nbatch, results)
 
 
 
@@ -354,6 +374,36 @@ def train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_
     for l in xrange(len(lr_steps)):
         lr_steps[l] = int(lr_steps[l]*p)
     print('lr_steps', lr_steps)
+    def ver_update(mbatch, acc_list, params=None):
+        save_step[0]+=1
+        msave = save_step[0]
+        do_save = False
+        if len(acc_list)>0:
+            lfw_score = acc_list[0]
+            if lfw_score>highest_acc[0]:
+                highest_acc[0] = lfw_score
+                if lfw_score>=0.998:
+                    do_save = True
+            if acc_list[-1]>=highest_acc[-1]:
+                highest_acc[-1] = acc_list[-1]
+                if lfw_score>=0.99:
+                    do_save = True
+        if ckpt==0:
+            do_save = False
+        elif ckpt>1:
+            do_save = True
+        if do_save:
+            print('saving', msave)
+            arg, aux = model.get_params() if params is None else params
+            mx.model.save_checkpoint(prefix, msave, model.symbol, arg, aux)
+        print('[%d]Accuracy-Highest: %1.5f'%(mbatch, highest_acc[-1]))
+
+    def ver_finish():
+        if ver_worker is not None:
+            ver_worker.close()
+            for nbatch, results in ver_worker.poll():
+                ver_update(nbatch, ver_report(nbatch, results), ver_snapshots.pop(nbatch))
+
     def _batch_callback(param):
         global_step[0]+=1
         mbatch = global_step[0]
@@ -367,30 +417,21 @@ def train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_
         if mbatch%1000==0:
             print('lr-batch-epoch:',opt.lr,param.nbatch,param.epoch)
 
+        if ver_worker is not None:
+            for nbatch, results in ver_worker.poll():
+                ver_update(nbatch, ver_report(nbatch, results), ver_snapshots.pop(nbatch))
         if mbatch>=0 and mbatch%verbose==0:
-            acc_list = ver_test(mbatch)
-            save_step[0]+=1
-            msave = save_step[0]
-            do_save = False
-            if len(acc_list)>0:
-                lfw_score = acc_list[0]
-                if lfw_score>highest_acc[0]:
-                    highest_acc[0] = lfw_score
-                    if lfw_score>=0.998:
-                        do_save = True
-                if acc_list[-1]>=highest_acc[-1]:
-                    highest_acc[-1] = acc_list[-1]
-                    if lfw_score>=0.99:
-                        do_save = True
-            if ckpt==0:
-                do_save = False
-            elif ckpt>1:
-                do_save = True
-            if do_save:
-                print('saving', msave)
+            if ver_worker is None:
+                ver_update(mbatch, ver_test(mbatch))
+            else:
+                # get_params refills the same arrays on every call, keep a copy
                 arg, aux = model.get_params()
-                mx.model.save_checkpoint(prefix, msave, model.symbol, arg, aux)
-            print('[%d]Accuracy-Highest: %1.5f'%(mbatch, highest_acc[-1]))
+                ver_snapshots[mbatch] = (dict((k, v.copy()) for k, v in arg.items()),
+                                         dict((k, v.copy()) for k, v in aux.items()))
+                dropped = ver_worker.submit(mbatch, *ver_snapshots[mbatch])
+                if dropped is not None:
+                    print('[%d]verification of batch %d dropped' % (mbatch, dropped))
+                    del ver_snapshots[dropped]
         if mbatch<=beta_freeze:
             _beta = beta
         else:
@@ -398,6 +439,7 @@ def train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_
             _beta = max(beta_min, beta*math.pow(1+gamma*move, -1.0*power))
         os.environ['BETA'] = str(_beta)
         if max_steps>0 and mbatch>max_steps:
+            ver_finish()
             sys.exit(0)
 
     epoch_cb = None
@@ -415,6 +457,7 @@ def train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_
         allow_missing      = True,
         batch_end_callback = _batch_callback,
         epoch_end_callback = epoch_cb )
+    ver_finish()
 
 
 # ### Train model
@@ -428,7 +471,8 @@ def train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_
 
 def main():
     train_net(data_dir,prefix,pretrained,ckpt,verbose,max_steps,end_epoch,lr,lr_steps,wd,fc7_wd_mult,
-              mom,emb_size,per_batch_size,margin_m,margin_s,target,beta,beta_min,beta_freeze,gamma,power,scale)
+              mom,emb_size,per_batch_size,margin_m,margin_s,target,beta,beta_min,beta_freeze,gamma,power,scale,
+              ver_async,ver_gpu)
 
 if __name__ == '__main__':
     main()
@@ -39,10 +39,22 @@ import cv2
 import math
 import datetime
 import pickle
+import hashlib
+import json
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from sklearn.decomposition import PCA
 import mxnet as mx
 from mxnet import ndarray as nd
 import face_image
+# calculate_accuracies is shared with arcface_validation, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from threshold_sweep import calculate_accuracy, calculate_accuracies
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 # Used to split data for K-fold crossvalidation
 class LFold:
@@ -59,7 +71,7 @@ class LFold:
 
 def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_folds=10, pca = 0):
     '''
-    Computes accuracy on each fold of cross validation using calculate_accuracy()
+    Computes accuracy on each fold of cross validation using calculate_accuracies() of threshold_sweep.py
     '''
     assert(embeddings1.shape[0] == embeddings2.shape[0])
     assert(embeddings1.shape[1] == embeddings2.shape[1])
@@ -92,71 +104,123 @@ def calculate_roc(thresholds, embeddings1, embeddings2, actual_issame, nrof_fold
           dist = np.sum(np.square(diff),1)
         
         # Find the best threshold for the fold
-        acc_train = np.zeros((nrof_thresholds))
-        for threshold_idx, threshold in enumerate(thresholds):
-            _, _, acc_train[threshold_idx] = calculate_accuracy(threshold, dist[train_set], actual_issame[train_set])
+        _, _, acc_train = calculate_accuracies(thresholds, dist[train_set], actual_issame[train_set])
         best_threshold_index = np.argmax(acc_train)
-        for threshold_idx, threshold in enumerate(thresholds):
-            tprs[fold_idx,threshold_idx], fprs[fold_idx,threshold_idx], _ = calculate_accuracy(threshold, dist[test_set], actual_issame[test_set])
-        _, _, accuracy[fold_idx] = calculate_accuracy(thresholds[best_threshold_index], dist[test_set], actual_issame[test_set])
+        tprs[fold_idx,:], fprs[fold_idx,:], acc_test = calculate_accuracies(thresholds, dist[test_set], actual_issame[test_set])
+        accuracy[fold_idx] = acc_test[best_threshold_index]
           
     tpr = np.mean(tprs,0)
     fpr = np.mean(fprs,0)
     return tpr, fpr, accuracy
 
-def calculate_accuracy(threshold, dist, actual_issame):
-    '''
-    Computes the actual accuracy for test samples by thresholding the distance between embedding vectors of a test image pair and comparing the output with the ground truth for the pair
-    '''
-    predict_issame = np.less(dist, threshold)
-    tp = np.sum(np.logical_and(predict_issame, actual_issame))
-    fp = np.sum(np.logical_and(predict_issame, np.logical_not(actual_issame)))
-    tn = np.sum(np.logical_and(np.logical_not(predict_issame), np.logical_not(actual_issame)))
-    fn = np.sum(np.logical_and(np.logical_not(predict_issame), actual_issame))
-  
-    tpr = 0 if (tp+fn==0) else float(tp) / float(tp+fn)
-    fpr = 0 if (fp+tn==0) else float(fp) / float(fp+tn)
-    acc = float(tp+tn)/dist.size
-    return tpr, fpr, acc
-
-def evaluate(embeddings, actual_issame, nrof_folds=10, pca = 0):
+def evaluate(embeddings, actual_issame, nrof_folds=10, pca = 0, threshold_step = 0.01):
     '''
     Splits embeddings into test pairs and computes accuracies using calculate_roc()
     '''
     # Calculate evaluation metrics
-    thresholds = np.arange(0, 4, 0.01)
+    thresholds = np.arange(0, 4, threshold_step)
     embeddings1 = embeddings[0::2]
     embeddings2 = embeddings[1::2]
     tpr, fpr, accuracy = calculate_roc(thresholds, embeddings1, embeddings2,
         np.asarray(actual_issame), nrof_folds=nrof_folds, pca = pca)
-    thresholds = np.arange(0, 4, 0.001)
     return tpr, fpr, accuracy
 
-def load_bin(path, image_size):
+def bin_digest(path):
+  '''
+  Hash of the content of a .bin file, names its decoded cache
+  Like onnx_cache does for the models, the hash is kept with the size and mtime of the .bin in <name>.digest.json
+  and only computed again when they change
+  '''
+  st = os.stat(path)
+  stamp_path = os.path.splitext(path)[0]+'.digest.json'
+  stamp = {'size': st.st_size, 'mtime': st.st_mtime}
+  if os.path.exists(stamp_path):
+    with open(stamp_path) as f:
+      old = json.load(f)
+    if old.get('size')==stamp['size'] and old.get('mtime')==stamp['mtime']:
+      return old['digest']
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1<<20), b''):
+      sha1.update(chunk)
+  stamp['digest'] = sha1.hexdigest()[:16]
+  tmp = '%s.%d.tmp' % (stamp_path, os.getpid())
+  with open(tmp, 'w') as f:
+    json.dump(stamp, f)
+  os.rename(tmp, stamp_path)
+  return stamp['digest']
+
+def decode_bins(bins, image_size, out, num_threads=8):
+  '''
+  Decodes the encoded images into out (n x 3 x h x w uint8, rgb) over a thread pool, cv2.imdecode releases the GIL
+  '''
+  def decode(i):
+    img = cv2.imdecode(np.frombuffer(bins[i], dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert img.shape[0]==image_size[0] and img.shape[1]==image_size[1]
+    out[i] = img[:,:,::-1].transpose((2,0,1))
+  pool = ThreadPool(num_threads)
+  pool.map(decode, xrange(out.shape[0]), chunksize=256)
+  pool.close()
+  pool.join()
+  return out
+
+def load_bin(path, image_size, flip=True, cache=True, num_threads=8):
   '''
   Loads validation datasets for verification
+  The images are decoded once over num_threads threads into n x 3 x h x w uint8. With cache=True they are saved
+  with the issame labels next to the .bin, keyed by the hash of its content, and later loads memory map them:
+  they are near-instant, copy nothing and share the page cache between processes
+  With flip=False only the original images are kept, test() then flips them inside every batch
   '''
-  bins, issame_list = pickle.load(open(path, 'rb'))
-  data_list = []
-  for flip in [0,1]:
-    data = nd.empty((len(issame_list)*2, 3, image_size[0], image_size[1]))
-    data_list.append(data)
-  for i in xrange(len(issame_list)*2):
-    _bin = bins[i]
-    img = mx.image.imdecode(_bin)
-    img = nd.transpose(img, axes=(2, 0, 1))
-    for flip in [0,1]:
-      if flip==1:
-        img = mx.ndarray.flip(data=img, axis=2)
-      data_list[flip][i][:] = img
-    if i%1000==0:
-      print('loading bin', i)
-  print(data_list[0].shape)
+  prefix = '%s.%s.%dx%d' % (os.path.splitext(path)[0], bin_digest(path), image_size[0], image_size[1])
+  data_path = prefix+'.data.npy'
+  issame_path = prefix+'.issame.npy'
+  if cache and os.path.exists(data_path) and os.path.exists(issame_path):
+    issame_list = np.load(issame_path)
+    data = np.load(data_path, mmap_mode='r')
+  else:
+    bins, issame_list = pickle.load(open(path, 'rb'))
+    issame_list = np.asarray(issame_list, dtype=bool)
+    shape = (len(issame_list)*2, 3, image_size[0], image_size[1])
+    if cache:
+      # write under a temporary name, concurrent loaders never see a partial cache
+      tmp = '%s.%d.tmp' % (prefix, os.getpid())
+      try:
+        data = np.lib.format.open_memmap(tmp+'.data.npy', mode='w+', dtype=np.uint8, shape=shape)
+        decode_bins(bins, image_size, data, num_threads)
+        data.flush()
+        del data
+        np.save(tmp+'.issame.npy', issame_list)
+        os.rename(tmp+'.issame.npy', issame_path)
+        os.rename(tmp+'.data.npy', data_path)
+      finally:
+        # left behind when decoding or saving failed
+        for tmp_path in (tmp+'.data.npy', tmp+'.issame.npy'):
+          if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+      data = np.load(data_path, mmap_mode='r')
+    else:
+      data = np.empty(shape, dtype=np.uint8)
+      decode_bins(bins, image_size, data, num_threads)
+  data_list = [data]
+  if flip:
+    data_list.append(data[:,:,:,::-1])
+  print(data.shape)
   return (data_list, issame_list)
 
+def batch_slice(data, begin, end):
+  '''
+  Rows begin:end of a data set as a float32 NDArray, data is an NDArray or a (memory mapped) numpy array
+  '''
+  if isinstance(data, np.ndarray):
+    return nd.array(data[begin:end], dtype=np.float32)
+  return nd.slice_axis(data, axis=0, begin=begin, end=end)
+
 def test(data_set, mx_model, batch_size, nfolds=10, data_extra = None, label_shape = None):
   '''
   test() takes a validation set data_set and the MXNet model mx_model as input and computes accuracies using evaluate() on the set using nfolds cross validation
+  If data_set only holds the original images (load_bin with flip=False), every batch is made of batch_size/2
+  images and their flips, so both embeddings come out of the same forward
   '''
   print('testing verification..')
   data_list = data_set[0]
@@ -165,35 +229,59 @@ def test(data_set, mx_model, batch_size, nfolds=10, data_extra = None, label_sha
   embeddings_list = []
   if data_extra is not None:
     _data_extra = nd.array(data_extra)
-  time_consumed = 0.0
+  time_consumed = [0.0]
   if label_shape is None:
     _label = nd.ones( (batch_size,) )
   else:
     _label = nd.ones( label_shape )
-  for i in xrange( len(data_list) ):
-    data = data_list[i]
+
+  def forward(_data):
+    time0 = datetime.datetime.now()
+    if data_extra is None:
+      db = mx.io.DataBatch(data=(_data,), label=(_label,))
+    else:
+      db = mx.io.DataBatch(data=(_data,_data_extra), label=(_label,))
+    model.forward(db, is_train=False)
+    net_out = model.get_outputs()
+    _embeddings = net_out[0].asnumpy()
+    time_now = datetime.datetime.now()
+    diff = time_now - time0
+    time_consumed[0]+=diff.total_seconds()
+    return _embeddings
+
+  if len(data_list)==1:
+    assert batch_size%2==0, 'flipping inside the batch needs an even batch_size'
+    data = data_list[0]
+    half = batch_size//2
     embeddings = None
     ba = 0
     while ba<data.shape[0]:
-      bb = min(ba+batch_size, data.shape[0])
+      bb = min(ba+half, data.shape[0])
       count = bb-ba
-      _data = nd.slice_axis(data, axis=0, begin=bb-batch_size, end=bb)
-      time0 = datetime.datetime.now()
-      if data_extra is None:
-        db = mx.io.DataBatch(data=(_data,), label=(_label,))
-      else:
-        db = mx.io.DataBatch(data=(_data,_data_extra), label=(_label,))
-      model.forward(db, is_train=False)
-      net_out = model.get_outputs()
-      _embeddings = net_out[0].asnumpy()
-      time_now = datetime.datetime.now()
-      diff = time_now - time0
-      time_consumed+=diff.total_seconds()
+      _data = batch_slice(data, bb-half, bb)
+      _data = nd.concat(_data, nd.flip(_data, axis=3), dim=0)
+      _embeddings = forward(_data)
       if embeddings is None:
-        embeddings = np.zeros( (data.shape[0], _embeddings.shape[1]) )
-      embeddings[ba:bb,:] = _embeddings[(batch_size-count):,:]
+        embeddings = [np.zeros( (data.shape[0], _embeddings.shape[1]) ) for _ in xrange(2)]
+      embeddings[0][ba:bb,:] = _embeddings[(half-count):half,:]
+      embeddings[1][ba:bb,:] = _embeddings[(batch_size-count):,:]
       ba = bb
-    embeddings_list.append(embeddings)
+    embeddings_list.extend(embeddings)
+  else:
+    for i in xrange( len(data_list) ):
+      data = data_list[i]
+      embeddings = None
+      ba = 0
+      while ba<data.shape[0]:
+        bb = min(ba+batch_size, data.shape[0])
+        count = bb-ba
+        _data = batch_slice(data, bb-batch_size, bb)
+        _embeddings = forward(_data)
+        if embeddings is None:
+          embeddings = np.zeros( (data.shape[0], _embeddings.shape[1]) )
+        embeddings[ba:bb,:] = _embeddings[(batch_size-count):,:]
+        ba = bb
+      embeddings_list.append(embeddings)
 
   _xnorm = 0.0
   _xnorm_cnt = 0
@@ -212,7 +300,123 @@ def test(data_set, mx_model, batch_size, nfolds=10, data_extra = None, label_sha
   embeddings = embeddings_list[0] + embeddings_list[1]
   embeddings = sklearn.preprocessing.normalize(embeddings)
   print(embeddings.shape)
-  print('infer time', time_consumed)
+  print('infer time', time_consumed[0])
   _, _, accuracy = evaluate(embeddings, issame_list, nrof_folds=nfolds)
   acc2, std2 = np.mean(accuracy), np.std(accuracy)
-  return acc1, std1, acc2, std2, _xnorm, embeddings_list
\ No newline at end of file
+  return acc1, std1, acc2, std2, _xnorm, embeddings_list
+
+def verification_worker(sym_json, ver_paths, image_size, batch_size, gpu, nfolds, task_queue, result_queue):
+  '''
+  Process loop of VerificationWorker: binds its own inference module, then runs test() on every snapshot.
+  An exception ends the loop, its traceback is sent as the result (None, traceback)
+  '''
+  try:
+    ctx = mx.cpu() if gpu<0 else mx.gpu(gpu)
+    sym = mx.sym.load_json(sym_json)
+    ver_list = [load_bin(path, image_size, flip=False) for path in ver_paths]
+    model = mx.mod.Module(symbol=sym, context=ctx, label_names=None)
+    model.bind(data_shapes=[('data', (batch_size, 3, image_size[0], image_size[1]))], for_training=False)
+    while True:
+      task = task_queue.get()
+      if task is None:
+        break
+      nbatch, arg_params, aux_params = task
+      arg_params = dict((k, nd.array(v)) for k, v in arg_params.items())
+      aux_params = dict((k, nd.array(v)) for k, v in aux_params.items())
+      model.set_params(arg_params, aux_params)
+      results = []
+      for data_set in ver_list:
+        _, _, acc2, std2, xnorm, _ = test(data_set, model, batch_size, nfolds)
+        results.append((acc2, std2, xnorm))
+      result_queue.put((nbatch, results))
+  except Exception:
+    result_queue.put((None, traceback.format_exc()))
+
+class VerificationWorker:
+  '''
+  Runs test() on parameter snapshots in a separate process with its own inference module, so that training
+  goes on while the verification sets are evaluated. At most one snapshot waits while another one is being
+  evaluated, a newer snapshot replaces the waiting one. submit() and poll() raise once the worker failed
+  '''
+  def __init__(self, sym, ver_paths, image_size, batch_size, gpu=-1, nfolds=10):
+    # spawn, a forked child would inherit the training process' device state
+    mp = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    self.arg_names = set(sym.list_arguments())
+    self.aux_names = set(sym.list_auxiliary_states())
+    self.task_queue = mp.Queue(1)
+    self.result_queue = mp.Queue()
+    self.process = mp.Process(target=verification_worker,
+                              args=(sym.tojson(), ver_paths, image_size, batch_size, gpu, nfolds,
+                                    self.task_queue, self.result_queue))
+    self.process.daemon = True
+    self.process.start()
+    self.closed = False
+
+  def submit(self, nbatch, arg_params, aux_params):
+    '''
+    Queues the snapshot taken at batch nbatch, only the parameters of the inference symbol are sent.
+    Returns the nbatch of the waiting snapshot it replaced, None if nothing was dropped
+    '''
+    if self.closed or not self.process.is_alive():
+      # raises with the reason the worker stopped
+      self.poll()
+      raise RuntimeError('verification worker is not running')
+    task = (nbatch,
+            dict((k, v.asnumpy()) for k, v in arg_params.items() if k in self.arg_names),
+            dict((k, v.asnumpy()) for k, v in aux_params.items() if k in self.aux_names))
+    # never blocks the training loop: a blocking put() could wait for the worker to finish a snapshot
+    dropped = None
+    while True:
+      try:
+        self.task_queue.put_nowait(task)
+        return dropped
+      except queue.Full:
+        try:
+          dropped = self.task_queue.get_nowait()[0]
+        except queue.Empty:
+          # the worker is taking it, or the waiting snapshot is not in the pipe yet
+          pass
+
+  def poll(self):
+    '''
+    Results that arrived so far, a list of (nbatch, [(acc, std, xnorm) for every verification set]).
+    Raises RuntimeError when the worker failed or died
+    '''
+    # read before draining, the results of a worker that just exited are in the queue already
+    exitcode = self.process.exitcode
+    results = []
+    while True:
+      try:
+        nbatch, result = self.result_queue.get_nowait()
+      except queue.Empty:
+        break
+      if nbatch is None:
+        raise RuntimeError('verification worker failed:\n' + result)
+      results.append((nbatch, result))
+    if exitcode:
+      raise RuntimeError('verification worker exited with code %d' % exitcode)
+    return results
+
+  def close(self):
+    '''
+    Waits for the queued snapshots and stops the worker, their results (or its failure) can still be polled
+    '''
+    if self.closed:
+      return
+    self.closed = True
+    # the slot may hold a snapshot the worker has not taken yet, or never will if it died
+    while self.process.is_alive():
+      try:
+        self.task_queue.put(None, timeout=1.0)
+        break
+      except queue.Full:
+        pass
+    while self.process.is_alive():
+      self.process.join(1.0)
+    if self.process.exitcode != 0 or not self.task_queue.empty():
+      # a dead worker leaves the waiting snapshot behind, drop it so that exiting does not wait on the pipe
+      try:
+        self.task_queue.get_nowait()
+      except queue.Empty:
+        pass
+      self.task_queue.cancel_join_thread()
@@ -1,14 +1,16 @@
-import mxnet as mx
 import numpy as np
 
 # Post-processing function for ImageNet models
-def postprocess(scores): 
+def postprocess(scores):
     '''
-    Postprocessing with mxnet gluon
-    The function takes scores generated by the network and returns the class IDs in decreasing order
-    of probability
+    Postprocessing with numpy, for the mxnet and onnxruntime backends of models/common/onnx_backend.py alike
+    The function takes scores generated by the network (NDArray or numpy array) and returns the class IDs
+    in decreasing order of probability
     '''
-    prob = mx.ndarray.softmax(scores).asnumpy()
+    scores = scores.asnumpy() if hasattr(scores, 'asnumpy') else np.asarray(scores)
+    # softmax over the classes
+    prob = np.exp(scores - scores.max(axis=-1, keepdims=True))
+    prob /= prob.sum(axis=-1, keepdims=True)
     prob = np.squeeze(prob)
     a = np.argsort(prob)[::-1]
     return a
@@ -0,0 +1,64 @@
+'''
+Samples/sec of CityLoader, in process and with the shared memory worker pool.
+
+Loads --epochs epochs of the data list for every worker count (0 loads in
+the main process) with the validation settings of duc-validation, and
+reports the samples/sec of the first epoch, which starts the pool, and of
+the following ones.
+
+Run: python benchmark_loader.py --val-list val.lst --data-dir leftImg8bit/val --label-dir gtFine/val --threads 0,4,8
+     python benchmark_loader.py --val-list val.lst --shard-index val-shards.json --threads 0,4,8
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+from cityscapes_loader import CityLoader
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the CityLoader worker pool')
+    parser.add_argument('--val-list', default='val.lst', help='data list, as written by duc-validation')
+    parser.add_argument('--data-dir', default='', help='image directory the list is relative to')
+    parser.add_argument('--label-dir', default='', help='label directory the list is relative to')
+    parser.add_argument('--batch-size', type=int, default=4, help='batch size')
+    parser.add_argument('--threads', default='0,4', help='comma separated worker counts, 0 for in process')
+    parser.add_argument('--slots', type=int, default=3, help='shared memory batch slots')
+    parser.add_argument('--epochs', type=int, default=2, help='epochs per worker count')
+    parser.add_argument('--shard-index', default=None, help='read the samples from the shards of city_shards.py')
+    parser.add_argument('--limit', type=int, default=200, help='number of samples per epoch')
+    args = parser.parse_args()
+
+    print('%-10s %8s %12s' % ('workers', 'epoch', 'samples/s'))
+    for threads in [int(x) for x in args.threads.split(',')]:
+        loader = CityLoader(args.val_list, {
+            'data_path': args.data_dir,
+            'label_path': args.label_dir,
+            'rgb_mean': (122.675, 116.669, 104.008),
+            'batch_size': args.batch_size,
+            'scale_factors': [1],
+            'data_shape': [(args.batch_size, 3, 800, 800)],
+            'label_shape': [(args.batch_size, 160000)],
+            'use_random_crop': False,
+            'use_mirror': False,
+            'ds_rate': 8,
+            'convert_label': True,
+            'multi_thread': threads > 0,
+            'n_thread': threads,
+            'n_slots': args.slots,
+            'cell_width': 2,
+            'random_bound': [120, 120],
+            'shard_index': args.shard_index,
+        })
+        loader.data = loader.data[:args.limit]
+        for epoch in range(args.epochs):
+            tic = time.time()
+            loader.reset()
+            samples = sum(batch.data[0].shape[0] for batch in loader)
+            print('%-10d %8d %12.1f' % (threads, epoch, samples / (time.time() - tic)))
+        loader.shutdown()
+
+
+if __name__ == '__main__':
+    main()
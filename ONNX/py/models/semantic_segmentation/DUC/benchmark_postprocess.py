@@ -0,0 +1,89 @@
+'''
+Speed and mIoU of the DUC label upsampling modes in duc_labels.py.
+
+Every image of the validation list goes through the model once, then its
+score map is turned into the full resolution label map with every mode.
+Reports the postprocess time, the speedup over exact, the mIoU against the
+ground truth, its difference to exact and the share of pixels labelled as
+exact does.
+
+Run: python benchmark_postprocess.py --model ResNet101_DUC_HDC.onnx --val-list val.lst --limit 50
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+import cv2 as cv
+import mxnet as mx
+import numpy as np
+from PIL import Image
+
+from cityscapes_loader import CityLoader
+from duc_engine import DucEngine, LABEL_NUM, cell_shape, plan_buckets, rearrange
+from duc_labels import MODES, score_labels
+from duc_metric import confusion_matrix, segmentation_scores
+from utils import replace_city_labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the DUC label upsampling modes')
+    parser.add_argument('--model', default='ResNet101_DUC_HDC.onnx', help='DUC onnx model')
+    parser.add_argument('--val-list', default='val.lst', help='validation list, as written by duc-validation')
+    parser.add_argument('--limit', type=int, default=50, help='number of images')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated label modes')
+    parser.add_argument('--repeat', type=int, default=3, help='best of repeat postprocess runs')
+    parser.add_argument('--gpu', type=int, default=-1, help='gpu id, -1 for cpu')
+    args = parser.parse_args()
+
+    items = []
+    for item in CityLoader.read_data(args.val_list):
+        # the list holds several crops of every image, the full images are used here
+        if not items or items[-1][0] != item[0]:
+            items.append(item)
+    items = items[:args.limit]
+    modes = args.modes.split(',')
+    shapes = dict((item[0], cv.imread(item[0]).shape[:2]) for item in items)
+    engine = DucEngine(args.model, plan_buckets(dict((s, 1) for s in shapes.values()), 1),
+                       mx.gpu(args.gpu) if args.gpu >= 0 else mx.cpu(), batch_size=1,
+                       rgb_mean=(122.675, 116.669, 104.008))
+
+    times = dict((mode, 0.0) for mode in modes)
+    confusion = dict((mode, np.zeros((LABEL_NUM, LABEL_NUM), dtype=np.int64)) for mode in modes)
+    agreement = dict((mode, 0) for mode in modes)
+    pixels = 0
+    for n, (image_path, label_path) in enumerate((item[0], item[1]) for item in items):
+        im = cv.imread(image_path)[:, :, ::-1]
+        shape = im.shape[:2]
+        bucket = engine.bucket_for(shape)
+        engine.fill(engine.inputs[bucket][0], im)
+        scores = rearrange(engine.forward(bucket, 1)[0], bucket, cell_shape(*shape))
+        gt = replace_city_labels(np.array(Image.open(label_path))).astype(np.int64)
+
+        reference = None
+        for mode in modes:
+            best = float('inf')
+            for _ in range(args.repeat):
+                tic = time.time()
+                _, labels = score_labels(scores, shape, mode)
+                best = min(best, time.time() - tic)
+            times[mode] += best
+            confusion[mode] += confusion_matrix(gt, labels, LABEL_NUM)
+            if reference is None:
+                reference = labels
+            agreement[mode] += int((labels == reference).sum())
+        pixels += shape[0] * shape[1]
+        if n % 10 == 0:
+            print('%d / %d images' % (n, len(items)))
+
+    base_time, base_iou = times[modes[0]], segmentation_scores(confusion[modes[0]])['mean_iou']
+    print('%-8s %12s %9s %9s %10s %12s' % ('mode', 'ms/image', 'speedup', 'mIoU', 'diff', 'agreement'))
+    for mode in modes:
+        miou = segmentation_scores(confusion[mode])['mean_iou']
+        print('%-8s %12.2f %8.2fx %9.4f %+10.5f %11.4f%%' % (mode, times[mode] * 1e3 / len(items),
+                                                             base_time / times[mode], miou, miou - base_iou,
+                                                             100.0 * agreement[mode] / pixels))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Per-sample latency of the DUC sample pipeline in utils.py.
+
+Times utils.get_single_image_duc on the items of a data list with the
+validation settings of duc-validation (or --scale for the scaled path of
+training), split into the image and label decoding it starts with and the
+rest of the pipeline, and the id to trainId conversion of a full label map.
+
+Run: python benchmark_sample.py --val-list val.lst --data-dir leftImg8bit/val --label-dir gtFine/val --limit 50
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+import utils
+from cityscapes_loader import CityLoader
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the DUC sample pipeline')
+    parser.add_argument('--val-list', default='val.lst', help='data list, as written by duc-validation')
+    parser.add_argument('--data-dir', default='', help='image directory the list is relative to')
+    parser.add_argument('--label-dir', default='', help='label directory the list is relative to')
+    parser.add_argument('--scale', type=float, default=1, help='scale factor of the samples')
+    parser.add_argument('--limit', type=int, default=50, help='number of samples')
+    args = parser.parse_args()
+
+    items = CityLoader.read_data(args.val_list)[:args.limit]
+    input_args = {
+        'data_path': args.data_dir,
+        'label_path': args.label_dir,
+        'rgb_mean': (122.675, 116.669, 104.008),
+        'scale_factors': [args.scale],
+        'data_shape': [(1, 3, 800, 800)],
+        'ds_rate': 8,
+        'convert_label': True,
+        'cell_width': 2,
+        'random_bound': [120, 120],
+    }
+
+    samples, decodes, converts = [], [], []
+    for item in items:
+        tic = time.time()
+        utils.get_single_image_duc(item, input_args)
+        samples.append(time.time() - tic)
+        tic = time.time()
+        cv.imread(os.path.join(args.data_dir, item[0]))
+        label = np.array(Image.open(os.path.join(args.label_dir, item[1])))
+        decodes.append(time.time() - tic)
+        tic = time.time()
+        utils.replace_city_labels(label)
+        converts.append(time.time() - tic)
+
+    samples, decodes = np.array(samples) * 1e3, np.array(decodes) * 1e3
+    converts = np.array(converts) * 1e3
+    print('%-28s %10s %10s' % ('ms', 'p50', 'mean'))
+    print('%-28s %10.2f %10.2f' % ('get_single_image_duc', np.median(samples), samples.mean()))
+    print('%-28s %10.2f %10.2f' % ('  image and label decoding', np.median(decodes), decodes.mean()))
+    print('%-28s %10.2f %10.2f' % ('  rest of the pipeline', np.median(samples - decodes), (samples - decodes).mean()))
+    print('%-28s %10.2f %10.2f' % ('replace_city_labels (full)', np.median(converts), converts.mean()))
+
+
+if __name__ == '__main__':
+    main()
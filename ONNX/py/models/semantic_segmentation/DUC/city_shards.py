@@ -0,0 +1,163 @@
+'''
+Pre-packed Cityscapes shards for the DUC loader
+
+pack_shards() decodes every image / label pair of a data list once and
+writes them into a few large shard files, in the order of the list and with
+the crops of an image sharing one record. With compression 'raw' the records
+are the decoded uint8 arrays, page aligned, and are read straight from the
+memory-mapped shards; with 'png' they are PNGs of compression level 1,
+decoded from the mapped bytes. The offsets are kept in an index JSON:
+
+    <prefix>.json        compression, shard files and records (paths, shard, offsets, shapes)
+    <prefix>-00000.bin   records
+
+CityLoader reads the shards instead of the files with the input arg
+'shard_index': '<prefix>.json'.
+
+Pack: python city_shards.py val.lst val-shards --data-dir leftImg8bit/val --label-dir gtFine/val
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+from PIL import Image
+
+
+COMPRESSIONS = ('raw', 'png')
+ALIGN = 4096
+
+
+def encode(array, compression):
+    if compression == 'raw':
+        return np.ascontiguousarray(array).tobytes()
+    ok, buf = cv.imencode('.png', array, [cv.IMWRITE_PNG_COMPRESSION, 1])
+    if not ok:
+        raise ValueError('png encoding failed')
+    return buf.tobytes()
+
+
+def write_record(f, data):
+    offset = f.tell()
+    f.write(data)
+    pad = -f.tell() % ALIGN
+    if pad:
+        f.write(b'\0' * pad)
+    return offset
+
+
+def read_pairs(data_list):
+    '''
+    image and label paths of the items of a data list, in the format of CityLoader.read_data
+    (parsed here, cityscapes_loader imports this module)
+    '''
+    with open(data_list, 'r') as f:
+        for line in f:
+            frags = line.strip().split('\t')
+            yield frags[1], frags[2]
+
+
+def pack_shards(data_list, prefix, data_path='', label_path='', shard_size=1 << 30, compression='raw'):
+    '''
+    Pack the image / label pairs of a data list into shards of about shard_size bytes
+    input : data list (val.lst / train.lst), output prefix, directories the list is relative to
+    output : path of the index JSON
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError('unknown compression %s, use one of %s' % (compression, ', '.join(COMPRESSIONS)))
+    shards, records, seen = [], [], set()
+    f = None
+    try:
+        for image_file, label_file in read_pairs(data_list):
+            if (image_file, label_file) in seen:
+                continue
+            seen.add((image_file, label_file))
+            im = cv.imread(os.path.join(data_path, image_file))
+            label = np.array(Image.open(os.path.join(label_path, label_file)))
+            im_data, label_data = encode(im, compression), encode(label, compression)
+            if f is None or f.tell() + len(im_data) + len(label_data) > shard_size:
+                if f is not None:
+                    f.close()
+                shards.append('%s-%05d.bin' % (os.path.basename(prefix), len(shards)))
+                f = open(os.path.join(os.path.dirname(prefix), shards[-1]), 'wb')
+            records.append({'image': image_file, 'label': label_file, 'shard': len(shards) - 1,
+                            'image_offset': write_record(f, im_data), 'image_size': len(im_data),
+                            'image_shape': list(im.shape),
+                            'label_offset': write_record(f, label_data), 'label_size': len(label_data),
+                            'label_shape': list(label.shape)})
+    finally:
+        if f is not None:
+            f.close()
+    index_path = prefix + '.json'
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'compression': compression, 'shards': shards, 'records': records}, f)
+    os.rename(index_path + '.tmp', index_path)
+    return index_path
+
+
+class CityShards(object):
+    """
+    Memory-mapped shards of an index JSON, returns the decoded image and label of a data list item
+    """
+    def __init__(self, index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        self.compression = index['compression']
+        self.records = dict(((r['image'], r['label']), r) for r in index['records'])
+        self.order = dict(((r['image'], r['label']), i) for i, r in enumerate(index['records']))
+        root = os.path.dirname(index_path)
+        self.shards = [np.memmap(os.path.join(root, name), dtype=np.uint8, mode='r') for name in index['shards']]
+
+    def position(self, item):
+        '''
+        position of the record of a data list item in the shards, for reading in sequence
+        '''
+        return self.order[(item[0], item[1])]
+
+    def read(self, item):
+        '''
+        input : data list item
+        output : uint8 bgr image, uint8 label ids, read-only views of the shards with 'raw'
+        '''
+        record = self.records[(item[0], item[1])]
+        shard = self.shards[record['shard']]
+        im = shard[record['image_offset']:record['image_offset'] + record['image_size']]
+        label = shard[record['label_offset']:record['label_offset'] + record['label_size']]
+        if self.compression == 'raw':
+            return im.reshape(record['image_shape']), label.reshape(record['label_shape'])
+        return cv.imdecode(im, cv.IMREAD_COLOR), cv.imdecode(label, cv.IMREAD_UNCHANGED)
+
+
+_opened = {}
+
+
+def open_shards(index_path):
+    '''
+    CityShards of an index, opened once per process
+    '''
+    if index_path not in _opened:
+        _opened[index_path] = CityShards(index_path)
+    return _opened[index_path]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pack a DUC data list into Cityscapes shards')
+    parser.add_argument('data_list', help='data list, as written by duc-validation')
+    parser.add_argument('prefix', help='output prefix of the index and shard files')
+    parser.add_argument('--data-dir', default='', help='image directory the list is relative to')
+    parser.add_argument('--label-dir', default='', help='label directory the list is relative to')
+    parser.add_argument('--shard-size', type=int, default=1024, help='shard size in MB')
+    parser.add_argument('--compression', default='raw', choices=COMPRESSIONS, help='record format')
+    args = parser.parse_args()
+    tic = time.time()
+    index_path = pack_shards(args.data_list, args.prefix, args.data_dir, args.label_dir,
+                             args.shard_size << 20, args.compression)
+    print('%s: %.2f s' % (index_path, time.time() - tic))
+
+
+if __name__ == '__main__':
+    main()
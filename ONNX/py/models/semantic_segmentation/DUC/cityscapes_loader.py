@@ -2,15 +2,12 @@ import atexit
 import logging
 import multiprocessing as mp
 import random
+import traceback
 
 import mxnet as mx
 import numpy as np
 
-try:
-    import Queue
-except ImportError:
-    import queue
-
+import city_shards
 import utils
 
 
@@ -19,6 +16,9 @@ class CityLoader(mx.io.DataIter):
     Data Loader class for Cityscapes Dataset.
     Performs loading and preparing of images from the dataset for train/val/test.
     Used in duc-validation.ipynb
+    With multi_thread, n_thread worker processes persist across epochs and write float32 data and uint8
+    labels into a ring of n_slots shared memory batches.
+    With shard_index, the samples are read from the memory-mapped shards of city_shards.py.
     """
     def __init__(self, data_list, input_args):
         super(CityLoader, self).__init__()
@@ -38,13 +38,33 @@ class CityLoader(mx.io.DataIter):
         self.current_batch = None
         self.data_num = None
         self.current = None
+        self.n_slots = input_args.get('n_slots', 3)
+        # with shards the items are read in shard order unless shuffle is set
+        self.shard_index = input_args.get('shard_index')
+        self.shuffle_data = input_args.get('shuffle', not self.shard_index)
         self.worker_proc = None
 
         if self.multi_thread:
-            self.stop_flag = mp.Value('b', False)
-            self.result_queue = mp.Queue(maxsize=self.batch_size*3)
             self.data_queue = mp.Queue()
-            
+            self.result_queue = mp.Queue()
+            # ring of n_slots batches in shared memory, the workers write the samples in place
+            self.slot_data_shape = [(self.n_slots,) + tuple(ds) for ds in self.data_shape]
+            self.slot_label_shape = [(self.n_slots,) + tuple(ls) for ls in self.label_shape]
+            self.slot_data_buffer = [CityLoader._shared_buffer(shape, np.float32) for shape in self.slot_data_shape]
+            self.slot_label_buffer = [CityLoader._shared_buffer(shape, np.uint8) for shape in self.slot_label_shape]
+            self.slot_data = CityLoader._shared_views(self.slot_data_buffer, self.slot_data_shape, np.float32)
+            self.slot_label = CityLoader._shared_views(self.slot_label_buffer, self.slot_label_shape, np.uint8)
+            self.slot_done = [0] * self.n_slots
+            self.pending = 0
+
+    @staticmethod
+    def _shared_buffer(shape, dtype):
+        return mp.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+    @staticmethod
+    def _shared_views(buffers, shapes, dtype):
+        return [np.frombuffer(buf, dtype=dtype).reshape(shape) for buf, shape in zip(buffers, shapes)]
+
     @staticmethod        
     def read_data(data_list):
         data = []
@@ -59,36 +79,55 @@ class CityLoader(mx.io.DataIter):
                 data.append(item)
         return data
     
-    def _insert_queue(self):
-        for item in self.data:
-            self.data_queue.put(item)
-        [self.data_queue.put(self.stop_word) for pid in range(self.n_thread)]
+    def _submit(self, batch):
+        if batch >= self.data_num // self.batch_size:
+            return
+        slot = batch % self.n_slots
+        start = batch * self.batch_size
+        for pos, item in enumerate(self.data[start:start + self.batch_size]):
+            self.data_queue.put((slot, pos, item))
+        self.pending += self.batch_size
+
+    def _collect(self):
+        slot, error = self.result_queue.get()
+        self.pending -= 1
+        if error is not None:
+            raise RuntimeError('CityLoader worker failed:\n' + error)
+        self.slot_done[slot] += 1
 
     def _thread_start(self):
-        self.stop_flag = False
         self.worker_proc = [mp.Process(target=CityLoader._worker,
-                                       args=[pid,
-                                             self.data_queue,
+                                       args=[self.data_queue,
                                              self.result_queue,
                                              self.input_args,
                                              self.stop_word,
-                                             self.stop_flag])
+                                             self.slot_data_buffer,
+                                             self.slot_label_buffer,
+                                             self.slot_data_shape,
+                                             self.slot_label_shape])
                             for pid in range(self.n_thread)]
-        [item.start() for item in self.worker_proc]
+        for worker in self.worker_proc:
+            worker.daemon = True
+            worker.start()
 
         def cleanup():
             self.shutdown()
         atexit.register(cleanup)
 
     @staticmethod
-    def _worker(worker_id, data_queue, result_queue, input_args, stop_word, stop_flag):
-        count = 0
-        for item in iter(data_queue.get, stop_word):
-            if stop_flag == 1:
-                break
-            image, label = CityLoader._get_single(item, input_args)
-            result_queue.put((image, label))
-            count += 1
+    def _worker(data_queue, result_queue, input_args, stop_word, data_buffer, label_buffer, data_shape, label_shape):
+        slot_data = CityLoader._shared_views(data_buffer, data_shape, np.float32)
+        slot_label = CityLoader._shared_views(label_buffer, label_shape, np.uint8)
+        for slot, pos, item in iter(data_queue.get, stop_word):
+            try:
+                image, label = CityLoader._get_single(item, input_args)
+                for j in range(len(image)):
+                    slot_data[j][slot, pos] = image[j]
+                for j in range(len(label)):
+                    slot_label[j][slot, pos] = label[j]
+                result_queue.put((slot, None))
+            except Exception:
+                result_queue.put((slot, traceback.format_exc()))
 
     @property
     def provide_label(self):
@@ -103,37 +142,35 @@ class CityLoader(mx.io.DataIter):
         self.current = 0
         self.shuffle()
         if self.multi_thread:
-            self.shutdown()
-            self._insert_queue()
-            self._thread_start()
+            # the pool lives across epochs, only the samples still in flight are waited for
+            while self.pending > 0:
+                self._collect()
+            self.slot_done = [0] * self.n_slots
+            if self.worker_proc is None:
+                self._thread_start()
+            for batch in range(self.n_slots):
+                self._submit(batch)
 
     def get_batch_size(self):
         return self.batch_size
 
     def shutdown(self):
-        if self.multi_thread:
-            # clean queue
-            while True:
-                try:
-                    self.result_queue.get(timeout=1)
-                except Queue.Empty:
-                    break
-            while True:
-                try:
-                    self.data_queue.get(timeout=1)
-                except Queue.Empty:
-                    break
-            # stop worker
-            self.stop_flag = True
-            if self.worker_proc:
-                for i, worker in enumerate(self.worker_proc):
-                    worker.join(timeout=1)
-                    if worker.is_alive():
-                        logging.error('worker {} is join fail'.format(i))
-                        worker.terminate()
+        if self.multi_thread and self.worker_proc:
+            for _ in self.worker_proc:
+                self.data_queue.put(self.stop_word)
+            for i, worker in enumerate(self.worker_proc):
+                worker.join(timeout=1)
+                if worker.is_alive():
+                    logging.error('worker {} is join fail'.format(i))
+                    worker.terminate()
+            self.worker_proc = None
+            self.pending = 0
 
     def shuffle(self):
-        random.shuffle(self.data)
+        if self.shuffle_data:
+            random.shuffle(self.data)
+        elif self.shard_index:
+            self.data.sort(key=city_shards.open_shards(self.shard_index).position)
 
     def next(self):
         if self._get_next():
@@ -145,25 +182,36 @@ class CityLoader(mx.io.DataIter):
         batch_size = self.batch_size
         if self.current + batch_size > self.data_num:
             return False
-        xs = [np.zeros(ds) for ds in self.data_shape]
-        ys = [np.zeros(ls) for ls in self.label_shape]
-        cnt = 0
-        for i in range(self.current, self.current + batch_size):
-            if self.multi_thread:
-                image, label = self.result_queue.get()
-            else:
+        if self.multi_thread:
+            batch = self.current // batch_size
+            slot = batch % self.n_slots
+            while self.slot_done[slot] < batch_size:
+                self._collect()
+            self.slot_done[slot] = 0
+            # the NDArrays are copied straight from the shared slot, which is then refilled with a later batch
+            xs = [mx.ndarray.array(x[slot]) for x in self.slot_data]
+            ys = [mx.ndarray.array(y[slot]) for y in self.slot_label]
+            self._submit(batch + self.n_slots)
+        else:
+            xs = [np.zeros(ds) for ds in self.data_shape]
+            ys = [np.zeros(ls) for ls in self.label_shape]
+            cnt = 0
+            for i in range(self.current, self.current + batch_size):
                 image, label = CityLoader._get_single(self.data[i], self.input_args)
-            for j in range(len(image)):
-                xs[j][cnt, :, :, :] = image[j]
-            for j in range(len(label)):
-                ys[j][cnt, :] = label[j]
-            cnt += 1
-        xs = [mx.ndarray.array(x) for x in xs]
-        ys = [mx.ndarray.array(y) for y in ys]
+                for j in range(len(image)):
+                    xs[j][cnt, :, :, :] = image[j]
+                for j in range(len(label)):
+                    ys[j][cnt, :] = label[j]
+                cnt += 1
+            xs = [mx.ndarray.array(x) for x in xs]
+            ys = [mx.ndarray.array(y) for y in ys]
         self.current_batch = mx.io.DataBatch(data=xs, label=ys, pad=0, index=None)
         self.current += batch_size
         return True
 
     @staticmethod
     def _get_single(item, input_args):
+        if input_args.get('shard_index'):
+            im, label = city_shards.open_shards(input_args['shard_index']).read(item)
+            return utils.get_single_image_duc(item, input_args, im, label)
         return utils.get_single_image_duc(item, input_args)
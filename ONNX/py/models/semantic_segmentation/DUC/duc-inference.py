@@ -31,15 +31,18 @@
 # In[1]:
 
 
+import sys
 import mxnet as mx
 import cv2 as cv
 import numpy as np
 import os
 from PIL import Image
 import math
-from collections import namedtuple
-from mxnet.contrib.onnx import import_model
+# onnx_cache and onnx_backend are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from onnx_backend import create_backend
 import cityscapes_labels
+from duc_labels import score_labels
 
 
 # ### Preprocess image
@@ -94,7 +97,7 @@ def colorize(labels):
     result_img.putpalette(get_palette())
     return np.array(result_img.convert('RGB'))
 
-def predict(imgs):
+def predict(imgs, mode='exact'):
     # get input and output dimensions
     result_height, result_width = result_shape
     _, _, img_height, img_width = imgs.shape
@@ -106,9 +109,7 @@ def predict(imgs):
     label_num = 19
     
     # Perform forward pass
-    batch = namedtuple('Batch', ['data'])
-    mod.forward(batch([imgs]),is_train=False)
-    labels = mod.get_outputs()[0].asnumpy().squeeze()
+    labels = mod.run(imgs)[0].squeeze()
 
     # re-arrange output
     test_width = int((int(img_width) / ds_rate) * ds_rate)
@@ -120,19 +121,9 @@ def predict(imgs):
     labels = labels.reshape((label_num, int(test_height / cell_width), int(test_width / cell_width)))
 
     labels = labels[:, :int(img_height / cell_width),:int(img_width / cell_width)]
-    labels = np.transpose(labels, [1, 2, 0])
-    labels = cv.resize(labels, (result_width, result_height), interpolation=cv.INTER_LINEAR)
-    labels = np.transpose(labels, [2, 0, 1])
-    
-    # get softmax output
-    softmax = labels
-    
-    # get classification labels
-    results = np.argmax(labels, axis=0).astype(np.uint8)
-    raw_labels = results
-
-    # comput confidence score
-    confidence = float(np.max(softmax, axis=0).mean())
+    # get confidence score and classification labels at the output resolution,
+    # mode 'nearest' or 'refined' takes the argmax at cell resolution (see duc_labels.py)
+    confidence, raw_labels = score_labels(labels, (result_height, result_width), mode)
 
     # generate segmented image
     result_img = Image.fromarray(colorize(raw_labels)).resize(result_shape[::-1])
@@ -144,20 +135,15 @@ def predict(imgs):
 
 
 # ### Load pretrained model
-# `get_model()` : Imports ONNX model into MXNet symbols and params, defines model using symbol file and binds parameters to the model using params file.
+# `get_model()` : Imports ONNX model into MXNet symbols and params, defines model using symbol file and binds parameters to the model using params file. With `backend='onnxruntime'` the model runs in an onnxruntime session instead.
 
 # In[4]:
 
 
-def get_model(ctx, model_path):
-    # import ONNX model into MXNet symbols and params
-    sym,arg,aux = import_model(model_path)
-    # define network module
-    mod = mx.mod.Module(symbol=sym, data_names=['data'], context=ctx, label_names=None)
-    # bind parameters to the network
-    mod.bind(for_training=False, data_shapes=[('data', (1, 3, im.shape[0], im.shape[1]))], label_shapes=mod._label_shapes)
-    mod.set_params(arg_params=arg, aux_params=aux,allow_missing=True, allow_extra=True)
-    return mod
+def get_model(ctx, model_path, backend='mxnet', **options):
+    # import ONNX model into MXNet symbols and params, define the network module and bind its parameters,
+    # or open an onnxruntime session; options go to create_backend
+    return create_backend(backend, model_path, (1, 3, im.shape[0], im.shape[1]), ctx, **options)
 
 
 # ### Download and display input image
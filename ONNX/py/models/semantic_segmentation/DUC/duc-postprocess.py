@@ -1,7 +1,9 @@
+import math
 import numpy as np
 import cv2 as cv
 from PIL import Image
 import cityscapes_labels
+from duc_labels import score_labels
 
 def get_palette():
     # get train id to color mappings from file
@@ -22,10 +24,12 @@ def colorize(labels):
     result_img.putpalette(get_palette())
     return np.array(result_img.convert('RGB'))
 
-def postprocess(labels,img_shape,result_shape):
+def postprocess(labels,img_shape,result_shape,crop_shape=None,mode='exact'):
     '''
     Postprocessing function for DUC
-    input : output labels from the network as numpy array, input image shape, desired output image shape
+    input : output labels from the network as numpy array, input image shape, desired output image shape,
+            shape of the image inside a padded (bucket) input, the whole input when None,
+            label upsampling: 'exact', or the faster 'nearest' / 'refined' (see duc_labels.py)
     output : confidence score, segmented image, blended image, raw segmentation labels
     '''
     ds_rate = 8
@@ -33,6 +37,7 @@ def postprocess(labels,img_shape,result_shape):
     cell_width = 2
     img_height,img_width = img_shape
     result_height,result_width = result_shape
+    crop_height,crop_width = crop_shape if crop_shape is not None else img_shape
 
     # re-arrange output
     test_width = int((int(img_width) / ds_rate) * ds_rate)
@@ -43,20 +48,10 @@ def postprocess(labels,img_shape,result_shape):
     labels = np.transpose(labels, (0, 3, 1, 4, 2))
     labels = labels.reshape((label_num, int(test_height / cell_width), int(test_width / cell_width)))
 
-    labels = labels[:, :int(img_height / cell_width),:int(img_width / cell_width)]
-    labels = np.transpose(labels, [1, 2, 0])
-    labels = cv.resize(labels, (result_width, result_height), interpolation=cv.INTER_LINEAR)
-    labels = np.transpose(labels, [2, 0, 1])
-    
-    # get softmax output
-    softmax = labels
-    
-    # get classification labels
-    results = np.argmax(labels, axis=0).astype(np.uint8)
-    raw_labels = results
-
-    # comput confidence score
-    confidence = float(np.max(softmax, axis=0).mean())
+    # drop the bucket padding
+    labels = labels[:, :int(math.ceil(crop_height / float(ds_rate)) * ds_rate / cell_width),:int(math.ceil(crop_width / float(ds_rate)) * ds_rate / cell_width)]
+    # get confidence score and classification labels at the output resolution
+    confidence, raw_labels = score_labels(labels, (result_height, result_width), mode)
 
     # generate segmented image
     result_img = Image.fromarray(colorize(raw_labels)).resize(result_shape[::-1])
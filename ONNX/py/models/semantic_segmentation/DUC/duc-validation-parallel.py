@@ -0,0 +1,152 @@
+'''
+Parallel DUC validation: the mIOU of duc-validation with N worker processes.
+
+The data list (val.lst, as written by duc-validation) is split into N
+contiguous runs of whole batches. Every worker sets its MXNet / OpenMP thread
+count before importing MXNet, binds its own module and accumulates the
+confusion matrix of its run; the matrices are added up at the end. The
+samples evaluated are those of a single process run without shuffling, so
+the mIOU is the same for any number of workers, and the same as the one of
+duc-validation when --batch-size is its batch_size (16): both drop the
+incomplete last batch. The default of 1 evaluates every image.
+
+The per-worker and total wall-clock times are printed, to check the scaling
+with --workers on the target machine.
+
+Run: python duc-validation-parallel.py --model ResNet101_DUC_HDC.onnx --data-dir leftImg8bit/val --label-dir gtFine/val --workers 8 --threads 4
+     python duc-validation-parallel.py --model ResNet101_DUC_HDC.onnx --workers 2 --gpus 0,1
+'''
+from __future__ import print_function
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+# onnx_cache and onnx_backend are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+
+
+def worker_ranges(num_items, batch_size, workers):
+    '''
+    [start, stop) item ranges of whole batches for every worker, the incomplete last batch is dropped
+    like CityLoader does
+    '''
+    bounds = np.linspace(0, num_items // batch_size, workers + 1).astype(int) * batch_size
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def evaluate(rank, args, start, stop, result_queue):
+    try:
+        # thread counts are read once when MXNet starts
+        if args.threads > 0:
+            os.environ['OMP_NUM_THREADS'] = str(args.threads)
+            os.environ['MXNET_CPU_WORKER_NTHREADS'] = str(args.threads)
+        import mxnet as mx
+        from cityscapes_loader import CityLoader
+        from duc_metric import IoUMetric
+        from onnx_cache import import_model
+
+        gpus = [int(g) for g in args.gpus.split(',')] if args.gpus else []
+        ctx = mx.gpu(gpus[rank % len(gpus)]) if gpus else mx.cpu()
+        loader = CityLoader(args.val_list, {
+            'data_path': args.data_dir,
+            'label_path': args.label_dir,
+            'rgb_mean': (122.675, 116.669, 104.008),
+            'batch_size': args.batch_size,
+            'scale_factors': [1],
+            'data_name': ['data'],
+            'label_name': ['seg_loss_label'],
+            'data_shape': [(args.batch_size, 3, 800, 800)],
+            'label_shape': [(args.batch_size, 160000)],
+            'use_random_crop': False,
+            'use_mirror': False,
+            'ds_rate': 8,
+            'convert_label': True,
+            'multi_thread': args.loader_threads > 0,
+            'n_thread': args.loader_threads,
+            'cell_width': 2,
+            'random_bound': [120, 120],
+            'shard_index': args.shard_index,
+            'shuffle': False,
+        })
+        loader.data = loader.data[start:stop]
+
+        sym, arg, aux = import_model(args.model)
+        mod = mx.mod.Module(symbol=sym, data_names=['data'], context=ctx, label_names=None)
+        mod.bind(for_training=False, data_shapes=[('data', (args.batch_size, 3, 800, 800))],
+                 label_shapes=mod._label_shapes)
+        mod.set_params(arg_params=arg, aux_params=aux, allow_missing=True, allow_extra=True)
+
+        metric = IoUMetric(ignore_label=255, label_num=19, name='IoU')
+        tic = time.time()
+        loader.reset()
+        for nbatch, eval_batch in enumerate(loader):
+            mod.forward(eval_batch, is_train=False)
+            metric.update(eval_batch.label, mod.get_outputs())
+            if nbatch % 10 == 0:
+                print('worker {}: {} / {} batches done'.format(rank, nbatch, (stop - start) // args.batch_size))
+        loader.shutdown()
+        result_queue.put((rank, metric.confusion, metric.num_inst, time.time() - tic, None))
+    except Exception:
+        result_queue.put((rank, None, 0, 0.0, traceback.format_exc()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='validate the DUC model with several worker processes')
+    parser.add_argument('--model', default='ResNet101_DUC_HDC.onnx', help='DUC onnx model')
+    parser.add_argument('--val-list', default='val.lst', help='validation list, as written by duc-validation')
+    parser.add_argument('--data-dir', default='', help='image directory the list is relative to')
+    parser.add_argument('--label-dir', default='', help='label directory the list is relative to')
+    parser.add_argument('--shard-index', default=None, help='read the samples from the shards of city_shards.py')
+    parser.add_argument('--workers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=0, help='MXNet / OpenMP threads per worker, 0 for the default')
+    parser.add_argument('--loader-threads', type=int, default=0, help='CityLoader processes per worker, 0 in process')
+    parser.add_argument('--gpus', default='', help='comma separated gpu ids the workers are spread over, cpu if empty')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size of every worker')
+    args = parser.parse_args()
+
+    from cityscapes_loader import CityLoader
+    from duc_metric import IoUMetric
+    from onnx_cache import import_model
+
+    # convert the model once, the workers load it from the cache
+    import_model(args.model)
+
+    ranges = worker_ranges(len(CityLoader.read_data(args.val_list)), args.batch_size, args.workers)
+    # spawned workers start MXNet from scratch with their own thread counts
+    context = mp.get_context('spawn')
+    result_queue = context.Queue()
+    tic = time.time()
+    workers = [context.Process(target=evaluate, args=(rank, args, start, stop, result_queue))
+               for rank, (start, stop) in enumerate(ranges)]
+    for worker in workers:
+        worker.start()
+
+    metric = IoUMetric(ignore_label=255, label_num=19, name='IoU')
+    for _ in workers:
+        rank, confusion, num_inst, elapsed, error = result_queue.get()
+        if error is not None:
+            for worker in workers:
+                worker.terminate()
+            raise RuntimeError('worker {} failed:\n{}'.format(rank, error))
+        metric.update_confusion(confusion, num_inst)
+        print('worker {}: {} samples in {:.1f} s'.format(rank, num_inst, elapsed))
+    for worker in workers:
+        worker.join()
+
+    scores = metric.scores()
+    print('{} samples, {} workers: {:.1f} s'.format(metric.num_inst, len(workers), time.time() - tic))
+    print("mean Intersection Over Union (mIOU): {}".format(scores['mean_iou']))
+    print("mIOU of the classes in the ground truth or the predictions: {}".format(scores['mean_iou_present']))
+    print("pixel accuracy: {}".format(scores['pixel_accuracy']))
+    print("frequency weighted IoU: {}".format(scores['fw_iou']))
+    print("per class IoU: {}".format(np.round(scores['iou'], 4).tolist()))
+
+
+if __name__ == '__main__':
+    main()
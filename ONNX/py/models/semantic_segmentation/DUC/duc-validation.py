@@ -22,6 +22,7 @@
 # * `cityscapes_loader.py` (load and prepare validation images and labels)
 # * `utils.py` (helper script used by `cityscapes_loader.py`)
 # * `cityscapes_labels.py` (contains segmentation category labels)
+# * `duc_metric.py` (confusion matrix based mIOU metric)
 # 
 # The validation set of Cityscapes must be prepared before proceeding. Follow guidelines in the [dataset](README.md/#dset) section.
 # 
@@ -36,12 +37,16 @@
 
 
 from __future__ import print_function
+import sys
 import mxnet as mx
 import numpy as np
 import glob
 import os
-from mxnet.contrib.onnx import import_model
+# onnx_cache and onnx_backend are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from onnx_cache import import_model
 from cityscapes_loader import CityLoader
+from duc_metric import IoUMetric
 
 
 # ### Set paths and parameters
@@ -98,57 +103,12 @@ for line in val_lst:
 
 
 # ### Define evaluation metric
-# `class IoUMetric` : Defines mean Intersection Over Union (mIOU) custom evaluation metric.
-# 
-# `check_label_shapes` : Checks the shape of target labels and network output.
+# `IoUMetric` (duc_metric.py) : mean Intersection Over Union (mIOU) custom evaluation metric. Every batch adds its
+# confusion matrix, built with a single bincount, and mIOU, pixel accuracy and frequency weighted IoU derive from it.
 
 # In[3]:
 
 
-def check_label_shapes(labels, preds, shape=0):
-    if shape == 0:
-        label_shape, pred_shape = len(labels), len(preds)
-    else:
-        label_shape, pred_shape = labels.shape, preds.shape
-
-    if label_shape != pred_shape:
-        raise ValueError("Shape of labels {} does not match shape of "
-                         "predictions {}".format(label_shape, pred_shape))
-
-class IoUMetric(mx.metric.EvalMetric):
-    def __init__(self, ignore_label, label_num, name='IoU'):
-        self._ignore_label = ignore_label
-        self._label_num = label_num
-        super(IoUMetric, self).__init__(name=name)
-
-    def reset(self):
-        self._tp = [0.0] * self._label_num
-        self._denom = [0.0] * self._label_num
-
-    def update(self, labels, preds):
-        check_label_shapes(labels, preds)
-        for i in range(len(labels)):
-            pred_label = mx.ndarray.argmax_channel(preds[i]).asnumpy().astype('int32')
-            label = labels[i].asnumpy().astype('int32')
-
-            check_label_shapes(label, pred_label)
-
-            iou = 0
-            eps = 1e-6
-            for j in range(self._label_num):
-                pred_cur = (pred_label.flat == j)
-                gt_cur = (label.flat == j)
-                tp = np.logical_and(pred_cur, gt_cur).sum()
-                denom = np.logical_or(pred_cur, gt_cur).sum() - np.logical_and(pred_cur, label.flat == self._ignore_label).sum()
-                assert tp <= denom
-                self._tp[j] += tp
-                self._denom[j] += denom
-                iou += self._tp[j] / (self._denom[j] + eps)
-            iou /= self._label_num
-            self.sum_metric = iou
-            self.num_inst = 1
-
-            
 # Create evaluation metric
 met = IoUMetric(ignore_label=255, label_num=19, name="IoU")
 metric = mx.metric.create(met)
@@ -178,6 +138,9 @@ val_args = {
     'multi_thread'          : False,
     'cell_width'            : 2,
     'random_bound'          : [120,120],
+    # keep the list order: the incomplete last batch is dropped, duc-validation-parallel.py with the same
+    # --batch-size then evaluates the same samples and gives the same mIOU
+    'shuffle'               : False,
 }
 val_dataloader = loader('val.lst', val_args)
 
@@ -224,7 +187,12 @@ for nbatch, eval_batch in enumerate(val_dataloader):
 # In[7]:
 
 
-print("mean Intersection Over Union (mIOU): {}".format(metric.get()[1]))
+scores = metric.scores()
+print("mean Intersection Over Union (mIOU): {}".format(scores['mean_iou']))
+print("mIOU of the classes in the ground truth or the predictions: {}".format(scores['mean_iou_present']))
+print("pixel accuracy: {}".format(scores['pixel_accuracy']))
+print("frequency weighted IoU: {}".format(scores['fw_iou']))
+print("per class IoU: {}".format(np.round(scores['iou'], 4).tolist()))
 
 
 # In[ ]:
@@ -0,0 +1,304 @@
+'''
+Shape-bucketed batched inference for the DUC models
+
+Images of any resolution are padded to the smallest of a few multiple-of-8
+shape buckets that holds them, images of the same bucket run together in
+batches, and every output is cropped back to its image before it is resized
+to the original resolution. The buckets are bound once, as the keys of a
+BucketingModule sharing the parameters and memory of the largest one.
+
+predict_tiled() runs very large images as overlapping tiles through the
+executor of one bucket and streams the label map band by band, its memory
+is bounded by the tile size and the image width instead of the image size.
+
+Plan the buckets from a traffic profile (JSON {"HxW": count} or [[h, w], ...]):
+    python duc_engine.py --profile traffic.json --max-buckets 4
+or from the images themselves:
+    python duc_engine.py --images frames/*.png --max-buckets 4
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import sys
+from collections import Counter
+
+import cv2 as cv
+import mxnet as mx
+import numpy as np
+
+from duc_labels import score_labels
+# onnx_cache and onnx_backend are shared by the models, in models/common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+from onnx_cache import import_model
+
+# DUC output: label_num x 4 x 4 cells per position of the 1/8 feature map, one cell is 2 x 2 pixels
+DS_RATE = 8
+CELL_WIDTH = 2
+LABEL_NUM = 19
+
+
+def cell_shape(height, width):
+    # the network needs multiples of the downsampling rate
+    return (int(math.ceil(height / float(DS_RATE))) * DS_RATE, int(math.ceil(width / float(DS_RATE))) * DS_RATE)
+
+
+def load_profile(path):
+    '''
+    Image shapes and their counts from a traffic profile, {"HxW": count} or a list of [h, w]
+    '''
+    with open(path) as f:
+        profile = json.load(f)
+    if isinstance(profile, dict):
+        return Counter(dict((tuple(int(x) for x in k.split('x')), v) for k, v in profile.items()))
+    return Counter(tuple(shape) for shape in profile)
+
+
+def padding_cost(shapes, buckets):
+    '''
+    Padded pixels of the traffic when every image goes to the smallest bucket holding it
+    '''
+    cost = 0
+    for (h, w), count in shapes.items():
+        areas = [bh * bw for bh, bw in buckets if bh >= h and bw >= w]
+        cost += (min(areas) - h * w) * count
+    return cost
+
+
+def plan_buckets(shapes, max_buckets=4):
+    '''
+    Pick at most max_buckets bucket shapes for the traffic
+    Starts from the bucket holding every image and greedily adds the image shape that removes the most
+    padded pixels, until max_buckets or no shape helps anymore
+    input : Counter of (height, width) image shapes
+    output : bucket shapes (multiples of 8), smallest area first
+    '''
+    cells = Counter()
+    for (h, w), count in shapes.items():
+        cells[cell_shape(h, w)] += count
+    buckets = [(max(h for h, _ in cells), max(w for _, w in cells))]
+    cost = padding_cost(cells, buckets)
+    while len(buckets) < max_buckets:
+        candidates = [shape for shape in cells if shape not in buckets]
+        if not candidates:
+            break
+        best_cost, best = min((padding_cost(cells, buckets + [shape]), shape) for shape in candidates)
+        if best_cost >= cost:
+            break
+        buckets.append(best)
+        cost = best_cost
+    return sorted(buckets, key=lambda shape: (shape[0] * shape[1], shape))
+
+
+def rearrange(output, input_shape, crop_shape):
+    '''
+    Network output (label_num * 16, h / 8, w / 8) of an input of input_shape into the (label_num, h / 2, w / 2)
+    score map, cropped to crop_shape / 2
+    '''
+    height, width = input_shape
+    labels = output.reshape((LABEL_NUM, 4, 4, height // DS_RATE, width // DS_RATE))
+    labels = np.transpose(labels, (0, 3, 1, 4, 2))
+    labels = labels.reshape((LABEL_NUM, height // CELL_WIDTH, width // CELL_WIDTH))
+    return labels[:, :crop_shape[0] // CELL_WIDTH, :crop_shape[1] // CELL_WIDTH]
+
+
+def tile_positions(length, tile, stride):
+    # the last tile ends at the border
+    positions = list(range(0, length - tile + 1, stride))
+    if positions[-1] != length - tile:
+        positions.append(length - tile)
+    return positions
+
+
+def blend_window(length, ramp):
+    '''
+    Tile weights along one axis, rising linearly over ramp cells from both ends, never zero
+    '''
+    pos = np.arange(length, dtype=np.float32)
+    return np.minimum(np.minimum(pos + 1, length - pos), max(ramp, 1)) / max(ramp, 1)
+
+
+class DucEngine(object):
+    """
+    Batched DUC inference over shape buckets
+    """
+    def __init__(self, model_path, buckets, ctx=None, batch_size=4, rgb_mean=None, label_mode='exact'):
+        '''
+        model_path : DUC onnx model
+        buckets : (height, width) bucket shapes, multiples of 8, e.g. from plan_buckets
+        ctx : device, cpu by default
+        batch_size : images per forward pass, partial batches are padded
+        rgb_mean : mean subtracted from the images, the mean of every image when None
+        label_mode : 'exact', 'nearest' or 'refined' label upsampling of predict, see duc_labels.py
+        '''
+        self.buckets = sorted(set(tuple(int(x) for x in b) for b in buckets), key=lambda shape: shape[0] * shape[1])
+        for h, w in self.buckets:
+            assert h % DS_RATE == 0 and w % DS_RATE == 0, 'bucket %dx%d is not a multiple of %d' % (h, w, DS_RATE)
+        self.batch_size = batch_size
+        self.rgb_mean = rgb_mean
+        self.label_mode = label_mode
+
+        sym, arg, aux = import_model(model_path)
+        largest = self.buckets[-1]
+        self.mod = mx.mod.BucketingModule(lambda key: (sym, ('data',), None), default_bucket_key=largest,
+                                          context=ctx or mx.cpu())
+        self.mod.bind(data_shapes=[('data', (batch_size, 3) + largest)], for_training=False)
+        self.mod.set_params(arg, aux, allow_missing=True, allow_extra=True)
+        for bucket in self.buckets:
+            # bind every bucket now, they share the memory of the largest one
+            self.mod.switch_bucket(bucket, [('data', (batch_size, 3) + bucket)])
+        self.inputs = dict((bucket, np.zeros((batch_size, 3) + bucket, dtype=np.float32)) for bucket in self.buckets)
+
+    def bucket_for(self, shape):
+        h, w = cell_shape(shape[0], shape[1])
+        for bucket in self.buckets:
+            if bucket[0] >= h and bucket[1] >= w:
+                return bucket
+        raise ValueError('image of %dx%d is larger than every bucket' % (shape[0], shape[1]))
+
+    def fill(self, buf, im):
+        '''
+        Write the mean subtracted image into the top left of buf (3 x bucket), zeros around it
+        '''
+        self.fill_tile(buf, im, 0, 0, self.rgb_mean if self.rgb_mean is not None else cv.mean(im)[:3])
+
+    def fill_tile(self, buf, im, y, x, rgb_mean):
+        '''
+        Write the mean subtracted window of im at (y, x) into buf (3 x tile), zeros past the image
+        '''
+        h = max(0, min(buf.shape[1], im.shape[0] - y))
+        w = max(0, min(buf.shape[2], im.shape[1] - x))
+        buf[...] = 0
+        buf[:, :h, :w] = np.transpose(im[y:y + h, x:x + w], (2, 0, 1))
+        buf[:, :h, :w] -= np.asarray(rgb_mean, dtype=np.float32)[:, None, None]
+
+    def forward(self, bucket, num):
+        data = self.inputs[bucket]
+        batch = mx.io.DataBatch(data=[mx.nd.array(data)], bucket_key=bucket,
+                                provide_data=[mx.io.DataDesc('data', data.shape)])
+        self.mod.forward(batch, is_train=False)
+        return self.mod.get_outputs()[0][:num].asnumpy()
+
+    def postprocess(self, output, bucket, shape):
+        '''
+        Output of one image into its confidence score and raw segmentation labels at the original resolution
+        '''
+        return score_labels(rearrange(output, bucket, cell_shape(shape[0], shape[1])), shape, self.label_mode)
+
+    def predict(self, images):
+        '''
+        input : list of h x w x 3 rgb images of any sizes within the buckets
+        output : list of (confidence, raw segmentation labels) in the order of the images
+        '''
+        groups = {}
+        for i, im in enumerate(images):
+            groups.setdefault(self.bucket_for(im.shape), []).append(i)
+        results = [None] * len(images)
+        for bucket, indices in groups.items():
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                for j, i in enumerate(batch):
+                    self.fill(self.inputs[bucket][j], images[i])
+                outputs = self.forward(bucket, len(batch))
+                for j, i in enumerate(batch):
+                    results[i] = self.postprocess(outputs[j], bucket, images[i].shape[:2])
+        return results
+
+    def predict_tiled(self, im, tile=(512, 512), overlap=64, out=None, rows_per_step=16):
+        '''
+        Sliding window inference of one large image
+        input : h x w x 3 rgb image, tile shape (one of the buckets), overlap of neighbouring tiles
+                (multiple of 8), optional h x w uint8 output (e.g. a memmap),
+                score map rows upsampled at once
+        output : confidence score, raw segmentation labels (out)
+        The tiles of a band run in batches, their scores (at half resolution, as the network gives them) are
+        blended with weights ramping over the overlap, and the rows no later band overlaps are upsampled by 2
+        and turned into labels right away. Peak memory: one batch of tiles and label_num x tile height x image
+        width scores; the full resolution score map is never held.
+        '''
+        tile = tuple(tile)
+        assert tile in self.buckets, 'tile %dx%d is not a bucket of the engine' % tile
+        assert overlap % DS_RATE == 0 and 0 <= overlap < min(tile), 'overlap has to be a multiple of 8 below the tile size'
+        height, width = im.shape[:2]
+        cells = cell_shape(height, width)
+        padded = (max(cells[0], tile[0]), max(cells[1], tile[1]))
+        ys = tile_positions(padded[0], tile[0], tile[0] - overlap)
+        xs = tile_positions(padded[1], tile[1], tile[1] - overlap)
+        rgb_mean = self.rgb_mean if self.rgb_mean is not None else cv.mean(im)[:3]
+        if out is None:
+            out = np.empty((height, width), dtype=np.uint8)
+
+        tile_h, tile_w = tile[0] // CELL_WIDTH, tile[1] // CELL_WIDTH
+        weight = np.outer(blend_window(tile_h, overlap // (2 * CELL_WIDTH)), blend_window(tile_w, overlap // (2 * CELL_WIDTH)))
+        scores = np.zeros((LABEL_NUM, tile_h, padded[1] // CELL_WIDTH), dtype=np.float32)
+        weights = np.zeros((tile_h, padded[1] // CELL_WIDTH), dtype=np.float32)
+        state = {'prev': None, 'next': 0, 'first': 0, 'confidence': 0.0}
+
+        for k, y in enumerate(ys):
+            for start in range(0, len(xs), self.batch_size):
+                batch = xs[start:start + self.batch_size]
+                for j, x in enumerate(batch):
+                    self.fill_tile(self.inputs[tile][j], im, y, x, rgb_mean)
+                outputs = self.forward(tile, len(batch))
+                for j, x in enumerate(batch):
+                    cols = slice(x // CELL_WIDTH, x // CELL_WIDTH + tile_w)
+                    scores[:, :, cols] += rearrange(outputs[j], tile, tile) * weight
+                    weights[:, cols] += weight
+
+            # rows [y, next band) are final
+            last = k == len(ys) - 1
+            done = tile_h if last else (ys[k + 1] - y) // CELL_WIDTH
+            for row in range(0, done, rows_per_step):
+                end = min(row + rows_per_step, done)
+                self.emit_rows(scores[:, row:end] / weights[row:end], last and end == done, state, out)
+            scores[:, :tile_h - done] = scores[:, done:]
+            scores[:, tile_h - done:] = 0
+            weights[:tile_h - done] = weights[done:]
+            weights[tile_h - done:] = 0
+        return state['confidence'] / (height * width), out
+
+    def emit_rows(self, rows, last, state, out):
+        '''
+        Upsample the next final half resolution score rows by 2 and write their labels into out
+        The previous row is kept as context, a full resolution row is written once both half resolution
+        rows it interpolates are final, so the result is the same as resizing the whole score map
+        '''
+        region = rows if state['prev'] is None else np.concatenate([state['prev'], rows], axis=1)
+        up = cv.resize(np.transpose(region, (1, 2, 0)), (region.shape[2] * CELL_WIDTH, region.shape[1] * CELL_WIDTH),
+                       interpolation=cv.INTER_LINEAR)
+        # region row 0 is half resolution row state['first']
+        stop = state['first'] + region.shape[1]
+        begin, end = state['next'], stop * CELL_WIDTH if last else stop * CELL_WIDTH - 1
+        end_out = min(end, out.shape[0])
+        if end_out > begin:
+            up = up[begin - state['first'] * CELL_WIDTH:end_out - state['first'] * CELL_WIDTH, :out.shape[1]]
+            out[begin:end_out] = np.argmax(up, axis=2)
+            state['confidence'] += float(np.max(up, axis=2).sum())
+        state['prev'] = rows[:, -1:]
+        state['first'] = stop - 1
+        state['next'] = end
+
+
+def main():
+    parser = argparse.ArgumentParser(description='plan DUC shape buckets from a traffic profile')
+    parser.add_argument('--profile', default='', help='JSON traffic profile, {"HxW": count} or [[h, w], ...]')
+    parser.add_argument('--images', nargs='*', default=[], help='images to build the profile from')
+    parser.add_argument('--max-buckets', type=int, default=4, help='number of buckets')
+    args = parser.parse_args()
+
+    if args.profile:
+        shapes = load_profile(args.profile)
+    else:
+        shapes = Counter(cv.imread(path).shape[:2] for path in args.images)
+    pixels = sum(h * w * count for (h, w), count in shapes.items())
+    for num in range(1, args.max_buckets + 1):
+        buckets = plan_buckets(shapes, num)
+        print('%d buckets %s  padding %.1f%%' % (len(buckets), ' '.join('%dx%d' % b for b in buckets),
+                                                 100.0 * padding_cost(shapes, buckets) / pixels))
+    print(json.dumps(plan_buckets(shapes, args.max_buckets)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Label maps from DUC score maps
+
+The network scores every 2 x 2 pixel cell of the image (label_num x h/2 x w/2
+after the DUC rearrangement). The modes differ in how they get to full
+resolution:
+
+    exact    resize all label_num score planes bilinearly, then argmax (the original postprocess)
+    nearest  argmax at cell resolution, resize the uint8 label map with nearest neighbour
+    refined  label of the cells a pixel interpolates when they all agree, which is the argmax of
+             the interpolated scores too; only the pixels between cells of different labels are
+             recomputed from their bilinearly interpolated scores, the labels are those of exact
+
+nearest and refined give the confidence at cell resolution.
+'''
+import cv2 as cv
+import numpy as np
+
+
+MODES = ('exact', 'nearest', 'refined')
+
+
+def argmax_max(scores):
+    '''
+    uint8 argmax and max over the label axis, a pass per label is faster than argmax over the outer axis
+    '''
+    best = scores[0].copy()
+    labels = np.zeros(best.shape, dtype=np.uint8)
+    for k in range(1, scores.shape[0]):
+        better = scores[k] > best
+        labels[better] = k
+        np.maximum(best, scores[k], out=best)
+    return labels, best
+
+
+def exact_labels(scores, shape):
+    up = cv.resize(np.transpose(scores, (1, 2, 0)), (shape[1], shape[0]), interpolation=cv.INTER_LINEAR)
+    return float(np.max(up, axis=2).mean()), np.argmax(up, axis=2).astype(np.uint8)
+
+
+def nearest_labels(scores, shape):
+    low, best = argmax_max(scores)
+    return float(best.mean()), cv.resize(low, (shape[1], shape[0]), interpolation=cv.INTER_NEAREST)
+
+
+def linear_coords(dst, src):
+    '''
+    Source index pairs and weights of cv.INTER_LINEAR along one axis, for the dst output positions
+    '''
+    pos = (np.arange(dst, dtype=np.float64) + 0.5) * (float(src) / dst) - 0.5
+    lo = np.floor(pos).astype(np.int64)
+    frac = (pos - lo).astype(np.float32)
+    frac[lo < 0] = 0
+    lo = np.clip(lo, 0, src - 1)
+    frac[lo >= src - 1] = 0
+    return lo, np.minimum(lo + 1, src - 1), frac
+
+
+def refined_labels(scores, shape):
+    low, best = argmax_max(scores)
+    y0, y1, fy = linear_coords(shape[0], scores.shape[1])
+    x0, x1, fx = linear_coords(shape[1], scores.shape[2])
+    # labels of the 4 cells every pixel interpolates, they agree away from boundaries
+    top, bottom = low[y0], low[y1]
+    labels = top[:, x0]
+    mixed = (labels != top[:, x1]) | (labels != bottom[:, x0]) | (labels != bottom[:, x1])
+    ys, xs = np.nonzero(mixed)
+    if ys.size > 0:
+        y0, y1, fy = y0[ys], y1[ys], fy[ys, None]
+        x0, x1, fx = x0[xs], x1[xs], fx[xs, None]
+        # label_num contiguous scores per cell for the gathers
+        cells = np.ascontiguousarray(np.transpose(scores, (1, 2, 0)))
+        top = cells[y0, x0] * (1 - fx) + cells[y0, x1] * fx
+        bottom = cells[y1, x0] * (1 - fx) + cells[y1, x1] * fx
+        labels[ys, xs] = np.argmax(top * (1 - fy) + bottom * fy, axis=1)
+    return float(best.mean()), labels
+
+
+def score_labels(scores, shape, mode='exact'):
+    '''
+    Confidence and uint8 label map of a score map
+    input : label_num x h x w scores, (height, width) of the label map, one of MODES
+    output : confidence score, height x width raw segmentation labels
+    '''
+    if mode == 'exact':
+        return exact_labels(scores, shape)
+    if mode == 'nearest':
+        return nearest_labels(scores, shape)
+    if mode == 'refined':
+        return refined_labels(scores, shape)
+    raise ValueError('unknown label mode %s, use one of %s' % (mode, ', '.join(MODES)))
@@ -0,0 +1,97 @@
+'''
+Confusion matrix based segmentation metrics for the DUC validation
+
+Every update adds the label_num x label_num confusion matrix of a batch,
+built with one np.bincount over label * label_num + prediction, ignored
+pixels masked out. All the metrics derive from the accumulated int64
+matrix, and the matrices of several evaluation workers add up with merge().
+'''
+import mxnet as mx
+import numpy as np
+
+
+def check_label_shapes(labels, preds, shape=0):
+    if shape == 0:
+        label_shape, pred_shape = len(labels), len(preds)
+    else:
+        label_shape, pred_shape = labels.shape, preds.shape
+
+    if label_shape != pred_shape:
+        raise ValueError("Shape of labels {} does not match shape of "
+                         "predictions {}".format(label_shape, pred_shape))
+
+
+def confusion_matrix(label, pred, label_num, ignore_label=255):
+    '''
+    label_num x label_num int64 matrix, rows are the ground truth labels, columns the predictions
+    '''
+    label = np.asarray(label).ravel().astype(np.int64)
+    pred = np.asarray(pred).ravel().astype(np.int64)
+    valid = label != ignore_label
+    return np.bincount(label[valid] * label_num + pred[valid],
+                       minlength=label_num * label_num).reshape(label_num, label_num)
+
+
+def segmentation_scores(confusion):
+    '''
+    per class IoU, mean IoU, pixel accuracy and frequency weighted IoU of a confusion matrix
+    classes that are neither in the ground truth nor predicted have a NaN IoU: mean_iou counts them as 0 and
+    averages over all label_num classes, as the original metric did, mean_iou_present leaves them out
+    '''
+    confusion = confusion.astype(np.float64)
+    tp = np.diag(confusion)
+    gt = confusion.sum(axis=1)
+    union = gt + confusion.sum(axis=0) - tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = tp / union
+    total = confusion.sum()
+    present = union > 0
+    return {'iou': iou,
+            'mean_iou': float(iou[present].sum() / iou.size),
+            'mean_iou_present': float(iou[present].mean()) if present.any() else 0.0,
+            'pixel_accuracy': float(tp.sum() / total) if total > 0 else 0.0,
+            'fw_iou': float((gt[present] * iou[present]).sum() / total) if total > 0 else 0.0}
+
+
+class IoUMetric(mx.metric.EvalMetric):
+    """
+    Mean Intersection over Union of the DUC outputs, from an accumulated confusion matrix
+    """
+    def __init__(self, ignore_label, label_num, name='IoU'):
+        self._ignore_label = ignore_label
+        self._label_num = label_num
+        super(IoUMetric, self).__init__(name=name)
+
+    def reset(self):
+        self.confusion = np.zeros((self._label_num, self._label_num), dtype=np.int64)
+        self.num_inst = 0
+        self.sum_metric = 0.0
+
+    def update(self, labels, preds):
+        check_label_shapes(labels, preds)
+        for label, pred in zip(labels, preds):
+            # argmax over the classes of the whole batch on the device, one copy to the host
+            pred_label = mx.ndarray.argmax_channel(pred).asnumpy()
+            label = label.asnumpy()
+            check_label_shapes(label, pred_label, shape=1)
+            self.update_confusion(confusion_matrix(label, pred_label, self._label_num, self._ignore_label),
+                                  label.shape[0])
+
+    def update_confusion(self, confusion, num_inst=1):
+        self.confusion += confusion
+        self.num_inst += num_inst
+
+    def merge(self, other):
+        '''
+        add the confusion matrix of another IoUMetric (e.g. of another evaluation worker), or a matrix
+        '''
+        if isinstance(other, IoUMetric):
+            self.update_confusion(other.confusion, other.num_inst)
+        else:
+            self.update_confusion(np.asarray(other, dtype=np.int64), 0)
+
+    def scores(self):
+        return segmentation_scores(self.confusion)
+
+    def get(self):
+        return self.name, self.scores()['mean_iou']
@@ -51,20 +51,31 @@ def save_log(prefix, output_dir):
     logging.getLogger('').addHandler(console)
 
 
+# id to trainId lookup table, ids without a trainId map to 255
+def city_train_id_lut():
+    lut = np.full(256, 255, dtype=np.uint8)
+    for label in cityscapes_labels.labels:
+        if 0 <= label.id < 256 and 0 <= label.trainId < 256:
+            lut[label.id] = label.trainId
+    return lut
+
+
+CITY_TRAIN_ID_LUT = city_train_id_lut()
+
+
 # replace ids with train_ids
 def replace_city_labels(label_data):
-    labels = cityscapes_labels.labels
-    converted = np.ones(label_data.shape, dtype=np.float) * 255
-    # id to trainId
-    id2trainId = {label.id: label.trainId for label in labels}
-    for id in id2trainId:
-        trainId = id2trainId[id]
-        converted[label_data == id] = trainId
-    return converted
+    return CITY_TRAIN_ID_LUT[np.asarray(label_data, dtype=np.uint8)]
+
+
+# source indices of cv.INTER_NEAREST resizing src pixels to dst pixels
+def nearest_index(dst, src):
+    return np.minimum(np.floor(np.arange(dst) * (float(src) / dst)).astype(np.int64), src - 1)
 
 
 # get the data of image and label for networks including a ye layer
-def get_single_image_duc(item, input_args):
+# im and img_label are the decoded uint8 bgr image and label ids, read from the item paths when not given
+def get_single_image_duc(item, input_args, im=None, img_label=None):
     # parse options
     data_path = input_args.get('data_path')
     label_path = input_args.get('label_path', '')
@@ -81,10 +92,9 @@ def get_single_image_duc(item, input_args):
     cell_width = input_args.get('cell_width', 1)
     random_bound = input_args.get('random_bound')
 
-    # read data, scale, and random crop
-    im = cv.imread(os.path.join(data_path, item[0]))
-    # change bgr to rgb
-    im = im[:, :, [2, 1, 0]]
+    # read data, the image stays uint8 bgr until the final mean subtraction
+    if im is None:
+        im = cv.imread(os.path.join(data_path, item[0]))
 
     im_size = (im.shape[0], im.shape[1])
     scale_factor = random.choice(scale_factors)
@@ -93,8 +103,8 @@ def get_single_image_duc(item, input_args):
     crop_coor = [int(int(c) * scale_factor) for c in item[-1]]
 
     if use_random_crop:
-        x0 = crop_coor[0] + random.randint(-random_bound[0], random_bound[0]) - crop_sz[0] / 2
-        y0 = crop_coor[1] + random.randint(-random_bound[1], random_bound[1]) - crop_sz[1] / 2
+        x0 = int(crop_coor[0] + random.randint(-random_bound[0], random_bound[0]) - crop_sz[0] / 2)
+        y0 = int(crop_coor[1] + random.randint(-random_bound[1], random_bound[1]) - crop_sz[1] / 2)
     else:
         # center crop
         x0 = int(crop_coor[0] - crop_sz[0] / 2)
@@ -102,42 +112,41 @@ def get_single_image_duc(item, input_args):
     x1 = int(x0 + crop_sz[0])
     y1 = int(y0 + crop_sz[1])
 
-    # resize
-    scaled_img = cv.resize(im, (scaled_shape[1], scaled_shape[0]), interpolation=cv.INTER_LINEAR)
-
-    # crop and make boarder
-    pad_w_left = max(0 - y0, 0)
-    pad_w_right = max(y1 - scaled_shape[1], 0)
-    pad_h_up = max(0 - x0, 0)
-    pad_h_bottom = max(x1 - scaled_shape[0], 0)
-
-    x0 += pad_h_up
-    x1 += pad_h_up
-    y0 += pad_w_left
-    y1 += pad_w_left
+    # part of the crop inside the scaled image, the rest is border
+    r0, r1 = max(x0, 0), min(x1, scaled_shape[0])
+    c0, c1 = max(y0, 0), min(y1, scaled_shape[1])
 
-    img_data = np.array(scaled_img, dtype=np.float)
-    img_data = cv.copyMakeBorder(img_data, pad_h_up, pad_h_bottom, pad_w_left, pad_w_right, cv.BORDER_CONSTANT,
-                                 value=list(rgb_mean))
-    img_data = img_data[x0:x1, y0:y1, :]
-    img_data = np.transpose(img_data, (2, 0, 1))
-
-    # subtract rgb mean
+    # crop first, only the cropped part of the image is scaled
+    if scaled_shape == im_size:
+        crop = im[r0:r1, c0:c1]
+    else:
+        # the sampling positions of resizing the whole image with cv.INTER_LINEAR, but warpAffine rounds its
+        # fixed-point weights differently from cv.resize: pixels differ by up to 1 gray level (about 1 in 8),
+        # the crop is not bit-exact with scaling the whole image first
+        sy = float(im_size[0]) / scaled_shape[0]
+        sx = float(im_size[1]) / scaled_shape[1]
+        warp = np.array([[sx, 0, sx * (c0 + 0.5) - 0.5], [0, sy, sy * (r0 + 0.5) - 0.5]])
+        crop = cv.warpAffine(im, warp, (c1 - c0, r1 - r0), flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP,
+                             borderMode=cv.BORDER_REPLICATE)
+
+    # change bgr to rgb and subtract rgb mean into float32, the border of rgb_mean becomes 0
+    img_data = np.zeros((3, x1 - x0, y1 - y0), dtype=np.float32)
     for i in range(3):
-        img_data[i] -= rgb_mean[i]
-
-    # read label
-    img_label = np.array(Image.open(os.path.join(label_path, item[1])))
-    img_label = cv.resize(img_label, (scaled_shape[1], scaled_shape[0]), interpolation=cv.INTER_NEAREST)
-    img_label = np.array(img_label, dtype=np.float)
-    img_label = cv.copyMakeBorder(img_label, pad_h_up, pad_h_bottom, pad_w_left, pad_w_right, cv.BORDER_CONSTANT,
-                                  value=ignore_label)
-    img_label = img_label[x0:x1, y0:y1]
-
-    # resize label according to down sample rate
-    if cell_width > 1:
-        img_label = cv.resize(img_label, (int(crop_sz[1] / cell_width), int(crop_sz[0] / cell_width)),
-                              interpolation=cv.INTER_NEAREST)
+        np.subtract(crop[:, :, 2 - i], rgb_mean[i], out=img_data[i, r0 - x0:r1 - x0, c0 - y0:c1 - y0],
+                    dtype=np.float32)
+
+    # read label, only the pixels kept by the nearest resizes to the scaled and to the cell size are gathered
+    if img_label is None:
+        img_label = np.array(Image.open(os.path.join(label_path, item[1])))
+    rows = x0 + nearest_index(int(crop_sz[0] / cell_width), crop_sz[0]) if cell_width > 1 else np.arange(x0, x1)
+    cols = y0 + nearest_index(int(crop_sz[1] / cell_width), crop_sz[1]) if cell_width > 1 else np.arange(y0, y1)
+    valid_rows = (rows >= 0) & (rows < scaled_shape[0])
+    valid_cols = (cols >= 0) & (cols < scaled_shape[1])
+    src_rows = nearest_index(scaled_shape[0], im_size[0])[rows[valid_rows]]
+    src_cols = nearest_index(scaled_shape[1], im_size[1])[cols[valid_cols]]
+    label = np.full((rows.size, cols.size), ignore_label, dtype=np.uint8)
+    label[np.ix_(valid_rows, valid_cols)] = img_label[np.ix_(src_rows, src_cols)]
+    img_label = label
 
     # use mirror
     if use_mirror and random.randint(0, 1) == 1:
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the model scripts import their sibling modules by name
+MODELS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'models')
+for folder in ['common', os.path.join('face_recognition', 'ArcFace'), os.path.join('semantic_segmentation', 'DUC')]:
+    sys.path.insert(0, os.path.join(MODELS, folder))
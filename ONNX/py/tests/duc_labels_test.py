@@ -0,0 +1,48 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from duc_labels import argmax_max, linear_coords, score_labels
+
+
+def random_scores(label_num, h, w, seed=0):
+    # smooth score planes, so that the labels form regions as in a real segmentation
+    rng = np.random.RandomState(seed)
+    coarse = rng.normal(size=(h // 4 + 1, w // 4 + 1, label_num)).astype(np.float32)
+    return np.ascontiguousarray(cv.resize(coarse, (w, h), interpolation=cv.INTER_LINEAR).transpose((2, 0, 1)))
+
+
+@pytest.mark.parametrize('src,dst', [(16, 32), (45, 128), (64, 64), (7, 10)])
+def test_linear_coords_match_resize(src, dst):
+    plane = np.random.RandomState(src).normal(size=(src, 1)).astype(np.float32)
+    lo, hi, frac = linear_coords(dst, src)
+    ref = cv.resize(plane, (1, dst), interpolation=cv.INTER_LINEAR)[:, 0]
+    np.testing.assert_allclose(plane[lo, 0] * (1 - frac) + plane[hi, 0] * frac, ref, atol=1e-5)
+
+
+def test_argmax_max():
+    scores = random_scores(19, 24, 40)
+    labels, best = argmax_max(scores)
+    np.testing.assert_array_equal(labels, np.argmax(scores, axis=0))
+    np.testing.assert_array_equal(best, np.max(scores, axis=0))
+
+
+@pytest.mark.parametrize('shape', [(96, 160), (100, 150)])
+def test_refined_matches_exact(shape):
+    scores = random_scores(19, 48, 80)
+    _, exact = score_labels(scores, shape, 'exact')
+    _, refined = score_labels(scores, shape, 'refined')
+    # cv.resize rounds its weights to float32 differently: only near ties may flip
+    assert np.count_nonzero(refined != exact) <= 1e-4 * exact.size
+
+
+def test_nearest_upsamples_cell_labels():
+    scores = random_scores(19, 48, 80)
+    confidence, labels = score_labels(scores, (96, 160), 'nearest')
+    np.testing.assert_array_equal(labels, np.repeat(np.repeat(np.argmax(scores, axis=0), 2, axis=0), 2, axis=1))
+    assert confidence == pytest.approx(float(np.max(scores, axis=0).mean()))
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        score_labels(random_scores(3, 8, 8), (16, 16), 'bicubic')
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+mx = pytest.importorskip('mxnet')
+from duc_metric import IoUMetric, confusion_matrix, segmentation_scores
+
+
+def legacy_mean_iou(batches, label_num, ignore_label):
+    # the per class loop of the original IoUMetric, over all the batches seen
+    tp, denom = [0.0] * label_num, [0.0] * label_num
+    for label, pred_label in batches:
+        for j in range(label_num):
+            pred_cur = pred_label.flat == j
+            gt_cur = label.flat == j
+            tp[j] += np.logical_and(pred_cur, gt_cur).sum()
+            denom[j] += np.logical_or(pred_cur, gt_cur).sum() - np.logical_and(pred_cur, label.flat == ignore_label).sum()
+    return sum(tp[j] / (denom[j] + 1e-6) for j in range(label_num)) / label_num
+
+
+def random_batches(label_num, num_batch, seed=0):
+    rng = np.random.RandomState(seed)
+    batches = []
+    for _ in range(num_batch):
+        scores = rng.uniform(size=(2, label_num, 12, 16)).astype(np.float32)
+        # the last classes are neither labelled nor predicted: the original metric counts them as 0
+        scores[:, label_num - 3:] = -1
+        label = rng.randint(0, label_num - 3, size=(2, 12, 16))
+        label[rng.uniform(size=label.shape) < 0.1] = 255
+        batches.append((label, scores))
+    return batches
+
+
+def test_iou_metric_matches_legacy():
+    batches = random_batches(19, 4)
+    metric = IoUMetric(ignore_label=255, label_num=19)
+    for label, scores in batches:
+        metric.update([mx.nd.array(label)], [mx.nd.array(scores)])
+    legacy = legacy_mean_iou([(label, np.argmax(scores, axis=1)) for label, scores in batches], 19, 255)
+    name, value = metric.get()
+    assert name == 'IoU'
+    assert value == pytest.approx(legacy, rel=1e-6)
+    assert metric.scores()['mean_iou_present'] > value
+
+
+def test_merge_matches_single_metric():
+    batches = random_batches(19, 6, seed=1)
+    single = IoUMetric(ignore_label=255, label_num=19)
+    workers = [IoUMetric(ignore_label=255, label_num=19) for _ in range(3)]
+    for i, (label, scores) in enumerate(batches):
+        single.update([mx.nd.array(label)], [mx.nd.array(scores)])
+        workers[i % 3].update([mx.nd.array(label)], [mx.nd.array(scores)])
+    merged = IoUMetric(ignore_label=255, label_num=19)
+    for worker in workers:
+        merged.merge(worker)
+    np.testing.assert_array_equal(merged.confusion, single.confusion)
+    assert merged.num_inst == single.num_inst
+    assert merged.get() == single.get()
+
+
+def test_segmentation_scores():
+    label = np.array([0, 0, 1, 1, 255, 2])
+    pred = np.array([0, 1, 1, 1, 0, 2])
+    scores = segmentation_scores(confusion_matrix(label, pred, 4))
+    np.testing.assert_allclose(scores['iou'][:3], [0.5, 2 / 3.0, 1.0])
+    assert np.isnan(scores['iou'][3])
+    assert scores['mean_iou'] == pytest.approx((0.5 + 2 / 3.0 + 1.0) / 4)
+    assert scores['mean_iou_present'] == pytest.approx((0.5 + 2 / 3.0 + 1.0) / 3)
+    assert scores['pixel_accuracy'] == pytest.approx(4 / 5.0)
@@ -0,0 +1,66 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+pytest.importorskip('mxnet')
+from duc_engine import CELL_WIDTH, DS_RATE, LABEL_NUM, DucEngine, cell_shape, rearrange
+
+
+def local_model(data):
+    '''
+    Stand-in for the network whose scores of a cell only depend on the pixels of that cell,
+    so every tile covering a cell gives it the same scores, laid out as the DUC output
+    '''
+    n, _, h, w = data.shape
+    cells = data.reshape((n, 3, h // CELL_WIDTH, CELL_WIDTH, w // CELL_WIDTH, CELL_WIDTH)).mean(axis=(3, 5))
+    freq = np.arange(1, LABEL_NUM + 1, dtype=np.float32)[None, :, None, None]
+    scores = np.sin(freq * cells[:, :1] / 40.0 + cells[:, 1:2] / 30.0) + np.cos(freq * cells[:, 2:] / 50.0)
+    scores = scores.reshape((n, LABEL_NUM, h // DS_RATE, 4, w // DS_RATE, 4)).transpose((0, 1, 3, 5, 2, 4))
+    return scores.reshape((n, LABEL_NUM * 16, h // DS_RATE, w // DS_RATE)).astype(np.float32)
+
+
+class LocalEngine(DucEngine):
+    def __init__(self, buckets, batch_size):
+        self.buckets = [tuple(b) for b in buckets]
+        self.batch_size = batch_size
+        self.rgb_mean = None
+        self.label_mode = 'exact'
+        self.inputs = dict((b, np.zeros((batch_size, 3) + b, dtype=np.float32)) for b in self.buckets)
+
+    def forward(self, bucket, num):
+        return local_model(self.inputs[bucket])[:num]
+
+
+@pytest.mark.parametrize('shape,tile,overlap,batch_size', [
+    ((300, 500), (64, 96), 16, 3),
+    ((100, 100), (128, 128), 32, 2),
+    ((257, 1000), (64, 64), 0, 4),
+    ((131, 77), (32, 40), 8, 2),
+])
+def test_tiled_matches_whole_image(shape, tile, overlap, batch_size):
+    im = np.random.RandomState(0).randint(0, 255, shape + (3,)).astype(np.uint8)
+    engine = LocalEngine([tile], batch_size)
+    out = np.zeros(shape, dtype=np.uint8)
+    confidence, labels = engine.predict_tiled(im, tile, overlap, out=out, rows_per_step=5)
+    assert labels is out
+
+    # the whole zero padded image at once, its half resolution scores upsampled by 2
+    cells = cell_shape(*shape)
+    padded = (max(cells[0], tile[0]), max(cells[1], tile[1]))
+    data = np.zeros((1, 3) + padded, dtype=np.float32)
+    engine.fill_tile(data[0], im, 0, 0, cv.mean(im)[:3])
+    scores = rearrange(local_model(data)[0], padded, padded)
+    up = cv.resize(scores.transpose((1, 2, 0)), (padded[1], padded[0]), interpolation=cv.INTER_LINEAR)
+    up = up[:shape[0], :shape[1]]
+    np.testing.assert_array_equal(labels, np.argmax(up, axis=2))
+    assert confidence == pytest.approx(float(np.max(up, axis=2).mean()), rel=1e-5)
+
+
+def test_tiled_matches_predict():
+    # with sizes a multiple of 8 the whole image postprocess resizes by 2 as well
+    im = np.random.RandomState(1).randint(0, 255, (160, 240, 3)).astype(np.uint8)
+    engine = LocalEngine([(64, 64), (160, 240)], 2)
+    confidence, labels = engine.predict([im])[0]
+    tiled_confidence, tiled = engine.predict_tiled(im, (64, 64), 16)
+    np.testing.assert_array_equal(tiled, labels)
+    assert tiled_confidence == pytest.approx(confidence, rel=1e-5)
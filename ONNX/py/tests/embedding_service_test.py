@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from concurrent.futures import wait
+
+import numpy as np
+import pytest
+
+from embedding_service import EmbeddingService
+
+
+class StubModel(object):
+    """
+    embedding model stand-in: the embedding of a face is its first pixels,
+    runs block while the gate is closed
+    """
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.gate = threading.Event()
+        self.gate.set()
+        self.running = threading.Event()
+
+    def run(self, data):
+        self.running.set()
+        self.gate.wait()
+        self.last_input = data.copy()
+        return [data.reshape(data.shape[0], -1)[:, :self.dim].copy()]
+
+
+def face(value, image_size=(2, 2)):
+    aligned = np.zeros((3,) + image_size, dtype=np.float32)
+    aligned.flat[0] = value
+    return aligned
+
+
+def test_embedding_is_normalized():
+    with EmbeddingService(StubModel(), batch_size=4, max_wait=0.001, image_size=(2, 2)) as service:
+        embedding = service.embed(face(3.0))
+    np.testing.assert_allclose(embedding, [1, 0, 0, 0])
+
+
+def test_zero_embedding():
+    with EmbeddingService(StubModel(), batch_size=4, max_wait=0.001, image_size=(2, 2)) as service:
+        embedding = service.embed(face(0.0))
+    assert np.all(np.isfinite(embedding))
+    np.testing.assert_array_equal(embedding, 0)
+
+
+def test_cancelled_request_keeps_the_worker_alive():
+    model = StubModel()
+    with EmbeddingService(model, batch_size=1, max_wait=0.001, image_size=(2, 2)) as service:
+        # hold the worker inside the first batch so the next request stays queued
+        model.gate.clear()
+        model.running.clear()
+        first = service.submit(face(1.0))
+        assert model.running.wait(5)
+
+        async def timed_out():
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(service.embed_async(face(2.0)), timeout=0.01)
+        asyncio.run(timed_out())
+
+        cancelled = service.submit(face(3.0))
+        assert cancelled.cancel()
+
+        model.gate.set()
+        np.testing.assert_allclose(first.result(timeout=5), [1, 0, 0, 0])
+        np.testing.assert_allclose(service.submit(face(4.0)).result(timeout=5), [1, 0, 0, 0])
+        assert service.stats()['requests'] == 2
+
+
+def test_partial_batch_is_zero_padded():
+    model = StubModel()
+    with EmbeddingService(model, batch_size=4, max_wait=0.001, image_size=(2, 2)) as service:
+        service.embed_batch([face(1.0), face(2.0), face(3.0)])
+        service.embed(face(4.0))
+    assert model.last_input[0].flat[0] == 4.0
+    np.testing.assert_array_equal(model.last_input[1:], 0)
+
+
+def test_submit_races_close():
+    service = EmbeddingService(StubModel(), batch_size=4, max_wait=0.001, image_size=(2, 2))
+    futures, refused = [], []
+
+    def client():
+        for _ in range(200):
+            try:
+                futures.append(service.submit(face(1.0)))
+            except RuntimeError:
+                refused.append(1)
+
+    clients = [threading.Thread(target=client) for _ in range(4)]
+    for thread in clients:
+        thread.start()
+    service.close()
+    for thread in clients:
+        thread.join()
+    # every accepted face is answered, the others are refused
+    done, not_done = wait(futures, timeout=5)
+    assert not not_done
+    assert len(futures) + len(refused) == 800
+    with pytest.raises(RuntimeError):
+        service.submit(face(1.0))
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from helper import umeyama_batch
+from face_preprocess import ARCFACE_SRC, alignment_transforms, preprocess, preprocess_batch
+from benchmark_align import legacy_align, legacy_umeyama, random_landmarks
+
+
+def arcface_src():
+    # the reference landmarks of the 112 x 112 face, shifted in float32 as alignment_transforms does
+    src = ARCFACE_SRC.copy()
+    src[:, 0] += 8.0
+    return src
+
+
+def test_umeyama_batch_matches_legacy():
+    landmarks = random_landmarks(200, 1920, 1080)
+    src = arcface_src()
+    ref = np.stack([legacy_umeyama(landmark, src) for landmark in landmarks])
+    # legacy_umeyama averages the float32 reference points in float32, umeyama_batch in float64
+    np.testing.assert_allclose(umeyama_batch(landmarks, src), ref, rtol=1e-9, atol=1e-5)
+    np.testing.assert_allclose(alignment_transforms(landmarks), ref, rtol=1e-9, atol=1e-5)
+
+
+def test_umeyama_batch_recovers_similarity():
+    rng = np.random.RandomState(0)
+    angle, scale, shift = 0.3, 1.7, np.array([12.0, -5.0])
+    rot = scale * np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    src = rng.uniform(0, 100, size=(1, 5, 2))
+    M = umeyama_batch(src, src[0].dot(rot.T) + shift)[0]
+    np.testing.assert_allclose(M[:, :2], rot, atol=1e-10)
+    np.testing.assert_allclose(M[:, 2], shift, atol=1e-8)
+
+
+@pytest.mark.parametrize('rgb', [False, True])
+def test_preprocess_batch_matches_legacy(rgb):
+    img = np.random.RandomState(0).randint(0, 255, (600, 800, 3)).astype(np.uint8)
+    landmarks = random_landmarks(20, img.shape[1], img.shape[0], seed=1)
+    ref = legacy_align(img, landmarks, arcface_src())
+    if not rgb:
+        ref = ref[:, ::-1]
+    # the last bits of the transforms differ, warpAffine rounds them to fixed point: a few pixels are 1 off
+    diff = np.abs(preprocess_batch(img, landmarks, rgb=rgb).astype(int) - ref)
+    assert diff.max() <= 1
+    assert np.count_nonzero(diff) < 1e-3 * diff.size
+
+
+def test_preprocess_matches_batch():
+    img = np.random.RandomState(0).randint(0, 255, (600, 800, 3)).astype(np.uint8)
+    landmarks = random_landmarks(3, img.shape[1], img.shape[0], seed=2)
+    batch = preprocess_batch(img, landmarks)
+    for i, landmark in enumerate(landmarks):
+        face = preprocess(img, landmark=landmark, image_size='112,112')
+        np.testing.assert_array_equal(face.transpose((2, 0, 1)), batch[i])
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from face_gallery import FaceGallery
+
+
+def exact_rows(gallery, queries, k, alive, dtype):
+    # brute force over the same quantized embeddings the gallery stores
+    gallery = gallery / np.linalg.norm(gallery, axis=1, keepdims=True)
+    if dtype == 'int8':
+        gallery = np.round(gallery * 127)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = np.dot(queries, gallery.T)
+    scores[:, ~alive] = -np.inf
+    return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+@pytest.mark.parametrize('cache_bytes', [0, 2 * 100 * 16 * 4])
+def test_search_matches_brute_force(tmp_path, dtype, cache_bytes):
+    rng = np.random.RandomState(0)
+    gallery = FaceGallery(str(tmp_path), dim=16, dtype=dtype, block_size=100, cache_bytes=cache_bytes)
+    x = rng.normal(size=(250, 16)).astype(np.float32)
+    gallery.add(x, np.arange(250))
+    q = rng.normal(size=(7, 16)).astype(np.float32)
+    alive = np.ones(250, dtype=bool)
+    np.testing.assert_array_equal(gallery.search(q, 5)[1], exact_rows(x, q, 5, alive, dtype))
+
+    # the partial last block grows: a cached copy of it must not go stale
+    x = np.vstack([x, rng.normal(size=(120, 16)).astype(np.float32)])
+    gallery.add(x[250:], np.arange(250, 370))
+    alive = np.ones(370, dtype=bool)
+    np.testing.assert_array_equal(gallery.search(q, 5)[1], exact_rows(x, q, 5, alive, dtype))
+
+    gallery.remove(np.arange(0, 370, 3))
+    alive[::3] = False
+    np.testing.assert_array_equal(gallery.search(q, 5)[1], exact_rows(x, q, 5, alive, dtype))
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+def test_compact_keeps_results(tmp_path, dtype):
+    rng = np.random.RandomState(1)
+    with FaceGallery(str(tmp_path), dim=16, dtype=dtype, block_size=100) as gallery:
+        x = rng.normal(size=(370, 16)).astype(np.float32)
+        gallery.add(x, np.arange(370))
+        gallery.remove(np.arange(0, 370, 3))
+    alive = np.ones(370, dtype=bool)
+    alive[::3] = False
+    q = rng.normal(size=(7, 16)).astype(np.float32)
+    labels = np.flatnonzero(alive)
+
+    gallery = FaceGallery(str(tmp_path))
+    gallery.compact()
+    assert len(gallery) == alive.sum()
+    expected = labels[exact_rows(x[alive], q, 5, np.ones(alive.sum(), dtype=bool), dtype)]
+    np.testing.assert_array_equal(gallery.search(q, 5)[1], expected)
+    np.testing.assert_array_equal(FaceGallery(str(tmp_path)).search(q, 5)[1], expected)
+
+
+def test_interrupted_compact_keeps_gallery(tmp_path, monkeypatch):
+    rng = np.random.RandomState(2)
+    gallery = FaceGallery(str(tmp_path), dim=16, block_size=100)
+    x = rng.normal(size=(250, 16)).astype(np.float32)
+    gallery.add(x, np.arange(250))
+    gallery.remove(np.arange(0, 250, 2))
+    gallery.flush()
+
+    # crash at the commit point: the gallery on disk must still be the old one
+    def crash(self):
+        raise RuntimeError('crash')
+    monkeypatch.setattr(FaceGallery, 'write_meta', crash)
+    with pytest.raises(RuntimeError):
+        gallery.compact()
+    monkeypatch.undo()
+
+    reopened = FaceGallery(str(tmp_path))
+    assert reopened.generation == 0 and len(reopened) == 125
+    q = rng.normal(size=(3, 16)).astype(np.float32)
+    alive = np.arange(250) % 2 == 1
+    np.testing.assert_array_equal(reopened.search(q, 5)[1], exact_rows(x, q, 5, alive, 'float16'))
+
+
+def test_zero_embedding_scores_are_finite(tmp_path):
+    gallery = FaceGallery(str(tmp_path), dim=16, block_size=100)
+    gallery.add(np.random.RandomState(3).normal(size=(10, 16)), np.arange(10))
+    gallery.add(np.zeros((1, 16)), [9999])
+    assert np.isfinite(gallery.search(np.zeros((1, 16), dtype=np.float32), 11)[0]).all()
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from face_ivfpq import FaceIvfPq
+
+
+@pytest.fixture
+def index(tmp_path):
+    rng = np.random.RandomState(0)
+    index = FaceIvfPq(str(tmp_path), dim=16, nlist=8, m=4, keep_vectors=True)
+    index.train(rng.normal(size=(600, 16)).astype(np.float32), niter=5)
+    gallery = rng.normal(size=(500, 16)).astype(np.float32)
+    index.add(gallery, np.arange(500) + 1000)
+    return index, gallery, rng.normal(size=(9, 16)).astype(np.float32)
+
+
+def unit(x):
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_full_probe_rerank_matches_exact(index):
+    index, gallery, queries = index
+    # every list probed and every face re-ranked: exact search over the float16 embeddings
+    scores, labels = index.search(queries, k=10, nprobe=index.nlist, rerank=len(gallery))
+    vectors = unit(gallery).astype(np.float16).astype(np.float32)
+    sim = np.dot(unit(queries), vectors.T)
+    exact = np.argsort(-sim, axis=1, kind='stable')[:, :10]
+    np.testing.assert_array_equal(labels, exact + 1000)
+    np.testing.assert_allclose(scores, np.take_along_axis(sim, exact, axis=1), rtol=1e-5, atol=1e-6)
+
+
+def test_pq_scores_match_reconstruction(index):
+    index, gallery, queries = index
+    # the lookup tables give the distance to the decoded face: its coarse centroid plus its PQ centroids
+    lists, codes = index.encode(unit(gallery))
+    decoded = index.centroids[lists] + np.concatenate(
+        [index.codebooks[j][codes[:, j]] for j in range(index.m)], axis=1)
+    dist = ((unit(queries)[:, None, :] - decoded[None]) ** 2).sum(axis=2)
+    exact = np.argsort(dist, axis=1, kind='stable')[:, :10]
+    scores, labels = index.search(queries, k=10, nprobe=index.nlist)
+    np.testing.assert_allclose(scores, 1 - np.take_along_axis(dist, exact, axis=1) / 2, rtol=1e-4, atol=1e-4)
+    # ties between faces with the same codes may come in any order
+    np.testing.assert_allclose(scores, 1 - dist[np.arange(len(queries))[:, None], labels - 1000] / 2,
+                               rtol=1e-4, atol=1e-4)
+
+
+def test_reopen_keeps_index(index, tmp_path):
+    index, gallery, queries = index
+    expected = index.search(queries, k=5, nprobe=4)
+    index.flush()
+    reopened = FaceIvfPq(str(tmp_path))
+    for a, b in zip(reopened.search(queries, k=5, nprobe=4), expected):
+        np.testing.assert_array_equal(a, b)
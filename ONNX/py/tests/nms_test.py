@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from helper import nms, batched_nms
+from benchmark_nms import legacy_nms, random_boxes
+
+
+@pytest.mark.parametrize('mode', ['Union', 'Min'])
+@pytest.mark.parametrize('num_box', [1, 7, 300, 3000])
+def test_nms_matches_legacy(num_box, mode):
+    boxes = random_boxes(num_box, seed=num_box)
+    for threshold in [0.3, 0.5, 0.7]:
+        np.testing.assert_array_equal(nms(boxes, threshold, mode), np.asarray(legacy_nms(boxes, threshold, mode)))
+
+
+def test_nms_integer_boxes():
+    boxes = np.round(random_boxes(200)).astype(np.int32)
+    boxes[:, 4] = np.random.RandomState(0).permutation(200)
+    np.testing.assert_array_equal(nms(boxes, 0.5), np.asarray(legacy_nms(boxes, 0.5)))
+
+
+def test_nms_empty():
+    assert len(nms(np.zeros((0, 5), dtype=np.float32), 0.5)) == 0
+    assert len(batched_nms(np.zeros((0, 5), dtype=np.float32), np.zeros(0, dtype=int), 0.5)) == 0
+
+
+@pytest.mark.parametrize('mode', ['Union', 'Min'])
+def test_batched_nms_matches_per_group(mode):
+    boxes = random_boxes(2000)
+    groups = np.random.RandomState(1).randint(0, 10, size=len(boxes))
+    loop = np.concatenate([np.flatnonzero(groups == g)[legacy_nms(boxes[groups == g], 0.5, mode)]
+                           for g in np.unique(groups)])
+    np.testing.assert_array_equal(batched_nms(boxes, groups, 0.5, mode), loop)
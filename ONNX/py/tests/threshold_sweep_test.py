@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from threshold_sweep import calculate_accuracy, calculate_accuracies
+
+
+def sweep_loop(thresholds, dist, actual_issame):
+    return np.array([calculate_accuracy(threshold, dist, actual_issame) for threshold in thresholds]).T
+
+
+@pytest.mark.parametrize('same_fraction', [0.0, 0.3, 0.5, 1.0])
+def test_calculate_accuracies_matches_loop(same_fraction):
+    rng = np.random.RandomState(0)
+    actual_issame = rng.uniform(size=1000) < same_fraction
+    dist = np.where(actual_issame, rng.uniform(0, 2.5, size=1000), rng.uniform(1, 4, size=1000))
+    thresholds = np.arange(0, 4, 0.01)
+    # distances on the grid: np.less keeps the pairs at the threshold out
+    dist[:100] = thresholds[rng.randint(0, len(thresholds), size=100)]
+    for ref, out in zip(sweep_loop(thresholds, dist, actual_issame), calculate_accuracies(thresholds, dist, actual_issame)):
+        np.testing.assert_allclose(out, ref, rtol=0, atol=1e-12)
+
+
+def test_calculate_accuracies_fold_selection():
+    rng = np.random.RandomState(1)
+    actual_issame = rng.uniform(size=600) < 0.5
+    dist = np.round(np.where(actual_issame, rng.normal(1.0, 0.3, size=600), rng.normal(1.8, 0.3, size=600)), 2)
+    thresholds = np.arange(0, 4, 0.01)
+    _, _, acc = calculate_accuracies(thresholds, dist, actual_issame)
+    _, _, ref = sweep_loop(thresholds, dist, actual_issame)
+    # the same best threshold is picked, ties included
+    assert np.argmax(acc) == np.argmax(ref)